@@ -0,0 +1,507 @@
+"""
+This module contains an in-process message broker and the transport
+built on it, which let several server nodes run in a single process
+without an ``NSQ`` deployment.
+"""
+
+from collections import deque
+from itertools import count
+
+from zope.interface import implements
+from twisted.internet import reactor
+from twisted.python import log
+
+from ircdd import envelope
+from ircdd.stats import Stats
+from ircdd.transport import ITransport, filter_messages
+
+
+class Message(object):
+    """
+    A message delivered by the :class:`LocalBroker`. Mirrors the parts
+    of :class:`nsq.Message` that the message handlers use.
+    """
+
+    def __init__(self, channel, id, body):
+        self.id = id
+        self.body = body
+        self.attempts = 0
+        self._channel = channel
+        self._responded = False
+
+    def is_responded(self):
+        return self._responded
+
+    def enable_async(self):
+        """
+        Marks the message as handled asynchronously. The broker only
+        removes a message once it is finished, so this does nothing.
+        """
+
+    def finish(self):
+        """
+        Acknowledges the message, removing it from its channel.
+        """
+        if not self._responded:
+            self._responded = True
+            self._channel.finish(self)
+
+    def requeue(self, delay=0):
+        """
+        Puts the message back on its channel, to be delivered again
+        after the given number of seconds.
+        """
+        if not self._responded:
+            self._responded = True
+            self._channel.requeue(self, delay)
+
+
+class _Channel(object):
+    """
+    The queue of a single channel on a topic, consumed by at most
+    one :class:`LocalReader`.
+    """
+
+    def __init__(self, broker, topic, name):
+        self.broker = broker
+        self.topic = topic
+        self.name = name
+        self.queue = deque()
+        self.in_flight = {}
+        self.reader = None
+        self._pump = None
+
+    def put(self, id, body):
+        self.queue.append(Message(self, id, body))
+        self.schedule()
+
+    def schedule(self, delay=0):
+        """
+        Schedules the delivery of the queued messages. Deliveries
+        never happen synchronously with a publish, as with ``NSQ``.
+        """
+        if self._pump is None:
+            self._pump = self.broker._clock.callLater(delay, self.deliver)
+
+    def deliver(self):
+        """
+        Hands queued messages to the reader until its in-flight
+        limit is reached.
+        """
+        self._pump = None
+        reader = self.reader
+        if reader is None:
+            return
+
+        if reader.disabled():
+            if self.queue:
+                self.schedule(self.broker.poll_interval)
+            return
+
+        while self.queue and len(self.in_flight) < reader.max_in_flight:
+            message = self.queue.popleft()
+            message.attempts += 1
+            message._responded = False
+            timeout = self.broker._clock.callLater(
+                self.broker.msg_timeout, self.expire, message)
+            self.in_flight[message.id] = (message, timeout)
+            self.broker.stats.incr("broker.delivered")
+
+            try:
+                result = reader.handler(message)
+            except Exception:
+                log.err()
+                result = False
+
+            if result is True:
+                message.finish()
+            elif result is False:
+                message.requeue()
+
+    def finish(self, message):
+        entry = self.in_flight.pop(message.id, None)
+        if entry is not None:
+            if entry[1].active():
+                entry[1].cancel()
+            self.schedule()
+
+    def requeue(self, message, delay=0):
+        entry = self.in_flight.pop(message.id, None)
+        if entry is None:
+            return
+        if entry[1].active():
+            entry[1].cancel()
+
+        self.broker.stats.incr("broker.requeued")
+        if delay:
+            self.broker._clock.callLater(delay, self._restore, message)
+        else:
+            self._restore(message)
+
+    def _restore(self, message):
+        self.queue.append(message)
+        self.schedule()
+
+    def expire(self, message):
+        """
+        Requeues a message which was not finished in time.
+        """
+        if message.id in self.in_flight:
+            self.broker.stats.incr("broker.timeouts")
+            message._responded = True
+            self.requeue(message)
+
+    def close(self):
+        if self._pump is not None and self._pump.active():
+            self._pump.cancel()
+        self._pump = None
+        for message, timeout in self.in_flight.values():
+            if timeout.active():
+                timeout.cancel()
+            self.queue.appendleft(message)
+        self.in_flight = {}
+
+
+class LocalBroker(object):
+    """
+    An in-process broker with the queueing semantics of ``NSQ``: every
+    message published on a topic is copied to each of the topic's
+    channels, and messages published before a topic has any channel
+    are kept until the first one is created. Each channel delivers its
+    messages asynchronously to its reader, keeping at most the reader's
+    ``max_in_flight`` unfinished; messages which are requeued or not
+    finished within ``msg_timeout`` seconds are delivered again.
+
+    A single broker can be shared by several server nodes in the same
+    process, each consuming on a channel named after itself.
+
+    :param stats: an optional :class:`ircdd.stats.Stats` registry on
+        which to maintain the broker counters and gauges.
+
+    :param msg_timeout: seconds after which an unfinished message is
+        requeued.
+    :type float:
+
+    :param poll_interval: seconds between delivery attempts while a
+        reader is paused.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for scheduling. Defaults to the reactor.
+    """
+
+    def __init__(self, stats=None, msg_timeout=60.0, poll_interval=0.1,
+                 clock=None):
+        self.stats = stats if stats is not None else Stats()
+        self.msg_timeout = msg_timeout
+        self.poll_interval = poll_interval
+        self._clock = clock or reactor
+
+        self._ids = count(1)
+        self._channels = {}
+        self._backlog = {}
+
+        self.stats.gauge("broker.depth", self.depth)
+        self.stats.gauge("broker.in_flight", self.inFlight)
+
+    def depth(self):
+        """
+        Returns the number of messages waiting to be delivered.
+        """
+        return (sum(len(c.queue) for c in self._allChannels()) +
+                sum(len(b) for b in self._backlog.itervalues()))
+
+    def inFlight(self):
+        """
+        Returns the number of messages delivered but not yet finished.
+        """
+        return sum(len(c.in_flight) for c in self._allChannels())
+
+    def _allChannels(self):
+        for channels in self._channels.itervalues():
+            for channel in channels.itervalues():
+                yield channel
+
+    def publish(self, topic, body):
+        """
+        Publishes a message on the topic.
+
+        :param topic: the name of the topic.
+
+        :param body: the serialized message.
+        """
+        self.stats.incr("broker.published")
+        channels = self._channels.get(topic)
+        if not channels:
+            self._backlog.setdefault(topic, deque()).append(body)
+            return
+
+        id = next(self._ids)
+        for channel in channels.itervalues():
+            channel.put(id, body)
+
+    def channel(self, topic, name):
+        """
+        Returns the named channel on the topic, creating it if needed.
+
+        :param topic: the name of the topic.
+
+        :param name: the name of the channel.
+        """
+        channels = self._channels.setdefault(topic, {})
+        if name not in channels:
+            channel = channels[name] = _Channel(self, topic, name)
+            for body in self._backlog.pop(topic, ()):
+                channel.put(next(self._ids), body)
+        return channels[name]
+
+    def deleteChannel(self, topic, name):
+        """
+        Deletes the named channel on the topic along with its messages.
+
+        :param topic: the name of the topic.
+
+        :param name: the name of the channel.
+        """
+        channels = self._channels.get(topic, {})
+        channel = channels.pop(name, None)
+        if channel is not None:
+            channel.close()
+        if not channels:
+            self._channels.pop(topic, None)
+
+
+_default = None
+
+
+def defaultBroker():
+    """
+    Returns the broker shared by all the nodes of the process.
+    """
+    global _default
+    if _default is None:
+        _default = LocalBroker()
+    return _default
+
+
+class LocalReader(object):
+    """
+    Consumes a channel of the :class:`LocalBroker`. Like a
+    :class:`nsq.Reader`, it can be placed under the control of a
+    :class:`ircdd.flow.FlowController`.
+    """
+
+    def __init__(self, channel, handler, max_in_flight=1):
+        self.channel = channel
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.conns = {}
+        self.disabled = lambda: False
+
+        channel.reader = self
+        channel.schedule()
+
+    def close(self):
+        if self.channel.reader is self:
+            self.channel.reader = None
+            self.channel.close()
+
+
+class LocalReadWriter(object):
+    """
+    A transport which exchanges messages with the other nodes of the
+    process through a :class:`LocalBroker`. It behaves like
+    :class:`ircdd.remote.RemoteReadWriter`: subscriptions are
+    reference-counted and unreferenced readers are closed after a
+    grace period.
+
+    :param broker: the :class:`LocalBroker` shared by the nodes.
+
+    :param server_name: a string that uniquely idetifies this server
+        instance. It is used as channel name.
+    :type string:
+
+    :param stats: an optional :class:`ircdd.stats.Stats` registry on
+        which to maintain the reader counters and gauges.
+
+    :param reader_grace: the number of seconds for which an
+        unreferenced reader is kept before it is closed.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for scheduling. Defaults to the reactor.
+
+    :param flow: an optional :class:`ircdd.flow.FlowController` which
+        sets the in-flight limits of the readers.
+
+    :param compressor: an optional :class:`ircdd.compression.Compressor`
+        which compresses large message bodies.
+
+    :param dedup: an optional :class:`ircdd.dedup.Deduplicator` which
+        drops redelivered messages.
+
+    :param reorder: an optional :class:`ircdd.reorder.ReorderBuffer`
+        which delivers each origin's messages in order.
+
+    :param sequencer: an optional :class:`ircdd.envelope.Sequencer`
+        which numbers the published messages. Defaults to a sequencer
+        of this transport's own.
+    """
+
+    implements(ITransport)
+
+    def __init__(self, broker, server_name, stats=None, reader_grace=30.0,
+                 clock=None, flow=None, compressor=None, dedup=None,
+                 reorder=None, sequencer=None):
+        self._broker = broker
+        self._server_name = server_name
+        self._reader_grace = reader_grace
+        self._clock = clock or reactor
+        self._flow = flow
+        self._compressor = compressor
+        self._dedup = dedup
+        self._reorder = reorder
+        self._sequencer = sequencer or envelope.Sequencer()
+
+        self._readers = {}
+        self._refs = {}
+        self._evictions = {}
+
+        self.stats = stats if stats is not None else Stats()
+        self.stats.gauge("remote.readers", lambda: len(self._readers))
+        self.stats.gauge("broker.depth", broker.depth)
+        self.stats.gauge("broker.in_flight", broker.inFlight)
+
+    def subscribe(self, topic, callback, msg_types=None):
+        """
+        Subscribes a callback to a topic, on this server's channel of
+        the topic in the broker. A :class:`LocalReader` is started for
+        the topic if there is none yet; only one callback per topic
+        exists. Every call takes a reference on the topic which must be
+        dropped with :meth:`release`.
+
+        :param topic: a string which identifies the topic on which to listen.
+        :type string:
+
+        :param callback: the callback which will be called when a message is
+            read. It takes a single argument (`message`), a
+            :class:`Message` with the decoded body in its
+            `parsed_msg` attribute, and must call `finish()` or
+            `requeue()` on it, or return `True`/`False`.
+        :type callable:
+
+        :param msg_types: an optional list of message types that the
+            callback handles. Messages of other types are finished
+            without being decoded.
+        :type list:
+        """
+        self._refs[topic] = self._refs.get(topic, 0) + 1
+
+        eviction = self._evictions.pop(topic, None)
+        if eviction is not None:
+            eviction.cancel()
+
+        if topic not in self._readers:
+            handler = filter_messages(callback, self._server_name,
+                                      target=topic, msg_types=msg_types,
+                                      dedup=self._dedup,
+                                      reorder=self._reorder)
+            max_in_flight = 1
+            if self._flow:
+                handler = self._flow.wrap(topic, handler)
+                max_in_flight = self._flow.share()
+
+            channel = self._broker.channel(topic, self._server_name)
+            reader = LocalReader(channel, handler, max_in_flight)
+            self._readers[topic] = reader
+
+            if self._flow:
+                self._flow.register(topic, reader)
+
+    def release(self, topic, delete_channel=False):
+        """
+        Drops a reference taken on the topic by :meth:`subscribe`.
+        When the last reference is dropped, the topic's reader is
+        closed after the grace period, unless the topic is subscribed
+        to again in the meantime.
+
+        :param topic: the topic to release.
+        :type string:
+
+        :param delete_channel: if True, this server's channel on the
+            topic is deleted once the reader is closed.
+        :type bool:
+        """
+        refs = self._refs.get(topic, 0) - 1
+        if refs > 0:
+            self._refs[topic] = refs
+            return
+
+        self._refs.pop(topic, None)
+        if topic in self._readers and topic not in self._evictions:
+            self._evictions[topic] = self._clock.callLater(
+                self._reader_grace, self._evict, topic, delete_channel)
+
+    def _evict(self, topic, delete_channel):
+        """
+        Closes the reader of a topic which was left unreferenced
+        for the whole grace period.
+        """
+        del self._evictions[topic]
+        self.unsubscribe(topic, delete_channel)
+        self.stats.incr("remote.readers_evicted")
+
+    def unsubscribe(self, topic, delete_channel=False):
+        """
+        Unsubscribes the callback from the given topic and closes
+        its reader immediately, regardless of the references held on
+        the topic.
+
+        :param topic: the topic for which to stop listening.
+        :type string:
+
+        :param delete_channel: if True, also deletes this server's
+            channel on the topic, along with the messages queued on it.
+        :type bool:
+        """
+        self._readers.pop(topic).close()
+        self._refs.pop(topic, None)
+
+        if self._flow:
+            self._flow.unregister(topic)
+
+        eviction = self._evictions.pop(topic, None)
+        if eviction is not None:
+            eviction.cancel()
+
+        if self._reorder is not None:
+            self._reorder.forget(envelope.digest(topic))
+
+        if delete_channel:
+            self._broker.deleteChannel(topic, self._server_name)
+            self.stats.incr("remote.channels_deleted")
+
+    def publish(self, topic, msg_body, callback=None):
+        """
+        Publishes a message to the given topic of the broker and calls
+        the optional callback once completed. The message is wrapped
+        in an envelope (see :mod:`ircdd.envelope`) like those published
+        to ``NSQ``, and copied to every channel of the topic.
+
+        :param topic: the name of the topic to publish to.
+        :type string:
+
+        :param msg_body: the message to publish.
+        :type dict:
+
+        :param callback: an optional callback which will be called
+            without arguments once the broker holds the message.
+        :type callable:
+        """
+        self._broker.publish(topic,
+                             envelope.pack(self._server_name, topic,
+                                           msg_body,
+                                           compressor=self._compressor,
+                                           sequencer=self._sequencer))
+        if callback is not None:
+            callback()
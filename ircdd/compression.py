@@ -0,0 +1,91 @@
+"""
+This module contains the compressor which decides which message
+bodies are compressed before being published to the cluster.
+"""
+
+import time
+import zlib
+
+
+class Compressor(object):
+    """
+    Compresses the bodies of the messages whose size reaches the
+    threshold of their message type, with zlib.
+
+    A body is only sent compressed when that makes it smaller. The
+    number of bytes before and after compression and the time spent
+    compressing are maintained as counters, and the overall ratio of
+    compressed to original size as a gauge.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the compression counters and gauges.
+
+    :param thresholds: an optional dict mapping message types
+        (``privmsg``, ``join``, ...) to the size in bytes from which
+        their bodies are compressed, or None to never compress them.
+    :type dict:
+
+    :param default_threshold: the threshold of the message types
+        missing from ``thresholds``. None disables compression for
+        them.
+    :type int:
+
+    :param level: the zlib compression level, from 1 (fastest) to 9.
+    :type int:
+    """
+
+    def __init__(self, stats, thresholds=None, default_threshold=None,
+                 level=6):
+        self.stats = stats
+        self.thresholds = thresholds or {}
+        self.default_threshold = default_threshold
+        self.level = level
+
+        self.stats.gauge("compress.ratio", self.ratio)
+
+    def threshold(self, msg_type):
+        """
+        Returns the size from which bodies of the given message type
+        are compressed, or None if they never are.
+
+        :param msg_type: the ``type`` field of a message body.
+        """
+        return self.thresholds.get(msg_type, self.default_threshold)
+
+    def compress(self, msg_type, body):
+        """
+        Returns the body to send and whether it is compressed.
+
+        :param msg_type: the ``type`` field of the message body.
+
+        :param body: the serialized body.
+        :type string:
+        """
+        threshold = self.threshold(msg_type)
+        if threshold is None or len(body) < threshold:
+            return body, False
+
+        start = time.time()
+        compressed = zlib.compress(body, self.level)
+        self.stats.incr("compress.time_us",
+                        int((time.time() - start) * 1000000))
+
+        if len(compressed) >= len(body):
+            self.stats.incr("compress.incompressible")
+            return body, False
+
+        self.stats.incr("compress.messages")
+        self.stats.incr("compress.bytes_in", len(body))
+        self.stats.incr("compress.bytes_out", len(compressed))
+        return compressed, True
+
+    def ratio(self):
+        """
+        Returns the size of the compressed bodies relative to their
+        original size, or 1.0 before anything was compressed.
+        """
+        bytes_in = self.stats.counters.get("compress.bytes_in", 0)
+        if not bytes_in:
+            return 1.0
+        return round(float(self.stats.counters["compress.bytes_out"]) /
+                     bytes_in, 3)
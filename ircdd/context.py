@@ -1,4 +1,5 @@
 from time import ctime
+import nsq
 import yaml
 
 from twisted import copyright
@@ -7,7 +8,23 @@ from twisted.cred import portal
 from ircdd.realm import ShardedRealm
 from ircdd import cred
 from ircdd.remote import RemoteReadWriter
+from ircdd.broker import LocalReadWriter, defaultBroker
+from ircdd.mesh import MeshTransport
+from ircdd.interest import InterestMap
+from ircdd.flow import FlowController
+from ircdd.stats import Stats
+from ircdd.compression import Compressor
+from ircdd.dedup import Deduplicator
+from ircdd.lanes import LaneTransport
+from ircdd.reorder import ReorderBuffer
+from ircdd.envelope import Sequencer
+from ircdd.wheel import TimingWheel
+from ircdd.throttle import FloodControl
+from ircdd.handles import RemoteUserCache
+from ircdd.output import OutputScheduler
+from ircdd.routes import RoutingTable
 from ircdd import database
+from ircdd import nsqclient
 
 
 class ConfigStore(dict):
@@ -51,6 +68,18 @@ def makeContext(config):
               and config.get(option) != config.defaults.get(option)):
             ctx[option] = config.get(option)
 
+    ctx['stats'] = Stats()
+    ctx['interest'] = InterestMap(ctx['hostname'])
+    ctx['remote_users'] = RemoteUserCache(
+        ctx['stats'],
+        max_size=int(ctx.get('remote_user_cache_size', 10000)),
+        ttl=float(ctx.get('remote_user_ttl', 5.0)))
+    if ctx.get('routing_table', True):
+        ctx['routes'] = RoutingTable(
+            ctx['stats'],
+            max_age=float(ctx.get('routes_max_age', 30.0)))
+        ctx['routes'].removed = ctx['remote_users'].invalidate
+
     ctx['realm'] = ShardedRealm(ctx, ctx['hostname'])
 
     cred_checker = cred.DatabaseCredentialsChecker(ctx)
@@ -66,8 +95,150 @@ def makeContext(config):
         creationDate=ctime()
         )
 
-    ctx['remote_rw'] = RemoteReadWriter(ctx['nsqd_tcp_address'],
-                                        ctx['lookupd_http_address'],
-                                        ctx['hostname'])
+    ctx['flow'] = FlowController(
+        int(ctx.get('max_in_flight', 2500)),
+        ctx['stats'],
+        interval=float(ctx.get('flow_interval', 1.0)),
+        lag_threshold=float(ctx.get('flow_lag_threshold', 0.05)),
+        latency_threshold=float(ctx.get('flow_latency_threshold', 0.01)),
+        pressure_high=int(ctx.get('flow_pressure_high', 16 * 1024 * 1024)))
+
+    ctx['compressor'] = Compressor(
+        ctx['stats'],
+        thresholds=ctx.get('compress_thresholds'),
+        default_threshold=ctx.get('compress_threshold'),
+        level=int(ctx.get('compress_level', 6)))
+
+    ctx['dedup'] = Deduplicator(
+        ctx['stats'],
+        window=float(ctx.get('dedup_window', 120.0)),
+        max_entries=int(ctx.get('dedup_max_entries', 200000)))
+
+    ctx['reorder'] = ReorderBuffer(
+        ctx['stats'],
+        timeout=float(ctx.get('reorder_timeout', 0.5)),
+        max_pending=int(ctx.get('reorder_max_pending', 100)),
+        max_streams=int(ctx.get('reorder_max_streams', 10000)))
+
+    ctx['sequencer'] = Sequencer(
+        max_targets=int(ctx.get('sequence_max_targets', 10000)))
+
+    if ctx.get('flood_control'):
+        ctx['flood'] = FloodControl(
+            ctx['stats'],
+            rate=float(ctx.get('flood_rate', 1.0)),
+            burst=float(ctx.get('flood_burst', 10.0)),
+            costs=ctx.get('flood_costs'),
+            max_queued=int(ctx.get('flood_max_queued', 100)),
+            global_caps=ctx.get('flood_global_caps'))
+
+    ctx['output'] = OutputScheduler(
+        max_delay=float(ctx.get('output_max_delay', 0.0)))
+
+    ctx['heartbeat_interval'] = float(ctx.get('heartbeat_interval', 10.0))
+    ctx['wheel'] = TimingWheel(
+        ctx['stats'],
+        tick=float(ctx.get('wheel_tick', 0.1)),
+        slots=int(ctx.get('wheel_slots', 64)))
+
+    ctx['node_transport'] = makeTransport(ctx)
+    if ctx.get('priority_lanes'):
+        ctx['remote_rw'] = LaneTransport(ctx['node_transport'], ctx['stats'])
+    else:
+        ctx['remote_rw'] = ctx['node_transport']
 
     return ctx
+
+
+def makeTransport(ctx):
+    """
+    Returns the transport between server nodes selected by the
+    ``transport`` option: ``nsq`` (the default) for a
+    :class:`ircdd.remote.RemoteReadWriter`, ``mesh`` for a
+    :class:`ircdd.mesh.MeshTransport` which falls back to ``NSQ`` if
+    ``NSQD`` addresses are configured, or ``local`` for a
+    :class:`ircdd.broker.LocalReadWriter` on the process-wide
+    in-process broker.
+    """
+    transport = ctx.get('transport') or 'nsq'
+
+    if transport == 'local':
+        return LocalReadWriter(
+            ctx.get('broker') or defaultBroker(),
+            ctx['hostname'],
+            stats=ctx['stats'],
+            reader_grace=float(ctx.get('reader_grace', 30.0)),
+            flow=ctx['flow'],
+            compressor=ctx['compressor'],
+            dedup=ctx['dedup'],
+            reorder=ctx['reorder'],
+            sequencer=ctx['sequencer'])
+
+    if transport == 'mesh':
+        fallback = None
+        if ctx.get('nsqd_tcp_address'):
+            fallback = _makeRemoteReadWriter(ctx)
+
+        return MeshTransport(
+            ctx['hostname'],
+            ctx['db'],
+            ctx.get('mesh_host') or ctx['hostname'],
+            int(ctx.get('mesh_port', 5800)),
+            stats=ctx['stats'],
+            fallback=fallback,
+            reader_grace=float(ctx.get('reader_grace', 30.0)),
+            queue_limit=int(ctx.get('mesh_queue_limit', 4 * 1024 * 1024)),
+            discovery_interval=float(ctx.get('mesh_discovery_interval',
+                                             10.0)),
+            flow=ctx['flow'],
+            compressor=ctx['compressor'],
+            reorder=ctx['reorder'],
+            sequencer=ctx['sequencer'])
+
+    if transport != 'nsq':
+        raise ValueError("Unknown transport: %s" % transport)
+
+    return _makeRemoteReadWriter(ctx)
+
+
+def _nsqClient(ctx):
+    """
+    Returns the ``NSQ`` client module selected by the ``nsq_client``
+    option: ``pynsq`` (the default), which runs on tornado's IOLoop
+    bridged into the reactor, or ``native`` for
+    :mod:`ircdd.nsqclient`.
+    """
+    if ctx.get('nsq_client') == 'native':
+        return nsqclient
+
+    from tornado.ioloop import IOLoop
+    from tornado.platform.twisted import TwistedIOLoop
+    if not IOLoop.initialized():
+        TwistedIOLoop().install()
+    return nsq
+
+
+def _makeRemoteReadWriter(ctx):
+    return RemoteReadWriter(
+        ctx['nsqd_tcp_address'],
+        ctx['lookupd_http_address'],
+        ctx['hostname'],
+        stats=ctx['stats'],
+        reader_grace=float(ctx.get('reader_grace', 30.0)),
+        cleanup_interval=float(ctx.get('channel_cleanup_interval', 60.0)),
+        flow=ctx['flow'],
+        queue_options=dict(
+            memory_limit=int(ctx.get('queue_memory_limit', 8 * 1024 * 1024)),
+            spool_path=ctx.get('spool_path'),
+            spool_limit=int(ctx.get('spool_limit', 1024 * 1024 * 1024))),
+        pool_options=dict(
+            max_failures=int(ctx.get('pool_max_failures', 3)),
+            max_error_rate=float(ctx.get('pool_max_error_rate', 0.5)),
+            latency_factor=float(ctx.get('pool_latency_factor', 3.0)),
+            probe_interval=float(ctx.get('pool_probe_interval', 5.0))),
+        client=_nsqClient(ctx),
+        compressor=ctx['compressor'],
+        dedup=ctx['dedup'],
+        reorder=ctx['reorder'],
+        ephemeral_types=ctx.get('nsq_ephemeral_types', ['privmsg']),
+        sequencer=ctx['sequencer'])
@@ -19,6 +19,7 @@ class IRCDDatabase:
     GROUPS_TABLE = 'groups'
     USER_SESSIONS_TABLE = 'user_sessions'
     GROUP_STATES_TABLE = 'group_states'
+    NODES_TABLE = 'nodes'
 
     def __init__(self, db="ircdd", host="127.0.0.1", port=28015):
         """
@@ -64,14 +65,18 @@ class IRCDDatabase:
         else:
             log.err("User already exists: %s" % nickname)
 
-    def heartbeatUserSession(self, nickname):
+    def heartbeatUserSession(self, nickname, node=None):
         """
-        Updates the ``last_heartbeat`` field of this user's session.
+        Updates the ``last_heartbeat`` field of this user's session,
+        along with the server node to which the user is connected.
         If the session does not exist it creates it.
 
         :param nickname: the nickname of the user whose session will
             be updated.
 
+        :param node: the name of the server node to which the user
+            is connected.
+
         Returns:
             Dict of the user session.
         """
@@ -82,12 +87,14 @@ class IRCDDatabase:
         if not session:
             return r.table(self.USER_SESSIONS_TABLE).insert({
                 "id": nickname,
+                "node": node,
                 "last_heartbeat": r.now(),
                 "last_message": r.now(),
                 "session_start": r.now()
             }).run(self.conn)
         else:
             return r.table(self.USER_SESSIONS_TABLE).get(nickname).update({
+                "node": node,
                 "last_heartbeat": r.now()
             }).run(self.conn)
 
@@ -102,6 +109,62 @@ class IRCDDatabase:
             nickname
         ).delete().run(self.conn)
 
+    def heartbeatNode(self, name, host, port):
+        """
+        Updates the ``last_heartbeat`` field of a server node's
+        registration, along with the address on which it accepts
+        connections from other nodes. If the registration does not
+        exist it creates it.
+
+        :param name: the name of the server node.
+
+        :param host: the host on which the node accepts connections.
+
+        :param port: the port on which the node accepts connections.
+        """
+        node = r.table(self.NODES_TABLE).get(
+            name
+        ).run(self.conn)
+
+        if not node:
+            return r.table(self.NODES_TABLE).insert({
+                "id": name,
+                "host": host,
+                "port": port,
+                "last_heartbeat": r.now()
+            }).run(self.conn)
+        else:
+            return r.table(self.NODES_TABLE).get(name).update({
+                "host": host,
+                "port": port,
+                "last_heartbeat": r.now()
+            }).run(self.conn)
+
+    def removeNode(self, name):
+        """
+        Removes a server node's registration.
+
+        :param name: the name of the server node.
+        """
+        return r.table(self.NODES_TABLE).get(
+            name
+        ).delete().run(self.conn)
+
+    def listNodes(self):
+        """
+        Returns the server nodes whose ``last_heartbeat``
+        was within the past 30 seconds.
+
+        Returns:
+            A list of dicts with the ``id``, ``host`` and ``port``
+            of each node.
+        """
+        return list(r.table(self.NODES_TABLE).filter(
+            lambda node: r.now()
+                          .sub(node["last_heartbeat"])
+                          .lt(30).default(False)
+        ).pluck("id", "host", "port").run(self.conn))
+
     def removeUserFromGroup(self, nickname, group):
         """
         Removes a user's subscription from a group.
@@ -115,15 +178,21 @@ class IRCDDatabase:
             r.row.without({"users": {nickname: True}})
         ).run(self.conn)
 
-    def heartbeatUserInGroup(self, nickname, group):
+    def heartbeatUserInGroup(self, nickname, group, node=None):
         """
         Updates a user's subscription to a group. If the subscription
         does not exist it is created. If the group state entry for the
         group does not exist, it is created.
+        The subscription records the node on which the user's session
+        lives, so the group state doubles as the registry of the nodes
+        that are interested in the group's messages.
 
         :param nickname: the nickname of the user to subscribe.
 
         :param group: the name of the group to subscribe to.
+
+        :param node: the name of the server instance to which the
+            user is connected.
         """
         presence = r.table(self.GROUP_STATES_TABLE).get(
             group
@@ -134,7 +203,8 @@ class IRCDDatabase:
                 "id": group,
                 "users": {
                     nickname: {
-                        "heartbeat": r.now()
+                        "heartbeat": r.now(),
+                        "node": node
                     }
                 }
             }).run(self.conn)
@@ -142,7 +212,8 @@ class IRCDDatabase:
             return r.table(self.GROUP_STATES_TABLE).get(group).update({
                 "users": r.row["users"].merge({
                     nickname: {
-                        "heartbeat": r.now()
+                        "heartbeat": r.now(),
+                        "node": node
                     }
                 })
             }).run(self.conn)
@@ -157,25 +228,53 @@ class IRCDDatabase:
             observe.
 
         Returns:
-            A changefeed that returns changes for the given group.
+            A changefeed that returns changes for the given group. The
+            ``users`` field of each change maps the active users to
+            the nodes to which they are connected.
         """
         conn = r.connect(db=self.db,
                          host=self.rdb_host,
                          port=self.rdb_port)
 
+        def activeUsers(state):
+            return state["users"].keys().filter(
+                lambda user: r.now()
+                              .sub(state["users"][user]["heartbeat"])
+                              .lt(30)
+                              .default(False)
+            ).map(
+                lambda user: [user,
+                              state["users"][user]["node"].default(None)]
+            ).coerce_to("object")
+
         return r.table(self.GROUP_STATES_TABLE).changes().filter(
             r.row["old_val"]["id"] == group or r.row["new_val"]["id"] == group
         )["new_val"].merge(
             lambda state: {
-                "users": state["users"].keys().filter(
-                    lambda user: r.now()
-                                  .sub(state["users"][user]["heartbeat"])
-                                  .lt(30)
-                                  .default(False)
-                )
+                "users": r.literal(activeUsers(state))
             }
         ).run(conn)
 
+    def observeUserSessions(self):
+        """
+        Creates a changefeed that watches the user sessions, starting
+        with the current ones. The changefeed lives on its own
+        dedicated connection to ``RDB``.
+
+        Returns:
+            A changefeed which first yields a change with only a
+            ``new_val`` for each existing session, then a change for
+            every heartbeat, login and logout. Sessions carry only their
+            ``id``, ``node`` and ``last_heartbeat`` fields.
+        """
+        conn = r.connect(db=self.db,
+                         host=self.rdb_host,
+                         port=self.rdb_port)
+
+        return r.table(self.USER_SESSIONS_TABLE).pluck(
+            "id", "node", "last_heartbeat"
+        ).changes(include_initial=True).run(conn)
+
     def observeGroupMeta(self, group):
         """
         Creates a changefeed that watches changes to the group's metadata.
@@ -0,0 +1,79 @@
+"""
+This module contains the structure which remembers the IDs of
+recently handled messages so that redelivered copies are dropped.
+"""
+
+from twisted.internet import reactor
+
+
+class Deduplicator(object):
+    """
+    A time-bounded set of message IDs, kept as two generations which
+    rotate every half ``window``: an ID is remembered for between half
+    a window and a whole window after it was added. When the current
+    generation reaches half of ``max_entries`` it is rotated early, so
+    memory stays bounded whatever the message rate, at the cost of a
+    shorter window.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the dedup counters and gauges.
+
+    :param window: the number of seconds for which IDs are remembered.
+    :type float:
+
+    :param max_entries: the maximum number of IDs remembered.
+    :type int:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    def __init__(self, stats, window=120.0, max_entries=200000, clock=None):
+        self.stats = stats
+        self.window = window
+        self.max_entries = max_entries
+        self._clock = clock or reactor
+
+        self._current = set()
+        self._previous = set()
+        self._rotated = self._clock.seconds()
+
+        self.stats.gauge("dedup.entries",
+                         lambda: len(self._current) + len(self._previous))
+
+    def _rotate(self):
+        now = self._clock.seconds()
+        if now - self._rotated >= self.window:
+            self._previous = set()
+        else:
+            self._previous = self._current
+        self._current = set()
+        self._rotated = now
+
+    def seen(self, id):
+        """
+        Returns True if the ID was added within the window, counting
+        the message as a duplicate.
+
+        :param id: the ID of a message.
+        """
+        self.stats.incr("dedup.checked")
+
+        if self._clock.seconds() - self._rotated >= self.window / 2:
+            self._rotate()
+
+        if id in self._current or id in self._previous:
+            self.stats.incr("dedup.duplicates")
+            return True
+        return False
+
+    def add(self, id):
+        """
+        Remembers the ID of a handled message.
+
+        :param id: the ID of a message.
+        """
+        if len(self._current) >= self.max_entries // 2:
+            self.stats.incr("dedup.early_rotations")
+            self._rotate()
+        self._current.add(id)
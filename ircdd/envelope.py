@@ -0,0 +1,212 @@
+"""
+This module contains the envelope in which messages are wrapped
+before being published to the cluster.
+
+Every envelope starts with a fixed-size binary header that carries
+the origin, type and target of the message, followed by the ``json``
+encoded body. Consumers can inspect the header to discard messages
+that they are not interested in without decoding the body.
+The body may be compressed, which is flagged in the high bit of
+the type code. Each message carries a sequence number which counts
+the messages published by its transport for its target, so consumers
+can deliver them in order.
+"""
+
+import json
+import struct
+import hashlib
+import time
+import uuid
+import zlib
+from collections import OrderedDict, namedtuple
+from itertools import count
+
+
+VERSION = 1
+
+# version, message type, origin digest, target digest
+HEADER = struct.Struct("!BB8s8s")
+
+UNKNOWN_TYPE = 0
+
+# Set in the type code when the body is compressed with zlib
+COMPRESSED = 0x80
+
+TYPES = {
+    "privmsg": 1,
+    "join": 2,
+    "part": 3,
+}
+
+Header = namedtuple("Header", ["version", "msg_type", "origin", "target",
+                               "compressed"])
+
+
+def digest(name):
+    """
+    Returns the fixed-size digest under which a server, user or
+    group name is carried in the envelope header.
+
+    :param name: the name to digest.
+    :type string:
+    """
+    if isinstance(name, unicode):
+        name = name.encode("utf8")
+
+    return hashlib.md5(name).digest()[:8]
+
+
+# Message IDs are unique across servers and restarts
+_id_prefix = uuid.uuid4().hex[:12]
+_id_counter = count(1)
+
+
+def message_id():
+    """
+    Returns a new unique message ID.
+    """
+    return "%s-%x" % (_id_prefix, next(_id_counter))
+
+
+class Sequencer(object):
+    """
+    Numbers the messages that a transport publishes for each target.
+
+    The counter of each target belongs to a stream, which is named
+    after the sequencer and the creation of the counter: the counters
+    of different transports, even in the same process, and a counter
+    created again after it was dropped start new streams rather than
+    going back in existing ones. At most ``max_targets`` counters are
+    kept; the least recently used one is dropped to make room for a new
+    one.
+
+    :param max_targets: the number of counters kept.
+    :type int:
+    """
+
+    def __init__(self, max_targets=10000):
+        self.max_targets = max_targets
+
+        self._prefix = uuid.uuid4().hex[:12]
+        self._epochs = count(1)
+        self._counters = OrderedDict()
+
+    def advance(self, target):
+        """
+        Returns the ``(stream, seq)`` pair of the next message for the
+        target.
+
+        :param target: the name of the user or group.
+        :type string:
+        """
+        counter = self._counters.pop(target, None)
+        if counter is None:
+            if len(self._counters) >= self.max_targets:
+                self._counters.popitem(last=False)
+            counter = ["%s-%x" % (self._prefix, next(self._epochs)), 0]
+
+        counter[1] += 1
+        self._counters[target] = counter
+        return counter[0], counter[1]
+
+    def rewind(self, target):
+        """
+        Takes back the sequence number of the last message packed for
+        the target, which was discarded instead of being published.
+
+        :param target: the name of the user or group.
+        :type string:
+        """
+        counter = self._counters.get(target)
+        if counter is not None:
+            counter[1] -= 1
+
+
+def stream(parsed_msg):
+    """
+    Returns the stream that a decoded message is sequenced in: its
+    origin server and the ``epoch`` of the counter which numbered it.
+
+    :param parsed_msg: the decoded body of an envelope.
+    :type dict:
+    """
+    return parsed_msg["origin"], parsed_msg.get("epoch")
+
+
+def type_code(msg_type):
+    """
+    Returns the header code for the given message type.
+
+    :param msg_type: the ``type`` field of a message body.
+    :type string:
+    """
+    return TYPES.get(msg_type, UNKNOWN_TYPE)
+
+
+def pack(origin, target, msg_body, compressor=None, sequencer=None):
+    """
+    Wraps the message body in an envelope and returns the
+    serialized envelope.
+
+    :param origin: the name of the server publishing the message.
+    :type string:
+
+    :param target: the name of the user or group the message is for.
+    :type string:
+
+    :param msg_body: the message to wrap.
+    :type dict:
+
+    :param compressor: an optional :class:`ircdd.compression.Compressor`
+        which decides whether to compress the body.
+
+    :param sequencer: an optional :class:`Sequencer` which numbers the
+        message; messages without a number are not reordered.
+    """
+    msg_type = msg_body.get("type")
+    code = type_code(msg_type)
+    fields = dict(msg_body=msg_body, origin=origin, id=message_id(),
+                  ts=time.time())
+    if sequencer is not None:
+        fields["epoch"], fields["seq"] = sequencer.advance(target)
+    body = json.dumps(fields)
+
+    if compressor is not None:
+        body, compressed = compressor.compress(msg_type, body)
+        if compressed:
+            code |= COMPRESSED
+
+    header = HEADER.pack(VERSION, code, digest(origin), digest(target))
+
+    return header + body
+
+
+def unpack_header(data):
+    """
+    Returns the :class:`Header` of a serialized envelope, or ``None``
+    if the data does not start with a header (i.e. it was published by
+    a server that sends plain ``json``).
+
+    :param data: the serialized envelope.
+    :type string:
+    """
+    if len(data) < HEADER.size or ord(data[0]) != VERSION:
+        return None
+
+    version, code, origin, target = HEADER.unpack_from(data)
+    return Header(version, code & ~COMPRESSED, origin, target,
+                  bool(code & COMPRESSED))
+
+
+def unpack_body(data):
+    """
+    Decodes and returns the body of a serialized envelope,
+    decompressing it first if needed.
+
+    :param data: the serialized envelope.
+    :type string:
+    """
+    body = data[HEADER.size:]
+    if ord(data[1]) & COMPRESSED:
+        body = zlib.decompress(body)
+    return json.loads(body)
@@ -0,0 +1,212 @@
+"""
+This module contains the flow controller which adapts the number
+of messages that the readers pull from the cluster to the load of
+the local node.
+"""
+
+from twisted.internet import reactor
+
+
+class FlowController(object):
+    """
+    Shares a node-wide budget of in-flight messages between all
+    :class:`nsq.Reader` instances and throttles consumption when the
+    node falls behind.
+
+    Each reader's share of the budget is proportional to the rate at
+    which it receives messages. The budget itself shrinks while the
+    event loop lags or the message handlers slow down and grows back
+    once the node catches up. When the clients' outbound buffers grow
+    past ``pressure_high`` bytes every reader is paused (sent RDY 0)
+    until they drain to half of that.
+
+    :param budget: the maximum number of messages in flight across
+        all readers.
+    :type int:
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the flow counters and gauges.
+
+    :param interval: the number of seconds between adjustments.
+    :type float:
+
+    :param lag_threshold: the event loop lag, in seconds, past which
+        consumption is slowed down.
+    :type float:
+
+    :param latency_threshold: the mean handler latency, in seconds,
+        past which consumption is slowed down.
+    :type float:
+
+    :param pressure_high: the number of bytes buffered for clients
+        past which consumption is paused.
+    :type int:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    ALPHA = 0.5
+    MIN_SCALE = 0.05
+    RECOVERY = 0.1
+
+    def __init__(self, budget, stats, interval=1.0, lag_threshold=0.05,
+                 latency_threshold=0.01, pressure_high=16 * 1024 * 1024,
+                 clock=None):
+        self.budget = budget
+        self.stats = stats
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.latency_threshold = latency_threshold
+        self.pressure_high = pressure_high
+        self._clock = clock or reactor
+
+        # A callable returning the number of bytes buffered for clients.
+        self.pressure = None
+
+        self.scale = 1.0
+        self.paused = False
+        self.lag = 0.0
+
+        self._readers = {}
+        self._rates = {}
+        self._counts = {}
+        self._busy = {}
+        self._last = None
+
+        self.stats.gauge("flow.budget", self.effectiveBudget)
+        self.stats.gauge("flow.lag_ms", lambda: int(self.lag * 1000))
+        self.stats.gauge("flow.paused", lambda: int(self.paused))
+
+    def effectiveBudget(self):
+        """
+        Returns the number of messages that may currently be in
+        flight across all readers.
+        """
+        return max(len(self._readers), int(self.budget * self.scale))
+
+    def share(self):
+        """
+        Returns the in-flight limit with which a new reader should
+        start, before its traffic is known.
+        """
+        return max(1, self.effectiveBudget() // (len(self._readers) + 1))
+
+    def register(self, topic, reader):
+        """
+        Places the reader of the given topic under flow control.
+
+        :param topic: the topic consumed by the reader.
+
+        :param reader: the :class:`nsq.Reader` to control.
+        """
+        self._readers[topic] = reader
+        self._rates[topic] = 0.0
+        self._counts[topic] = 0
+        self._busy[topic] = 0.0
+
+        # Keeps the reader from raising its RDY count while paused.
+        reader.disabled = lambda: self.paused
+
+    def unregister(self, topic):
+        """
+        Releases the reader of the given topic from flow control.
+
+        :param topic: the topic consumed by the reader.
+        """
+        for table in (self._readers, self._rates, self._counts, self._busy):
+            table.pop(topic, None)
+
+    def wrap(self, topic, handler):
+        """
+        Wraps a message handler so that the messages it handles and
+        the time it spends handling them are accounted to the topic.
+
+        :param topic: the topic consumed by the handler.
+
+        :param handler: the message handler to wrap.
+        :type callable:
+        """
+        def measured(message):
+            start = self._clock.seconds()
+            try:
+                return handler(message)
+            finally:
+                if topic in self._counts:
+                    self._counts[topic] += 1
+                    self._busy[topic] += self._clock.seconds() - start
+
+        return measured
+
+    def adjust(self):
+        """
+        Samples the load of the node and redistributes the in-flight
+        budget between the readers. Meant to be called every
+        ``interval`` seconds.
+        """
+        now = self._clock.seconds()
+        if self._last is None:
+            self._last = now
+            return
+        elapsed = max(now - self._last, 1e-6)
+        self._last = now
+        self.lag = max(0.0, elapsed - self.interval)
+
+        count = sum(self._counts.itervalues())
+        busy = sum(self._busy.itervalues())
+        latency = busy / count if count else 0.0
+
+        pressure = self.pressure() if self.pressure else 0
+        if pressure > self.pressure_high:
+            if not self.paused:
+                self.stats.incr("flow.pauses")
+            self.paused = True
+        elif pressure <= self.pressure_high / 2:
+            self.paused = False
+
+        if (self.lag > self.lag_threshold or
+                latency > self.latency_threshold or self.paused):
+            self.scale = max(self.MIN_SCALE, self.scale / 2)
+            self.stats.incr("flow.throttles")
+        else:
+            self.scale = min(1.0, self.scale + self.RECOVERY)
+
+        for topic in self._readers:
+            rate = self._counts[topic] / elapsed
+            self._rates[topic] = (self.ALPHA * rate +
+                                  (1 - self.ALPHA) * self._rates[topic])
+            self._counts[topic] = 0
+            self._busy[topic] = 0.0
+
+        self._distribute()
+
+    def _distribute(self):
+        """
+        Splits the effective budget between the readers in proportion
+        to their message rates and applies the resulting limits.
+        """
+        budget = self.effectiveBudget()
+        weights = dict((topic, rate + 1.0)
+                       for topic, rate in self._rates.iteritems())
+        total = sum(weights.itervalues())
+
+        for topic, reader in self._readers.iteritems():
+            limit = max(1, int(budget * weights[topic] / total))
+            self._apply(reader, limit)
+
+    def _apply(self, reader, limit):
+        """
+        Sets the reader's in-flight limit and updates the RDY count of
+        each of its connections accordingly; paused readers get RDY 0.
+        pynsq refuses to lower RDY counts through its own bookkeeping,
+        so the connections are updated directly.
+        """
+        reader.max_in_flight = limit
+        conns = getattr(reader, "conns", {})
+        per_conn = 0 if self.paused else max(1, limit // max(1, len(conns)))
+
+        for conn in conns.itervalues():
+            rdy = min(per_conn, getattr(conn, "max_rdy_count", per_conn))
+            previous = conn.rdy
+            if previous != rdy and conn.send_rdy(rdy):
+                reader.total_rdy = max(reader.total_rdy - previous + rdy, 0)
@@ -4,12 +4,16 @@ from twisted.words import iwords
 from twisted.internet import defer, reactor, threads
 from twisted.python import failure, log
 
+from ircdd import wire
+
 
 class ShardedGroup(object):
     """
     A group which may exist in a sharded state on different
-    servers. It subscribes to its own topic on the message queue
-    and sends/receives remote messages.
+    servers. While it has local sessions it subscribes to its own
+    topic on the message queue and sends/receives remote messages.
+    Once its last local session is removed, ``idle`` is called with
+    the group; :meth:`close` tears the shard down.
 
     :param ctx: an initialized context object that will be used for
         ``RDB`` and ``NSQ`` access.
@@ -26,7 +30,12 @@ class ShardedGroup(object):
         self.meta = {"topic": "", "topic_author": ""}
 
         self.ctx = ctx
-        self.ctx.remote_rw.subscribe(self.name, self.receiveRemote)
+
+        # A callable taking the group, called once it has no local
+        # sessions left.
+        self.idle = None
+        self.closed = False
+        self._changesets = []
 
         self.getMeta()
         self.getState()
@@ -55,11 +64,41 @@ class ShardedGroup(object):
     def getState(self):
         """
         Gets the groups state from `RDB` and
-        populates the local shard with it.
+        populates the local shard with it. The users are
+        mapped to the nodes to which they are connected.
         """
         state = self.ctx.db.getGroupState(self.name)
         if state:
-            self.users = state["users"]
+            self.users = dict((user, presence.get("node"))
+                              for user, presence in state["users"].iteritems())
+
+    def _watch(self, changeset):
+        """
+        Keeps track of a changeset so that its connection is closed
+        when the group is torn down, or else on shutdown.
+        """
+        if self.closed:
+            changeset.conn.close(False)
+            return
+
+        trigger = reactor.addSystemEventTrigger("before", "shutdown",
+                                                changeset.conn.close,
+                                                False)
+        self._changesets.append((changeset, trigger))
+
+    def _follow(self, changeset, handle):
+        """
+        Hands each change of the changeset to the reactor thread
+        until the changeset's connection is closed.
+        """
+        reactor.callFromThread(self._watch, changeset)
+
+        try:
+            for change in changeset:
+                reactor.callFromThread(handle, change)
+        except Exception:
+            if not self.closed:
+                raise
 
     def _observeState(self):
         """
@@ -69,18 +108,12 @@ class ShardedGroup(object):
         SIGINT, a callback forcefully closes the
         changeset's connection.
         """
-        changeset = self.ctx.db.observeGroupState(self.name)
-
-        reactor.addSystemEventTrigger("before", "shutdown",
-                                      changeset.conn.close,
-                                      False)
+        def updateUserList(change):
+            if not self.closed:
+                self.users = change["users"]
 
-        def updateUserList(users):
-            self.users = users
-
-        for change in changeset:
-            reactor.callFromThread(updateUserList,
-                                   change["users"])
+        self._follow(self.ctx.db.observeGroupState(self.name),
+                     updateUserList)
 
     def _observeMeta(self):
         """
@@ -89,28 +122,47 @@ class ShardedGroup(object):
         In order to join with the reactor thread on SIGINT
         a callback forcefully closes the changeset's connection.
         """
-        changeset = self.ctx.db.observeGroupMeta(self.name)
+        def updateMeta(change):
+            if change.get("new_val") and not self.closed:
+                self.updateMeta(change["new_val"]["meta"])
 
-        reactor.addSystemEventTrigger("before", "shutdown",
-                                      changeset.conn.close,
-                                      False)
+        self._follow(self.ctx.db.observeGroupMeta(self.name), updateMeta)
 
-        for change in changeset:
-            if change.get("new_val"):
-                reactor.callFromThread(self.updateMeta,
-                                       change["new_val"]["meta"])
+    def close(self):
+        """
+        Tears down the shard of a group without local sessions: its
+        changefeeds are closed, ending their threads, and what is known
+        about the nodes interested in it is dropped. Its topic was
+        already released when the last local session was removed.
+        """
+        self.closed = True
+        self.idle = None
+
+        for changeset, trigger in self._changesets:
+            reactor.removeSystemEventTrigger(trigger)
+            changeset.conn.close(False)
+        self._changesets = []
+
+        self.ctx.interest.forget(self.name)
 
     def add(self, added_user):
         """
         Adds a user to this shard as a local session.
         Notifies all other active local users and posts a
         message on the group's topic to notify remote users.
+        The first local session subscribes the shard to the
+        group's topic.
         """
         assert iwords.IChatClient.providedBy(added_user), \
             "%r is not a chat client" % (added_user,)
 
         if added_user.name not in self.local_sessions:
+            if not self.local_sessions:
+                self.ctx.remote_rw.subscribe(self.name, self.receiveRemote)
+
             self.local_sessions[added_user.name] = added_user
+            self.ctx.interest.add(self.name, self.ctx.hostname,
+                                  added_user.name)
             self.notifyAdd(added_user.name, added_user.ctx.hostname)
             self.notifyShardsAdd(added_user.name)
 
@@ -118,7 +170,10 @@ class ShardedGroup(object):
 
     def remove(self, removed_user, reason=None):
         """
-        Remove a local user from the group.
+        Remove a local user from the group. Once the last local
+        session is removed, the shard releases the group's topic;
+        its channel is eventually deleted so that the group's messages
+        stop being delivered to this node.
         """
         assert reason is None or isinstance(reason, unicode)
 
@@ -128,14 +183,23 @@ class ShardedGroup(object):
             log.err("Removing user %s failed: user does not exist" %
                     removed_user.name)
         else:
+            self.ctx.interest.remove(self.name, self.ctx.hostname,
+                                     removed_user.name)
             self.notifyRemove(removed_user.name, reason)
             self.notifyShardsRemove(removed_user.name, reason)
+
+            if not self.local_sessions:
+                self.ctx.remote_rw.release(self.name, delete_channel=True)
+                if self.idle is not None:
+                    self.idle(self)
         return defer.succeed(None)
 
     def receiveRemote(self, message):
         """
         Callback which is executed when the Reader for this group's
-        topic receives a message.
+        topic receives a message. The messages of each origin arrive in
+        the order in which they were published (see
+        :mod:`ircdd.reorder`).
 
         :param message: A :class:`nsq.Message` which contains
             the IRC message and metadata in its parsed_body.
@@ -148,9 +212,15 @@ class ShardedGroup(object):
                          self,
                          msg_body)
         elif msg_type == "join":
+            self.ctx.interest.add(self.name,
+                                  message.parsed_msg["origin"],
+                                  msg_body["sender"]["name"])
             self.notifyAdd(msg_body["sender"]["name"],
                            msg_body["sender"]["hostname"])
         elif msg_type == "part":
+            self.ctx.interest.remove(self.name,
+                                     message.parsed_msg["origin"],
+                                     msg_body["sender"]["name"])
             self.notifyRemove(msg_body["sender"]["name"],
                               msg_body["reason"])
 
@@ -169,17 +239,66 @@ class ShardedGroup(object):
 
         assert recipient is self
 
+        lines = wire.message_lines(message, "#" + self.name)
+
+        rendered = {}
         recipients = []
+        failed = []
+
+        for recipient in self.local_sessions.values():
+            if recipient.name == sender_name:
+                continue
 
-        for recipient in self.local_sessions.itervalues():
-            if recipient.name != sender_name:
+            if not hasattr(recipient, "sendRendered"):
                 d = defer.maybeDeferred(recipient.receive, sender_name,
                                         self, message)
                 d.addErrback(self._ebUserCall, p=recipient)
                 recipients.append(d)
-        defer.DeferredList(recipients).addCallback(self._cbUserCall)
+                continue
+
+            try:
+                fmt = recipient.wireFormat()
+                data = rendered.get(fmt)
+                if data is None:
+                    data = rendered[fmt] = wire.render(sender_name, fmt[0],
+                                                       lines, fmt[1])
+                recipient.sendRendered(data, droppable=True)
+            except Exception as e:
+                log.err(None, "Failed to deliver to %s" % recipient.name)
+                failed.append((recipient, e))
+
+        self.ctx.stats.incr("fanout.messages")
+        self.ctx.stats.incr("fanout.renders", len(rendered))
+
+        for recipient, e in failed:
+            self.ctx.stats.incr("fanout.errors")
+            self.remove(recipient, unicode(str(e), "utf-8", "replace"))
+
+        if recipients:
+            defer.DeferredList(recipients).addCallback(self._cbUserCall)
         return defer.succeed(None)
 
+    def hasRemoteMembers(self, exclude=None):
+        """
+        Returns True if any other node may have sessions in this
+        group, i.e. if messages for the group must be published.
+        Both the nodes which announced a `join` and the nodes
+        registered in the group state are taken into account. Users
+        registered without a node are assumed to be remote.
+
+        :param exclude: the name of a user to disregard, e.g. one
+            that is in the process of leaving.
+        """
+        if self.ctx.interest.remoteNodes(self.name):
+            return True
+
+        for user, node in self.users.iteritems():
+            if (user != exclude and user not in self.local_sessions and
+                    node != self.ctx.hostname):
+                return True
+
+        return False
+
     def iterusers(self):
         """
         Returns the list of users connected to this
@@ -231,10 +350,15 @@ class ShardedGroup(object):
         """
         Submits a `join` message on this group's topic,
         notifying remote shards of the event so that they
-        can in turn relay it to their users.
+        can in turn relay it to their users. Nothing is
+        submitted if no other node has members in the group.
 
         :param added_user_name: the name of the added user.
         """
+        if not self.hasRemoteMembers():
+            self.ctx.stats.incr("publish.skipped.join")
+            return
+
         message = {
             "type": "join",
             "sender": {
@@ -285,12 +409,17 @@ class ShardedGroup(object):
     def notifyShardsRemove(self, removed_user_name, reason="unknown reason"):
         """
         Publishes a `part` message to this group's topic in order to
-        notify other instances if the event.
+        notify other instances if the event. Nothing is published if
+        no other node has members in the group.
 
         :param removed_user_name: the name of the removed user.
 
         :param reason: the reason the user was removed.
         """
+        if not self.hasRemoteMembers(exclude=removed_user_name):
+            self.ctx.stats.incr("publish.skipped.part")
+            return
+
         message = {
             "type": "part",
             "sender": {
@@ -0,0 +1,135 @@
+"""
+This module contains the handles which stand in for users connected
+to other server nodes, and the cache which keeps them.
+"""
+
+from collections import OrderedDict
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.words import iwords
+
+
+class RemoteUser(object):
+    """
+    Stands in for a user connected to another server node, as the
+    recipient of the messages sent to them by local users. Those
+    messages are published on the user's topic by the sender and
+    delivered by the node the user is connected to, so the handle
+    neither subscribes to the topic nor maintains a session: it is
+    its own mind, and receiving a message does nothing.
+
+    :param name: the nickname of the user.
+    :type string:
+
+    :param node: the name of the server node to which the user is
+        connected, if known.
+    :type string:
+    """
+
+    implements(iwords.IUser)
+
+    realm = None
+
+    def __init__(self, name, node=None):
+        self.name = name
+        self.node = node
+        self.groups = []
+
+    @property
+    def mind(self):
+        return self
+
+    def receive(self, sender_name, recipient, message):
+        pass
+
+
+class RemoteUserCache(object):
+    """
+    The :class:`RemoteUser` handles of the users recently found
+    connected to other nodes, so that messaging them again does not
+    query their session. A handle is trusted for ``ttl`` seconds and
+    dropped as soon as the user is known to have logged out or to have
+    logged in locally. Local logins and logouts are known right away,
+    but a logout on another node only once the routing table reports
+    it: without the routing table, a handle stays in use until its
+    ``ttl`` expires, and the messages sent to the user until then are
+    lost without an error. At most ``max_size`` handles are kept; the
+    least recently used one is evicted to make room for a new one.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the cache counters and gauges.
+
+    :param max_size: the number of handles kept.
+    :type int:
+
+    :param ttl: the number of seconds for which a handle is trusted.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    def __init__(self, stats, max_size=10000, ttl=5.0, clock=None):
+        self.stats = stats
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock or reactor
+
+        self._handles = OrderedDict()
+
+        self.stats.gauge("remote_users.cached", lambda: len(self._handles))
+
+    def get(self, name):
+        """
+        Returns the handle of the user, or None if there is no handle
+        or it is no longer trusted.
+
+        :param name: the nickname of the user.
+        :type string:
+        """
+        entry = self._handles.pop(name, None)
+        if entry is None:
+            self.stats.incr("remote_users.misses")
+            return None
+
+        handle, expires = entry
+        if expires <= self._clock.seconds():
+            self.stats.incr("remote_users.expired")
+            return None
+
+        self._handles[name] = entry
+        self.stats.incr("remote_users.hits")
+        return handle
+
+    def add(self, name, node=None):
+        """
+        Creates, caches and returns the handle of a user found
+        connected to another node.
+
+        :param name: the nickname of the user.
+        :type string:
+
+        :param node: the name of the node, if known.
+        :type string:
+        """
+        self._handles.pop(name, None)
+        if len(self._handles) >= self.max_size:
+            self._handles.popitem(last=False)
+            self.stats.incr("remote_users.evicted")
+
+        handle = RemoteUser(name, node)
+        self._handles[name] = (handle, self._clock.seconds() + self.ttl)
+        return handle
+
+    def invalidate(self, name):
+        """
+        Drops the handle of the user, who logged out or logged in on
+        this node.
+
+        :param name: the nickname of the user.
+        :type string:
+        """
+        if self._handles.pop(name, None) is not None:
+            self.stats.incr("remote_users.invalidated")
@@ -0,0 +1,94 @@
+"""
+This module tracks which server nodes are interested in the
+messages published on each user and group topic.
+"""
+
+
+class InterestMap(object):
+    """
+    A map from topics to the nodes which have local sessions for
+    the user or group behind the topic, along with the names of
+    those sessions.
+    It is used to skip publishing messages that no other node
+    would deliver.
+
+    :param local_node: the name of this server instance.
+    :type string:
+    """
+
+    def __init__(self, local_node):
+        self.local_node = local_node
+        self._topics = {}
+
+    def add(self, topic, node, member):
+        """
+        Records that the given member has a session for the topic
+        on the given node.
+
+        :param topic: the name of the user or group.
+
+        :param node: the name of the node on which the session lives.
+
+        :param member: the name of the session's user.
+        """
+        nodes = self._topics.setdefault(topic, {})
+        nodes.setdefault(node, set()).add(member)
+
+    def remove(self, topic, node, member):
+        """
+        Removes the given member's session on the given node. The
+        node stops being interested in the topic once its last
+        session is removed.
+
+        :param topic: the name of the user or group.
+
+        :param node: the name of the node on which the session lives.
+
+        :param member: the name of the session's user.
+        """
+        nodes = self._topics.get(topic)
+        if not nodes or node not in nodes:
+            return
+
+        nodes[node].discard(member)
+        if not nodes[node]:
+            del nodes[node]
+        if not nodes:
+            del self._topics[topic]
+
+    def forget(self, topic):
+        """
+        Drops everything known about the topic.
+
+        :param topic: the name of the user or group.
+        """
+        self._topics.pop(topic, None)
+
+    def nodes(self, topic):
+        """
+        Returns the set of nodes interested in the topic.
+
+        :param topic: the name of the user or group.
+        """
+        return set(self._topics.get(topic, ()))
+
+    def remoteNodes(self, topic):
+        """
+        Returns the set of nodes other than this one that are
+        interested in the topic.
+
+        :param topic: the name of the user or group.
+        """
+        return self.nodes(topic) - set([self.local_node])
+
+    def isLocalOnly(self, topic):
+        """
+        Returns True if this node is the only one known to be
+        interested in the topic.
+
+        :param topic: the name of the user or group.
+        """
+        return self._topics.get(topic, {}).keys() == [self.local_node]
+
+    def __len__(self):
+        return len(self._topics)
@@ -0,0 +1,133 @@
+"""
+This module contains the transport which carries control messages
+(joins and parts) apart from chat messages, so that a busy group's
+chat never delays the membership updates of its shards.
+"""
+
+import time
+
+from zope.interface import implements
+
+from ircdd.transport import ITransport
+
+
+CHAT = "chat"
+CONTROL = "control"
+
+LANES = (CONTROL, CHAT)
+
+# Appended to the name of a user or group for its control topic
+CONTROL_SUFFIX = ".control"
+
+
+def lane(msg_type):
+    """
+    Returns the lane that messages of the given type travel in.
+
+    :param msg_type: the ``type`` field of a message body.
+    :type string:
+    """
+    return CHAT if msg_type == "privmsg" else CONTROL
+
+
+def lane_topic(topic, name):
+    """
+    Returns the topic which carries the given lane of a user or group.
+
+    :param topic: the name of the user or group.
+
+    :param name: the name of the lane.
+    :type string:
+    """
+    return topic + CONTROL_SUFFIX if name == CONTROL else topic
+
+
+class LaneTransport(object):
+    """
+    Wraps a transport so that the messages of each user or group are
+    published on one topic per lane. Each lane topic is consumed by
+    its own reader, with its own share of the in-flight budget, so
+    control messages are never queued behind chat. A subscription
+    only consumes the lanes of the message types it handles.
+
+    The latency of each lane, from publication until the message is
+    handed to the subscriber, is kept as a moving average. It is taken
+    from the wall clocks of two nodes, so it is only as accurate as
+    their clocks are synchronized.
+
+    :param transport: the :class:`ircdd.transport.ITransport` provider
+        which carries the lane topics.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the lane counters and gauges.
+    """
+
+    implements(ITransport)
+
+    ALPHA = 0.2
+
+    def __init__(self, transport, stats):
+        self.transport = transport
+        self.stats = stats
+
+        self._subscriptions = {}
+        self._latencies = dict((name, 0.0) for name in LANES)
+
+        for name in LANES:
+            self.stats.gauge("lanes.%s.latency_ms" % name,
+                             lambda name=name: self._latencies[name] * 1000)
+
+    def _measure(self, name, callback):
+        """
+        Wraps a callback so that the latency of the messages it
+        receives is accounted to the lane.
+        """
+        def measured(message):
+            published = message.parsed_msg.get("ts")
+            if published is not None:
+                latency = max(0.0, time.time() - published)
+                self._latencies[name] += self.ALPHA * (
+                    latency - self._latencies[name])
+            self.stats.incr("lanes.%s.received" % name)
+            return callback(message)
+
+        return measured
+
+    def subscribe(self, topic, callback, msg_types=None):
+        if msg_types:
+            types = dict((name, [t for t in msg_types if lane(t) == name])
+                         for name in LANES)
+            names = [name for name in LANES if types[name]]
+        else:
+            types = dict((name, None) for name in LANES)
+            names = LANES
+
+        self._subscriptions.setdefault(topic, []).append(names)
+        for name in names:
+            self.transport.subscribe(lane_topic(topic, name),
+                                     self._measure(name, callback),
+                                     types[name])
+
+    def release(self, topic, delete_channel=False):
+        subscriptions = self._subscriptions.get(topic)
+        if not subscriptions:
+            return
+
+        names = subscriptions.pop()
+        if not subscriptions:
+            del self._subscriptions[topic]
+        for name in names:
+            self.transport.release(lane_topic(topic, name), delete_channel)
+
+    def unsubscribe(self, topic, delete_channel=False):
+        names = set()
+        for subscription in self._subscriptions.pop(topic, []):
+            names.update(subscription)
+        for name in names:
+            self.transport.unsubscribe(lane_topic(topic, name),
+                                       delete_channel)
+
+    def publish(self, topic, msg_body, callback=None):
+        name = lane(msg_body.get("type"))
+        self.stats.incr("lanes.%s.published" % name)
+        self.transport.publish(lane_topic(topic, name), msg_body, callback)
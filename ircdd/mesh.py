@@ -0,0 +1,540 @@
+"""
+This module contains the mesh transport, which delivers messages
+between server nodes over direct TCP connections instead of
+through ``NSQ``.
+"""
+
+import struct
+from collections import deque
+
+from zope.interface import implements
+from twisted.internet import protocol, reactor, threads
+from twisted.protocols import basic
+from twisted.python import log
+
+from ircdd import envelope, lanes
+from ircdd.stats import Stats
+from ircdd.transport import ITransport, filter_messages
+
+
+# Frame kinds
+HELLO = 1
+SUB = 2
+UNSUB = 3
+MSG = 4
+# Sent after the SUB frames of the subscriptions held on connection
+READY = 5
+
+# kind, topic length
+FRAME = struct.Struct("!BH")
+
+
+def pack_frame(kind, topic, data=""):
+    """
+    Serializes a frame. Every frame names a topic (or, for ``HELLO``,
+    the sending node) followed by an optional payload.
+    """
+    if isinstance(topic, unicode):
+        topic = topic.encode("utf8")
+    return FRAME.pack(kind, len(topic)) + topic + data
+
+
+def unpack_frame(frame):
+    """
+    Returns the kind, topic and payload of a serialized frame.
+    """
+    kind, topic_len = FRAME.unpack_from(frame)
+    start = FRAME.size
+    topic = frame[start:start + topic_len].decode("utf8")
+    return kind, topic, frame[start + topic_len:]
+
+
+class MeshMessage(object):
+    """
+    A message received from a peer. Messages are delivered at most
+    once, so finishing or requeueing them does nothing.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def finish(self):
+        pass
+
+    def requeue(self, delay=0):
+        pass
+
+    def enable_async(self):
+        pass
+
+
+class MeshProtocol(basic.Int32StringReceiver):
+    """
+    A connection to a peer node. Frames are length-prefixed and carry
+    the messages of every topic the two nodes share. The connection
+    registers itself as the producer of its transport so that frames
+    are queued, up to the mesh's ``queue_limit`` bytes, while the
+    peer's socket buffer is full. Urgent frames, those of the control
+    lane topics, are sent ahead of the queued ones.
+
+    A peer is ``ready`` once it has announced all the subscriptions it
+    held when the connection was made; until then its ``topics`` are
+    incomplete.
+    """
+
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.peer = None
+        self.ready = False
+        self.topics = set()
+        self.queued = 0
+        self._queue = deque()
+        self._urgent = deque()
+        self._paused = False
+
+    def connectionMade(self):
+        if hasattr(self.transport, "setTcpNoDelay"):
+            self.transport.setTcpNoDelay(True)
+        self.transport.registerProducer(self, True)
+
+        self.sendString(pack_frame(HELLO, self.mesh.server_name))
+        for topic in self.mesh.topics():
+            self.sendString(pack_frame(SUB, topic))
+        self.sendString(pack_frame(READY, u""))
+
+    def stringReceived(self, frame):
+        try:
+            kind, topic, data = unpack_frame(frame)
+        except (struct.error, UnicodeDecodeError):
+            log.err("Malformed mesh frame from %s" % self.peer)
+            self.transport.loseConnection()
+            return
+
+        if kind == HELLO:
+            self.peer = topic
+            self.mesh.peerConnected(self)
+        elif self.peer is None:
+            self.transport.loseConnection()
+        elif kind == SUB:
+            self.topics.add(topic)
+        elif kind == UNSUB:
+            self.topics.discard(topic)
+        elif kind == READY:
+            self.ready = True
+        elif kind == MSG:
+            self.mesh.deliver(self, topic, data)
+
+    def connectionLost(self, reason):
+        self._queue.clear()
+        self._urgent.clear()
+        self.queued = 0
+        if self.peer is not None:
+            self.mesh.peerLost(self)
+
+    def canSend(self, size):
+        """
+        Returns True if a frame of the given size can be sent or
+        queued without going past the queue limit.
+        """
+        if not self._paused and not self.queued:
+            return True
+        return self.queued + size <= self.mesh.queue_limit
+
+    def sendFrame(self, frame, urgent=False):
+        """
+        Sends the frame, or queues it while the peer is not keeping
+        up. Returns False if the frame was dropped because the queue
+        is full.
+
+        :param urgent: if True, the frame is queued ahead of the
+            frames which are not urgent.
+        """
+        if not self._paused and not self.queued:
+            self.sendString(frame)
+            return True
+
+        if self.queued + len(frame) > self.mesh.queue_limit:
+            return False
+
+        (self._urgent if urgent else self._queue).append(frame)
+        self.queued += len(frame)
+        return True
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        while (self._urgent or self._queue) and not self._paused:
+            frame = (self._urgent or self._queue).popleft()
+            self.queued -= len(frame)
+            self.sendString(frame)
+
+    def stopProducing(self):
+        self._queue.clear()
+        self._urgent.clear()
+        self.queued = 0
+
+
+class MeshServerFactory(protocol.ServerFactory):
+    """
+    Accepts connections from peer nodes.
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def buildProtocol(self, addr):
+        return MeshProtocol(self.mesh)
+
+
+class PeerFactory(protocol.ReconnectingClientFactory):
+    """
+    Keeps a connection to a single peer node open, reconnecting with
+    an exponential backoff.
+    """
+
+    def __init__(self, mesh, name, max_delay):
+        self.mesh = mesh
+        self.name = name
+        self.maxDelay = max_delay
+        self.proto = None
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        self.proto = MeshProtocol(self.mesh)
+        return self.proto
+
+    def clientConnectionLost(self, connector, reason):
+        self.proto = None
+        self.mesh.stats.incr("mesh.reconnects")
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.proto = None
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def stop(self):
+        self.stopTrying()
+        if self.proto is not None and self.proto.transport is not None:
+            self.proto.transport.loseConnection()
+
+
+class MeshTransport(object):
+    """
+    A transport which keeps a persistent TCP connection to every other
+    server node and delivers each message directly to the nodes that
+    subscribe to its topic, in a single hop.
+
+    Nodes register their mesh address in the database and discover
+    each other through it every ``discovery_interval`` seconds; of each
+    pair of nodes, the one with the greater name connects to the other.
+    Every node announces its subscriptions to its peers, so messages are
+    only sent to the peers which consume them.
+
+    An optional ``fallback`` transport, usually a
+    :class:`ircdd.remote.RemoteReadWriter`, is subscribed to the same
+    topics and carries the messages published while the mesh is not
+    complete (see :meth:`isComplete`), i.e. before the first discovery
+    of the nodes, while a known node is not connected or has not yet
+    announced its subscriptions, and those which do not fit in a slow
+    peer's queue. Without a fallback, the messages published while the
+    mesh is not complete may not reach every node which consumes them
+    and are counted. Messages sent over the mesh are delivered at most
+    once.
+
+    :param server_name: a string that uniquely idetifies this server
+        instance.
+    :type string:
+
+    :param db: the :class:`ircdd.database.IRCDDatabase` used to
+        discover the other nodes.
+
+    :param host: the host on which other nodes can reach this one.
+    :type string:
+
+    :param port: the port on which this node accepts connections from
+        the other nodes.
+    :type int:
+
+    :param stats: an optional :class:`ircdd.stats.Stats` registry on
+        which to maintain the mesh counters and gauges.
+
+    :param fallback: an optional :class:`ircdd.transport.ITransport`
+        provider to publish through when the mesh cannot deliver.
+
+    :param reader_grace: the number of seconds for which an
+        unreferenced topic is kept before it is dropped.
+    :type float:
+
+    :param queue_limit: the number of bytes that may be queued for a
+        peer which is not keeping up.
+    :type int:
+
+    :param max_reconnect_delay: the maximum number of seconds between
+        attempts to reconnect to a peer.
+    :type float:
+
+    :param discovery_interval: the number of seconds between lookups
+        of the other nodes.
+    :type float:
+
+    :param flow: an optional :class:`ircdd.flow.FlowController`; while
+        it is paused the mesh stops reading from its peers.
+
+    :param clock: the reactor used for connections and scheduling.
+        Defaults to the global reactor.
+
+    :param compressor: an optional :class:`ircdd.compression.Compressor`
+        which compresses large message bodies.
+
+    :param reorder: an optional :class:`ircdd.reorder.ReorderBuffer`
+        which delivers each origin's messages in order, whichever path
+        they took. It should be shared with the fallback.
+
+    :param sequencer: an optional :class:`ircdd.envelope.Sequencer`
+        which numbers the published messages. Defaults to a sequencer
+        of this transport's own; it should be shared with the fallback,
+        so the messages of both paths are numbered in one stream.
+    """
+
+    implements(ITransport)
+
+    def __init__(self, server_name, db, host, port, stats=None,
+                 fallback=None, reader_grace=30.0,
+                 queue_limit=4 * 1024 * 1024, max_reconnect_delay=30.0,
+                 discovery_interval=10.0, flow=None, clock=None,
+                 compressor=None, reorder=None, sequencer=None):
+        self.server_name = server_name
+        self.db = db
+        self.host = host
+        self.port = port
+        self.fallback = fallback
+        self.queue_limit = queue_limit
+        self.max_reconnect_delay = max_reconnect_delay
+        self.discovery_interval = discovery_interval
+        self._reader_grace = reader_grace
+        self._flow = flow
+        self._clock = clock or reactor
+        self._compressor = compressor
+        self._reorder = reorder
+        self._sequencer = sequencer or envelope.Sequencer()
+
+        self._handlers = {}
+        self._refs = {}
+        self._evictions = {}
+        self._nodes = {}
+        self._discovered = False
+        self._peers = {}
+        self._connectors = {}
+        self._resume = None
+
+        self.stats = stats if stats is not None else Stats()
+        self.stats.gauge("mesh.peers", lambda: len(self._peers))
+        self.stats.gauge("mesh.queued_bytes",
+                         lambda: sum(p.queued for p in self._peers.values()))
+
+    def topics(self):
+        """
+        Returns the topics this node consumes.
+        """
+        return self._handlers.keys()
+
+    def isComplete(self):
+        """
+        Returns True if the nodes have been discovered, and this node
+        is connected to every other node it knows of and knows all the
+        topics they consume.
+        """
+        return self._discovered and all(
+            name in self._peers and self._peers[name].ready
+            for name in self._nodes)
+
+    def discover(self):
+        """
+        Refreshes this node's registration and connects to the other
+        nodes registered in the database. Meant to be called every
+        ``discovery_interval`` seconds.
+        """
+        def lookup():
+            self.db.heartbeatNode(self.server_name, self.host, self.port)
+            return self.db.listNodes()
+
+        d = threads.deferToThread(lookup)
+        d.addCallback(self.updateNodes)
+        d.addErrback(log.err)
+        return d
+
+    def updateNodes(self, nodes):
+        """
+        Connects to the nodes which are new and disconnects from
+        those which are gone.
+
+        :param nodes: a list of dicts with the ``id``, ``host`` and
+            ``port`` of each node.
+        """
+        self._nodes = dict((node["id"], (node["host"], node["port"]))
+                           for node in nodes
+                           if node["id"] != self.server_name)
+        self._discovered = True
+
+        for name, factory in self._connectors.items():
+            if name not in self._nodes:
+                factory.stop()
+                del self._connectors[name]
+
+        for name, (host, port) in self._nodes.iteritems():
+            if name < self.server_name and name not in self._connectors:
+                factory = PeerFactory(self, name, self.max_reconnect_delay)
+                self._connectors[name] = factory
+                self._clock.connectTCP(host, port, factory)
+
+    def peerConnected(self, proto):
+        existing = self._peers.get(proto.peer)
+        if existing is not None and existing is not proto:
+            existing.transport.loseConnection()
+        self._peers[proto.peer] = proto
+
+        # Nodes which connect before they are discovered are known
+        # from then on.
+        self._nodes.setdefault(proto.peer, None)
+        log.msg("Mesh connected to %s" % proto.peer)
+
+    def peerLost(self, proto):
+        if self._peers.get(proto.peer) is proto:
+            del self._peers[proto.peer]
+            log.msg("Mesh disconnected from %s" % proto.peer)
+
+    def _broadcast(self, kind, topic):
+        frame = pack_frame(kind, topic)
+        for peer in self._peers.values():
+            peer.sendFrame(frame)
+
+    def deliver(self, peer, topic, data):
+        """
+        Hands a message received from a peer to the topic's handler.
+        """
+        self.stats.incr("mesh.received")
+        handler = self._handlers.get(topic)
+        if handler is not None:
+            handler(MeshMessage(data))
+
+        if self._flow and self._flow.paused:
+            self._pauseReading()
+
+    def _pauseReading(self):
+        """
+        Stops reading from the peers until the flow controller
+        resumes consumption.
+        """
+        if self._resume is not None:
+            return
+        for peer in self._peers.values():
+            peer.transport.pauseProducing()
+        self._resume = self._clock.callLater(self._flow.interval,
+                                             self._resumeReading)
+
+    def _resumeReading(self):
+        self._resume = None
+        if self._flow.paused:
+            self._pauseReading()
+            return
+        for peer in self._peers.values():
+            peer.transport.resumeProducing()
+
+    def subscribe(self, topic, callback, msg_types=None):
+        self._refs[topic] = self._refs.get(topic, 0) + 1
+
+        eviction = self._evictions.pop(topic, None)
+        if eviction is not None:
+            eviction.cancel()
+
+        if topic not in self._handlers:
+            handler = filter_messages(callback, self.server_name,
+                                      target=topic, msg_types=msg_types,
+                                      reorder=self._reorder)
+            if self._flow:
+                handler = self._flow.wrap(topic, handler)
+            self._handlers[topic] = handler
+            self._broadcast(SUB, topic)
+
+        if self.fallback is not None:
+            self.fallback.subscribe(topic, callback, msg_types)
+
+    def release(self, topic, delete_channel=False):
+        if self.fallback is not None:
+            self.fallback.release(topic, delete_channel)
+
+        refs = self._refs.get(topic, 0) - 1
+        if refs > 0:
+            self._refs[topic] = refs
+            return
+
+        self._refs.pop(topic, None)
+        if topic in self._handlers and topic not in self._evictions:
+            self._evictions[topic] = self._clock.callLater(
+                self._reader_grace, self._evict, topic)
+
+    def _evict(self, topic):
+        del self._evictions[topic]
+        self._drop(topic)
+
+    def _drop(self, topic):
+        del self._handlers[topic]
+        self._refs.pop(topic, None)
+        self._broadcast(UNSUB, topic)
+
+        eviction = self._evictions.pop(topic, None)
+        if eviction is not None:
+            eviction.cancel()
+
+        if self._reorder is not None:
+            self._reorder.forget(envelope.digest(topic))
+
+    def unsubscribe(self, topic, delete_channel=False):
+        if topic in self._handlers:
+            self._drop(topic)
+        if self.fallback is not None:
+            self.fallback.unsubscribe(topic, delete_channel)
+
+    def publish(self, topic, msg_body, callback=None):
+        if not self.isComplete():
+            if self.fallback is not None:
+                self.stats.incr("mesh.fallback")
+                self.fallback.publish(topic, msg_body, callback)
+                return
+            self.stats.incr("mesh.incomplete")
+
+        frame = pack_frame(MSG, topic,
+                           envelope.pack(self.server_name, topic, msg_body,
+                                         compressor=self._compressor,
+                                         sequencer=self._sequencer))
+        targets = [peer for peer in self._peers.itervalues()
+                   if topic in peer.topics]
+
+        if (self.fallback is not None and
+                not all(peer.canSend(len(frame)) for peer in targets)):
+            # The fallback packs the message again
+            self._sequencer.rewind(topic)
+            self.stats.incr("mesh.fallback")
+            self.fallback.publish(topic, msg_body, callback)
+            return
+
+        # Control lane topics are sequenced apart from the chat of their
+        # user or group, so their frames may overtake it; the frames of
+        # a single topic must not overtake each other
+        urgent = topic.endswith(lanes.CONTROL_SUFFIX)
+        for peer in targets:
+            if peer.sendFrame(frame, urgent):
+                self.stats.incr("mesh.sent")
+            else:
+                log.err("Mesh queue to %s full, dropping message for %s" %
+                        (peer.peer, topic))
+                self.stats.incr("mesh.dropped")
+
+        if callback is not None:
+            callback()
@@ -0,0 +1,502 @@
+"""
+This module contains a native Twisted client for the ``NSQ`` TCP
+protocol, which runs without the tornado IOLoop bridge needed by
+``pynsq``. Its :class:`Reader` and :class:`Writer` expose the parts of
+the ``pynsq`` API that :class:`ircdd.remote.RemoteReadWriter` uses.
+"""
+
+import json
+import socket
+import struct
+from collections import deque
+
+import requests
+from requests.exceptions import ConnectionError, Timeout
+from twisted.internet import protocol, reactor, task, threads
+from twisted.python import log
+
+
+MAGIC = "  V2"
+
+FRAME_RESPONSE = 0
+FRAME_ERROR = 1
+FRAME_MESSAGE = 2
+
+HEARTBEAT = "_heartbeat_"
+
+# Errors after which the connection remains usable.
+NON_FATAL_ERRORS = ("E_FIN_FAILED", "E_REQ_FAILED", "E_TOUCH_FAILED")
+
+SIZE = struct.Struct("!l")
+# size, frame type
+FRAME_HEADER = struct.Struct("!ll")
+# timestamp, attempts, id
+MESSAGE_HEADER = struct.Struct("!qH16s")
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class Error(Exception):
+    """
+    An error returned by ``NSQD`` or raised by the client. Passed to
+    publish callbacks in place of the response, like ``nsq.Error``.
+    """
+
+
+class Message(object):
+    """
+    A message received from ``NSQD``.
+    """
+
+    def __init__(self, conn, id, body, timestamp, attempts):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.attempts = attempts
+        self._conn = conn
+        self._has_responded = False
+        self._async = False
+
+    def has_responded(self):
+        return self._has_responded
+
+    def enable_async(self):
+        """
+        Lets the handler finish or requeue the message after it
+        returns, instead of the reader responding on its behalf.
+        """
+        self._async = True
+
+    def is_async(self):
+        return self._async
+
+    def finish(self):
+        """
+        Acknowledges the message.
+        """
+        assert not self._has_responded
+        self._has_responded = True
+        self._conn.fin(self.id)
+
+    def requeue(self, delay=0, **kwargs):
+        """
+        Asks ``NSQD`` to deliver the message again after the given
+        number of seconds.
+        """
+        assert not self._has_responded
+        self._has_responded = True
+        self._conn.req(self.id, int(delay * 1000))
+
+    def touch(self):
+        """
+        Resets the message's timeout.
+        """
+        assert not self._has_responded
+        self._conn.touch(self.id)
+
+
+class NSQProtocol(protocol.Protocol):
+    """
+    A connection to a single ``NSQD``. Commands are written as soon as
+    they are issued, without waiting for the responses to the previous
+    ones; responses are matched to their commands in order. Frames are
+    parsed in place in the receive buffer, so only message bodies
+    are copied.
+
+    :param owner: the :class:`Reader` or :class:`Writer` which is told
+        when the connection is ready and receives its messages.
+
+    :param address: the 'host:port' address of the ``NSQD``.
+    """
+
+    def __init__(self, owner, address):
+        self.owner = owner
+        self.address = address
+        self.rdy = 0
+        self.in_flight = 0
+        self.max_rdy_count = 2500
+        self._buffer = ""
+        self._pending = deque()
+
+    def connectionMade(self):
+        if hasattr(self.transport, "setTcpNoDelay"):
+            self.transport.setTcpNoDelay(True)
+        self.transport.write(MAGIC)
+        self.identify(self.owner.identify_options(), self._identified)
+
+    def _identified(self, data):
+        if isinstance(data, Error):
+            log.err("IDENTIFY failed on %s: %s" % (self.address, data))
+            self.transport.loseConnection()
+            return
+
+        if data != "OK":
+            self.max_rdy_count = json.loads(data).get("max_rdy_count",
+                                                      self.max_rdy_count)
+        self.owner.connectionReady(self)
+
+    def dataReceived(self, data):
+        if self._buffer:
+            data = self._buffer + data
+        offset = 0
+        end = len(data)
+
+        while end - offset >= FRAME_HEADER.size:
+            size, frame_type = FRAME_HEADER.unpack_from(data, offset)
+            if size < SIZE.size or size > MAX_FRAME_SIZE:
+                log.err("Invalid frame size %s from %s" % (size, self.address))
+                self._buffer = ""
+                self.transport.loseConnection()
+                return
+
+            stop = offset + SIZE.size + size
+            if stop > end:
+                break
+
+            self._frameReceived(frame_type, data,
+                                offset + FRAME_HEADER.size, stop)
+            offset = stop
+
+        self._buffer = data[offset:]
+
+    def _frameReceived(self, frame_type, data, start, stop):
+        if frame_type == FRAME_MESSAGE:
+            timestamp, attempts, id = MESSAGE_HEADER.unpack_from(data, start)
+            body = data[start + MESSAGE_HEADER.size:stop]
+            self.in_flight += 1
+            self.owner.messageReceived(
+                self, Message(self, id, body, timestamp, attempts))
+        elif frame_type == FRAME_RESPONSE:
+            response = data[start:stop]
+            if response == HEARTBEAT:
+                self.nop()
+            elif self._pending:
+                self._pending.popleft()(response)
+        elif frame_type == FRAME_ERROR:
+            error = data[start:stop]
+            if error.split(" ", 1)[0] in NON_FATAL_ERRORS:
+                log.msg("NSQ error on %s: %s" % (self.address, error))
+            elif self._pending:
+                self._pending.popleft()(Error(error))
+            else:
+                log.err("NSQ error on %s: %s" % (self.address, error))
+
+    def connectionLost(self, reason):
+        pending, self._pending = self._pending, deque()
+        for callback in pending:
+            callback(Error("connection lost"))
+        self.owner.connectionLost(self)
+
+    def _command(self, line, body=None, callback=None):
+        if body is None:
+            self.transport.write(line)
+        else:
+            self.transport.writeSequence([line, SIZE.pack(len(body)), body])
+        if callback is not None:
+            self._pending.append(callback)
+
+    def identify(self, options, callback):
+        self._command("IDENTIFY\n", json.dumps(options), callback)
+
+    def sub(self, topic, channel, callback):
+        self._command("SUB %s %s\n" % (topic, channel), callback=callback)
+
+    def send_rdy(self, count):
+        self._command("RDY %d\n" % count)
+        self.rdy = count
+        return True
+
+    def fin(self, id):
+        self.in_flight -= 1
+        self._command("FIN %s\n" % id)
+
+    def req(self, id, delay_ms):
+        self.in_flight -= 1
+        self._command("REQ %s %d\n" % (id, delay_ms))
+
+    def touch(self, id):
+        self._command("TOUCH %s\n" % id)
+
+    def pub(self, topic, data, callback):
+        self._command("PUB %s\n" % topic, data, callback)
+
+    def mpub(self, topic, messages, callback):
+        parts = [SIZE.pack(len(messages))]
+        for message in messages:
+            parts.append(SIZE.pack(len(message)))
+            parts.append(message)
+        self._command("MPUB %s\n" % topic, "".join(parts), callback)
+
+    def nop(self):
+        self._command("NOP\n")
+
+    def cls(self):
+        self._command("CLS\n")
+
+
+class _ConnectionFactory(protocol.ReconnectingClientFactory):
+    """
+    Keeps a connection to a single ``NSQD`` open.
+    """
+
+    def __init__(self, owner, address, reconnect_interval):
+        self.owner = owner
+        self.address = address
+        self.maxDelay = reconnect_interval
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return NSQProtocol(self.owner, self.address)
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return value
+
+
+class _Client(object):
+    """
+    Connection management shared by :class:`Reader` and :class:`Writer`.
+    """
+
+    def __init__(self, reconnect_interval=10.0, clock=None, **identify):
+        self.reconnect_interval = reconnect_interval
+        self.conns = {}
+        self._factories = {}
+        self._clock = clock or reactor
+        self._identify = dict(client_id=socket.gethostname().split(".")[0],
+                              hostname=socket.gethostname(),
+                              user_agent="ircdd",
+                              feature_negotiation=True,
+                              heartbeat_interval=30000)
+        self._identify.update(identify)
+
+    def identify_options(self):
+        return self._identify
+
+    def connect(self, address):
+        """
+        Opens a connection to the ``NSQD`` at the 'host:port' address,
+        unless one is already open.
+        """
+        if address in self._factories:
+            return
+        host, port = address.rsplit(":", 1)
+        factory = _ConnectionFactory(self, address, self.reconnect_interval)
+        self._factories[address] = factory
+        self._clock.connectTCP(host, int(port), factory)
+
+    def connectionReady(self, conn):
+        self.conns[conn.address] = conn
+
+    def connectionLost(self, conn):
+        if self.conns.get(conn.address) is conn:
+            del self.conns[conn.address]
+
+    def messageReceived(self, conn, message):
+        pass
+
+    def close(self):
+        """
+        Closes every connection and stops reconnecting.
+        """
+        for factory in self._factories.itervalues():
+            factory.stopTrying()
+        self._factories = {}
+        for conn in self.conns.values():
+            conn.cls()
+            conn.transport.loseConnection()
+
+
+class Writer(_Client):
+    """
+    Publishes messages to a set of ``NSQD`` instances, spreading them
+    over the open connections in turn.
+
+    :param nsqd_tcp_addresses: a list of 'host:port' strings.
+    :type list:
+
+    :param reconnect_interval: the maximum number of seconds between
+        attempts to reconnect.
+    :type float:
+    """
+
+    def __init__(self, nsqd_tcp_addresses, reconnect_interval=10.0,
+                 clock=None, **identify):
+        _Client.__init__(self, reconnect_interval, clock, **identify)
+        self._next = 0
+        for address in nsqd_tcp_addresses:
+            self.connect(address)
+
+    def _choose(self):
+        if not self.conns:
+            return None
+        conns = self.conns.values()
+        self._next = (self._next + 1) % len(conns)
+        return conns[self._next]
+
+    def _send(self, command, topic, data, callback):
+        conn = self._choose()
+        if conn is None:
+            if callback is not None:
+                callback(None, Error("no open connections"))
+            return
+
+        def respond(response):
+            if callback is not None:
+                callback(conn, response)
+
+        command(conn, _encode(topic), data, respond)
+
+    def pub(self, topic, msg, callback=None):
+        """
+        Publishes a message. The optional callback is called with the
+        connection and either the response or an :class:`Error`.
+        """
+        self._send(NSQProtocol.pub, topic, msg, callback)
+
+    def mpub(self, topic, msgs, callback=None):
+        """
+        Publishes a list of messages in a single command.
+        """
+        self._send(NSQProtocol.mpub, topic, msgs, callback)
+
+
+class Reader(_Client):
+    """
+    Consumes a topic on a channel from the ``NSQD`` instances which
+    ``NSQLookupd`` reports as its producers, or from a fixed list of
+    ``NSQD`` instances.
+
+    The message handler is called with each :class:`Message`; unless
+    it responds to the message itself, the message is finished if the
+    handler returns True and requeued otherwise.
+
+    The ``max_in_flight`` limit is split evenly between the
+    connections. While ``disabled()`` returns True new connections
+    start with a RDY count of 0.
+
+    :param message_handler: the callable to call with each message.
+
+    :param topic: the topic to consume.
+
+    :param channel: the channel to consume on.
+
+    :param lookupd_http_addresses: a list of 'host:port' strings of
+        ``NSQLookupd`` instances to poll for producers.
+
+    :param nsqd_tcp_addresses: a list of 'host:port' strings of
+        ``NSQD`` instances to connect to directly.
+
+    :param max_in_flight: the number of messages that may be in flight
+        across all connections.
+
+    :param lookupd_poll_interval: seconds between polls of
+        ``NSQLookupd``.
+    """
+
+    def __init__(self, message_handler=None, topic=None, channel=None,
+                 lookupd_http_addresses=None, nsqd_tcp_addresses=None,
+                 max_in_flight=1, lookupd_poll_interval=60,
+                 reconnect_interval=10.0, clock=None, **identify):
+        _Client.__init__(self, reconnect_interval, clock, **identify)
+        self.message_handler = message_handler
+        self.topic = _encode(topic)
+        self.channel = _encode(channel)
+        self.lookupd_http_addresses = lookupd_http_addresses or []
+        self.max_in_flight = max_in_flight
+        self.total_rdy = 0
+        self.disabled = lambda: False
+
+        for address in nsqd_tcp_addresses or []:
+            self.connect(address)
+
+        self._poll = None
+        if self.lookupd_http_addresses:
+            self._poll = task.LoopingCall(self.query_lookupd)
+            self._poll.clock = self._clock
+            self._poll.start(lookupd_poll_interval, now=True)
+
+    def _lookup(self, address):
+        """
+        Returns the producers of the topic known to the given
+        ``NSQLookupd``. Runs in a thread.
+        """
+        endpoint = "http://%s/lookup" % address
+        try:
+            response = requests.get(endpoint, params={"topic": self.topic},
+                                    timeout=5)
+        except (ConnectionError, Timeout) as e:
+            log.err("Error making request to NSQLookupd: %s" % str(e))
+            return []
+
+        if response.status_code != requests.codes.ok:
+            return []
+        body = response.json()
+        return body.get("data", body).get("producers", [])
+
+    def query_lookupd(self):
+        """
+        Polls every ``NSQLookupd`` and connects to new producers.
+        """
+        for address in self.lookupd_http_addresses:
+            d = threads.deferToThread(self._lookup, address)
+            d.addCallback(self._connectProducers)
+            d.addErrback(log.err)
+
+    def _connectProducers(self, producers):
+        for producer in producers:
+            self.connect("%s:%s" % (producer["broadcast_address"],
+                                    producer["tcp_port"]))
+
+    def connectionReady(self, conn):
+        def subscribed(response):
+            if isinstance(response, Error):
+                log.err("SUB failed on %s: %s" % (conn.address, response))
+                conn.transport.loseConnection()
+                return
+            _Client.connectionReady(self, conn)
+            self._redistribute()
+
+        conn.sub(self.topic, self.channel, subscribed)
+
+    def connectionLost(self, conn):
+        _Client.connectionLost(self, conn)
+        self._redistribute()
+
+    def _redistribute(self):
+        """
+        Splits ``max_in_flight`` between the connections.
+        """
+        if not self.conns:
+            self.total_rdy = 0
+            return
+
+        per_conn = 0
+        if not self.disabled():
+            per_conn = max(1, self.max_in_flight // len(self.conns))
+
+        for conn in self.conns.itervalues():
+            rdy = min(per_conn, conn.max_rdy_count)
+            if conn.rdy != rdy:
+                conn.send_rdy(rdy)
+        self.total_rdy = sum(conn.rdy for conn in self.conns.itervalues())
+
+    def messageReceived(self, conn, message):
+        try:
+            success = self.message_handler(message)
+        except Exception:
+            log.err()
+            success = False
+
+        if not message.has_responded() and not message.is_async():
+            if success:
+                message.finish()
+            else:
+                message.requeue()
+
+    def close(self):
+        if self._poll is not None and self._poll.running:
+            self._poll.stop()
+        _Client.close(self)
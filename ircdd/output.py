@@ -0,0 +1,233 @@
+"""
+This module contains the output buffer which coalesces the lines
+written to a client connection into fewer, larger writes, and
+bounds the data queued for clients which do not keep up.
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class OutputScheduler(object):
+    """
+    Flushes the :class:`OutputBuffer` of every client connection of a
+    node. The buffers written to are marked dirty and flushed together
+    by a single call, scheduled ``max_delay`` seconds after the first
+    write, so a message fanned out to thousands of clients costs one
+    reactor timer rather than one per client.
+
+    :param max_delay: the number of seconds for which data may be held
+        back.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for scheduling. Defaults to the reactor.
+    """
+
+    def __init__(self, max_delay=0.0, clock=None):
+        self.max_delay = max_delay
+        self._clock = clock or reactor
+
+        self._dirty = set()
+        self._call = None
+
+    def schedule(self, buffer):
+        """
+        Marks the buffer to be flushed with the next batch.
+
+        :param buffer: the :class:`OutputBuffer` written to.
+        """
+        self._dirty.add(buffer)
+        if self._call is None:
+            self._call = self._clock.callLater(self.max_delay, self.flush)
+
+    def cancel(self, buffer):
+        """
+        Takes the buffer out of the next batch, once it was flushed or
+        discarded.
+
+        :param buffer: the :class:`OutputBuffer`.
+        """
+        self._dirty.discard(buffer)
+
+    def flush(self):
+        """
+        Flushes the dirty buffers.
+        """
+        self._call = None
+        dirty, self._dirty = self._dirty, set()
+        for buffer in dirty:
+            try:
+                buffer.flush()
+            except Exception:
+                log.err(None, "Failed to flush output")
+
+
+class OutputBuffer(object):
+    """
+    Wraps the transport of a client connection. The data written to it
+    is held back and handed to the transport in a single
+    ``writeSequence`` once ``max_bytes`` are gathered, or at the latest
+    when the :class:`OutputScheduler` flushes it (i.e. on the next
+    reactor iteration by default), so the lines produced while handling
+    one event leave in as few system calls as possible. Everything else
+    is delegated to the wrapped transport; losing the connection
+    flushes the buffer first.
+
+    The buffer registers as the producer of the transport. While the
+    transport pauses it because the client is not reading fast enough,
+    data written as droppable (the channel chat fanned out by
+    :meth:`ircdd.group.ShardedGroup.receive`) is discarded and the
+    client's own input is no longer read; private messages and replies
+    are kept. Should the data queued for
+    the client still grow past ``sendq`` bytes, nothing more is written
+    and the client is disconnected with ``SendQ exceeded``, as classic
+    IRC servers do. The data queued for the client is that held in the
+    buffer and that handed to the transport since it paused the buffer;
+    the transport's own buffer, up to the size at which it pauses its
+    producer, is not counted.
+
+    :param transport: the transport of the client connection.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the output counters and gauges.
+
+    :param max_delay: the number of seconds for which data may be held
+        back, without a ``scheduler``.
+    :type float:
+
+    :param max_bytes: the number of bytes past which the buffer is
+        flushed right away.
+    :type int:
+
+    :param sendq: the number of bytes that may be queued for the client.
+    :type int:
+
+    :param close_timeout: the number of seconds given to a client
+        disconnected past ``sendq`` to read its queue and the ``ERROR``
+        line, after which the connection is aborted.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for scheduling. Defaults to the reactor.
+
+    :param scheduler: the :class:`OutputScheduler` of the node. Defaults
+        to a scheduler of the buffer's own.
+    """
+
+    def __init__(self, transport, stats, max_delay=0.0, max_bytes=16384,
+                 sendq=1048576, close_timeout=10.0, clock=None,
+                 scheduler=None):
+        self.transport = transport
+        self.stats = stats
+        self.max_bytes = max_bytes
+        self.sendq = sendq
+        self.close_timeout = close_timeout
+        self._clock = clock or reactor
+        self.scheduler = scheduler or OutputScheduler(max_delay, clock)
+
+        self.pending = 0
+        self.unsent = 0
+        self.paused = False
+        self.closed = False
+        self._chunks = []
+        self._abort = None
+
+        transport.registerProducer(self, True)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def queued(self):
+        """
+        Returns the number of bytes queued for the client, in the
+        buffer and in the transport since it paused the buffer.
+        """
+        return self.pending + self.unsent
+
+    def write(self, data, droppable=False):
+        """
+        Buffers the data.
+
+        :param data: the bytes to write.
+
+        :param droppable: if True, the data is discarded while the
+            client is not keeping up.
+        :type bool:
+        """
+        if self.closed:
+            return
+        if droppable and self.paused:
+            self.stats.incr("output.dropped")
+            return
+
+        self._chunks.append(data)
+        self.pending += len(data)
+        self.stats.incr("output.lines", data.count("\n") or 1)
+
+        if self.queued() > self.sendq:
+            self.exceeded()
+        elif self.pending >= self.max_bytes:
+            self.flush()
+        else:
+            self.scheduler.schedule(self)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def flush(self):
+        """
+        Hands the buffered data to the transport.
+        """
+        self.scheduler.cancel(self)
+
+        if self._chunks:
+            chunks = self._chunks
+            self._chunks = []
+            if self.paused:
+                self.unsent += self.pending
+            self.pending = 0
+            self.stats.incr("output.writes")
+            self.transport.writeSequence(chunks)
+
+    def discard(self):
+        """
+        Drops the buffered data, once the connection is gone.
+        """
+        self.scheduler.cancel(self)
+        if self._abort is not None and self._abort.active():
+            self._abort.cancel()
+        self._abort = None
+        self._chunks = []
+        self.pending = 0
+
+    def exceeded(self):
+        """
+        Disconnects the client, whose queue grew past ``sendq``.
+        """
+        log.msg("SendQ exceeded for %s" % (self.transport.getPeer(),))
+        self.stats.incr("output.sendq_exceeded")
+        self.discard()
+        self.closed = True
+        self.transport.write("ERROR :Closing Link: SendQ exceeded\r\n")
+        self.transport.loseConnection()
+        self._abort = self._clock.callLater(self.close_timeout,
+                                            self.transport.abortConnection)
+
+    def loseConnection(self):
+        self.flush()
+        self.transport.loseConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+        self.stats.incr("output.pauses")
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.unsent = 0
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.discard()
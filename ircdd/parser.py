@@ -0,0 +1,182 @@
+"""
+This module contains the parser which splits the data received from
+clients into IRC lines, and the dispatch tables which map the commands
+of those lines to the ``irc_<COMMAND>`` handlers of a protocol class.
+"""
+
+# The longest line accepted: 8191 bytes of IRCv3 tags and 512 of message
+MAX_LINE = 8191 + 512
+
+_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+_tables = {}
+
+
+def unescape_tag(value):
+    """
+    Returns the value of an IRCv3 message tag with its escape
+    sequences replaced.
+
+    :param value: the escaped value.
+    :type string:
+    """
+    if "\\" not in value:
+        return value
+
+    chunks = []
+    i, length = 0, len(value)
+    while i < length:
+        char = value[i]
+        if char == "\\":
+            i += 1
+            if i < length:
+                chunks.append(_ESCAPES.get(value[i], value[i]))
+        else:
+            chunks.append(char)
+        i += 1
+    return "".join(chunks)
+
+
+def parse_tags(raw):
+    """
+    Returns a dict mapping the keys of the IRCv3 message tags, the
+    part of a line between ``@`` and the first space, to their values.
+    Tags without a value map to the empty string.
+
+    :param raw: the tags of a line.
+    :type string:
+    """
+    tags = {}
+    for tag in raw.split(";"):
+        key, _, value = tag.partition("=")
+        if key:
+            tags[key] = unescape_tag(value)
+    return tags
+
+
+def parse_line(line):
+    """
+    Breaks an IRC line, without its line ending, into its message
+    tags, prefix, command and parameters. Returns a ``(tags, prefix,
+    command, params)`` tuple, where ``tags`` is None for a line without
+    tags and the command is upper-cased, or None if the line is not a
+    valid IRC message.
+
+    :param line: the line to parse.
+    :type string:
+    """
+    tags = None
+    prefix = ""
+    first = line[:1]
+
+    if first == "@":
+        raw, _, line = line[1:].partition(" ")
+        tags = parse_tags(raw)
+        line = line.lstrip(" ")
+        first = line[:1]
+
+    if first == ":":
+        prefix, _, line = line[1:].partition(" ")
+        line = line.lstrip(" ")
+
+    i = line.find(" :")
+    if i == -1:
+        params = line.split()
+    else:
+        params = line[:i].split()
+        trailing = line[i + 2:]
+
+    if not params:
+        return None
+    command = params.pop(0).upper()
+    if not command.isalnum():
+        return None
+    if i != -1:
+        params.append(trailing)
+
+    return tags, prefix, command, params
+
+
+class LineParser(object):
+    """
+    Splits the data received from a client into lines and parses them
+    with :func:`parse_line`. Lines end with LF, optionally preceded by
+    CR. Empty lines are skipped; lines longer than :data:`MAX_LINE`
+    bytes and lines which are not valid IRC messages are dropped, so no
+    input can break the connection. Like Twisted's ``parsemsg``, the
+    parser leaves the lines as bytes: the handlers decode their
+    parameters with the encoding of the client.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        count the dropped lines.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._buffer = ""
+        self._overflow = False
+
+    def feed(self, data):
+        """
+        Returns the ``(tags, prefix, command, params)`` tuples of the
+        lines completed by the data.
+
+        :param data: the bytes received.
+        :type string:
+        """
+        data = self._buffer + data
+        end = data.rfind("\n") + 1
+        self._buffer = data[end:]
+
+        if self._overflow:
+            # The rest of a line which was too long
+            if end:
+                data = data[data.find("\n") + 1:end]
+                self._overflow = False
+            else:
+                data = self._buffer = ""
+        else:
+            data = data[:end]
+        if len(self._buffer) > MAX_LINE:
+            self.stats.incr("parser.oversized")
+            self._buffer = ""
+            self._overflow = True
+
+        lines = data.split("\n")
+        lines.pop()
+
+        parsed = []
+        for line in lines:
+            if line[-1:] == "\r":
+                line = line[:-1]
+            if not line:
+                continue
+            if len(line) > MAX_LINE:
+                self.stats.incr("parser.oversized")
+                continue
+
+            message = parse_line(line)
+            if message is None:
+                self.stats.incr("parser.malformed")
+            else:
+                parsed.append(message)
+        return parsed
+
+
+def dispatch_table(cls):
+    """
+    Returns a dict mapping each command handled by the protocol class
+    to the name and function of its ``irc_<COMMAND>`` handler. The
+    table of a class is built the first time it is asked for and
+    reused for every following line.
+
+    :param cls: the protocol class.
+    """
+    table = _tables.get(cls)
+    if table is None:
+        table = {}
+        for name in dir(cls):
+            if name.startswith("irc_"):
+                table[name[4:]] = (name, getattr(cls, name))
+        _tables[cls] = table
+    return table
@@ -0,0 +1,254 @@
+"""
+This module contains the pool of writers through which messages
+are published to the ``NSQD`` instances of the cluster.
+"""
+
+import hashlib
+
+import nsq
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class _Member(object):
+    """
+    A single ``NSQD`` instance of the pool, along with its writer
+    and its health record.
+    """
+
+    def __init__(self, address, writer, backoff):
+        self.address = address
+        self.writer = writer
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.ejected_until = None
+        self.probing = False
+        self.backoff = backoff
+
+    def connected(self):
+        return bool(self.writer.conns)
+
+
+class WriterPool(object):
+    """
+    Publishes through one ``Writer`` per ``NSQD`` instance,
+    tracking the latency and error rate of each.
+
+    Each topic is routed by rendezvous hashing to the same instance
+    for as long as that instance is healthy, which preserves the order
+    of the messages within the topic. Instances which fail repeatedly,
+    whose error rate climbs past ``max_error_rate``, or whose latency
+    grows past ``latency_factor`` times the median of the pool are
+    ejected; their topics move to the next instance in hash order.
+    After ``probe_interval`` seconds an ejected instance is given
+    traffic again and is ejected for twice as long if it is still
+    unhealthy. The last healthy instance is never ejected.
+
+    Exposes the ``pub`` method and ``conns`` attribute of a single
+    ``Writer``.
+
+    :param addresses: a list of 'tcp_address:port' strings of the
+        ``NSQD`` instances to publish to. At least one is required.
+    :type list:
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the health gauges.
+
+    :param max_failures: consecutive failures after which an instance
+        is ejected.
+    :type int:
+
+    :param max_error_rate: the average error rate past which an
+        instance is ejected.
+    :type float:
+
+    :param latency_factor: how many times slower than the median of
+        the pool an instance may get before being ejected.
+    :type float:
+
+    :param min_latency: latencies, in seconds, below which an instance
+        is never considered slow.
+    :type float:
+
+    :param probe_interval: seconds for which an instance is initially
+        ejected.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+
+    :param client: the ``NSQ`` client module providing the ``Writer``
+        and ``Error`` classes: ``nsq`` (the default) or
+        :mod:`ircdd.nsqclient`.
+    """
+
+    ALPHA = 0.2
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, addresses, stats, max_failures=3, max_error_rate=0.5,
+                 latency_factor=3.0, min_latency=0.05, probe_interval=5.0,
+                 clock=None, client=None):
+        if not addresses:
+            raise ValueError("No NSQD address to publish to")
+
+        self.stats = stats
+        self.max_failures = max_failures
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+        self.min_latency = min_latency
+        self.probe_interval = probe_interval
+        self._clock = clock or reactor
+        self._client = client or nsq
+
+        self._members = []
+        for address in addresses:
+            writer = self._client.Writer([address], reconnect_interval=10.0)
+            member = _Member(address, writer, probe_interval)
+            self._members.append(member)
+            self._registerGauges(member)
+
+    def _registerGauges(self, member):
+        prefix = "pool.%s." % member.address
+        self.stats.gauge(prefix + "latency_ms",
+                         lambda: int((member.latency or 0.0) * 1000))
+        self.stats.gauge(prefix + "error_rate",
+                         lambda: round(member.error_rate, 3))
+        self.stats.gauge(prefix + "healthy",
+                         lambda: int(self._isHealthy(member)))
+
+    @property
+    def conns(self):
+        """
+        The connections of all the writers in the pool.
+        """
+        conns = {}
+        for member in self._members:
+            conns.update(member.writer.conns)
+        return conns
+
+    def _isHealthy(self, member):
+        if member.ejected_until is None:
+            return True
+
+        if self._clock.seconds() >= member.ejected_until:
+            # Give the instance another chance; its next results
+            # decide whether it stays.
+            member.ejected_until = None
+            member.probing = True
+            member.latency = None
+            member.error_rate = 0.0
+            member.failures = 0
+        return member.ejected_until is None
+
+    def _rank(self, topic):
+        """
+        Returns the members ordered by their rendezvous hash
+        for the topic.
+        """
+        if isinstance(topic, unicode):
+            topic = topic.encode("utf8")
+
+        def weight(member):
+            return hashlib.md5(topic + "\0" + member.address).digest()
+
+        return sorted(self._members, key=weight, reverse=True)
+
+    def choose(self, topic):
+        """
+        Returns the member which should publish the topic's messages:
+        the first healthy and connected member in hash order, or the
+        first connected one if none is healthy.
+
+        :param topic: the topic to publish on.
+        """
+        ranked = self._rank(topic)
+
+        for member in ranked:
+            if self._isHealthy(member) and member.connected():
+                return member
+
+        for member in ranked:
+            if member.connected():
+                return member
+
+        return ranked[0]
+
+    def pub(self, topic, msg, callback=None):
+        """
+        Publishes the message through the writer chosen for the
+        topic and records the outcome.
+
+        :param topic: the topic to publish on.
+
+        :param msg: the serialized message.
+
+        :param callback: an optional callable which will be called
+            with the connection and the response, like the callback of
+            :meth:`nsq.Writer.pub`.
+        """
+        member = self.choose(topic)
+        start = self._clock.seconds()
+
+        def finish_pub(conn, data):
+            self._record(member, self._clock.seconds() - start,
+                         isinstance(data, self._client.Error))
+            if callback:
+                callback(conn, data)
+
+        member.writer.pub(topic, msg, callback=finish_pub)
+
+    def _record(self, member, latency, failed):
+        """
+        Updates the health record of the member with the outcome of
+        a single publish and ejects the member if it is unhealthy.
+        """
+        member.error_rate += self.ALPHA * (float(failed) - member.error_rate)
+
+        if failed:
+            member.failures += 1
+        else:
+            member.failures = 0
+            if member.latency is None:
+                member.latency = latency
+            else:
+                member.latency += self.ALPHA * (latency - member.latency)
+
+        if member.ejected_until is not None:
+            return
+
+        if (member.failures >= self.max_failures or
+                member.error_rate > self.max_error_rate or
+                (member.probing and failed) or
+                self._isSlow(member)):
+            self._eject(member)
+        elif member.probing and not failed:
+            member.probing = False
+            member.backoff = self.probe_interval
+
+    def _isSlow(self, member):
+        others = sorted(m.latency for m in self._members
+                        if m is not member and m.latency is not None and
+                        m.ejected_until is None)
+        if member.latency is None or not others:
+            return False
+
+        median = others[len(others) // 2]
+        return member.latency > max(self.min_latency,
+                                    self.latency_factor * median)
+
+    def _eject(self, member):
+        healthy = [m for m in self._members
+                   if m is not member and m.ejected_until is None]
+        if not healthy:
+            return
+
+        if member.probing:
+            member.backoff = min(member.backoff * 2, self.MAX_BACKOFF)
+        member.probing = False
+        member.ejected_until = self._clock.seconds() + member.backoff
+
+        self.stats.incr("pool.ejections")
+        log.msg("Ejected nsqd %s for %ss (latency %s, error rate %.2f)" %
+                (member.address, member.backoff,
+                 member.latency, member.error_rate))
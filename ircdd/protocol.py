@@ -6,36 +6,119 @@ from twisted.words import iwords, ewords
 from twisted.words.protocols import irc
 from twisted.internet import defer
 
+from ircdd import parser, wire
+from ircdd.output import OutputBuffer
 
-class ProxyIRCDDUser():
+
+class IRCDDUser(IRCUser):
     """
-    Shell object that stands in place of a real client connection.
-    It is used when the lcoal node must operate on a ShardedUser
-    which is connected to a different node.
+    IRC protocol implementation which handles user connections.
+    Its output goes through an :class:`ircdd.output.OutputBuffer`, and
+    its commands through a :class:`ircdd.throttle.ClientThrottle` when
+    the node has flood control.
+
+    Input is parsed by an :class:`ircdd.parser.LineParser` and each
+    command is dispatched through the :func:`ircdd.parser.dispatch_table`
+    of the class. The IRCv3 message tags of the command being handled
+    are available as ``tags``.
     """
 
-    def __init__(self, ctx, name):
+    password = "no password"
+    throttle = None
+    tags = None
+
+    def connectionMade(self):
+        """
+        Wraps the transport in an output buffer and sets up the
+        parser and flood control of the connection.
+        """
+        self.lineParser = parser.LineParser(self.ctx.stats)
+        self.transport = OutputBuffer(
+            self.transport,
+            self.ctx.stats,
+            max_delay=float(self.ctx.get('output_max_delay', 0.0)),
+            max_bytes=int(self.ctx.get('output_max_bytes', 16384)),
+            sendq=int(self.ctx.get('output_sendq', 1048576)),
+            scheduler=self.ctx.get('output'))
+        if self.ctx.get('flood') is not None:
+            self.throttle = self.ctx.flood.throttle(
+                self.dispatchCommand,
+                self.excessFlood,
+                self.serverBusy)
+        IRCUser.connectionMade(self)
+
+    def connectionLost(self, reason):
+        """
+        Forgets the connection on the factory before logging out.
+        """
+        self.factory.clients.discard(self)
+        if self.throttle is not None:
+            self.throttle.stop()
+        if isinstance(self.transport, OutputBuffer):
+            self.transport.discard()
+        IRCUser.connectionLost(self, reason)
+
+    def dataReceived(self, data):
         """
-        Initializes a proxy ircdd user object.
+        Parses the lines completed by the data and handles their
+        commands.
         """
-        self.ctx = ctx
-        self.name = name
+        for tags, prefix, command, params in self.lineParser.feed(data):
+            self.handleCommand(command, prefix, params, tags)
 
-    def receive(self, sender_name, recipient, message):
+    def handleCommand(self, command, prefix, params, tags=None):
         """
-        The remote client will process the message via NSQ, so this
-        method just logs the fact that the proxy was hit.
+        Hands the command to the flood control of the connection,
+        which handles it now or once the client has waited enough.
         """
-        log.msg("Proxy received message %s from %s for %s" %
-                (message, sender_name, recipient))
+        if self.throttle is None:
+            self.dispatchCommand(command, prefix, params, tags)
+        else:
+            self.throttle.submit(command, prefix, params, tags)
 
+    def dispatchCommand(self, command, prefix, params, tags=None):
+        """
+        Calls the handler of the command. Handlers set on the instance,
+        such as the one which logs the client in, take precedence over
+        those of the class.
+        """
+        entry = parser.dispatch_table(self.__class__).get(command)
+        name, function = entry or ("irc_" + command, None)
+        method = self.__dict__.get(name)
 
-class IRCDDUser(IRCUser):
-    """
-    IRC protocol implementation which handles user connections.
-    """
+        self.tags = tags
+        try:
+            if method is not None:
+                method(prefix, params)
+            elif function is not None:
+                function(self, prefix, params)
+            else:
+                self.irc_unknown(prefix, command, params)
+        except Exception:
+            log.deferr()
+        finally:
+            self.tags = None
+
+    def excessFlood(self):
+        """
+        Disconnects the client, which sent too many commands.
+        """
+        log.msg("Excess flood from %s" % (self.transport.getPeer(),))
+        self.transport.write("ERROR :Closing Link: Excess Flood\r\n")
+        self.transport.loseConnection()
 
-    password = "no password"
+    def serverBusy(self, command):
+        """
+        Tells the client that the command was refused because the
+        node handles too many of them.
+
+        :param command: the upper-case name of the command.
+        """
+        self.sendMessage(
+            irc.RPL_TRYAGAIN, command,
+            ":Server load is temporarily too heavy. "
+            "Please wait a while and try again.",
+            to=(getattr(self, "name", None) or u"*").encode(self.encoding))
 
     def receive(self, sender_name, recipient, message):
         """
@@ -55,13 +138,33 @@ class IRCDDUser(IRCUser):
         else:
             recipient_name = recipient.name
 
-        text = message.get("text", "<an unrepresentable message>")
+        lines = wire.message_lines(message, recipient_name)
+
+        hostname, encoding = self.wireFormat()
+        self.sendRendered(wire.render(sender_name, hostname, lines, encoding))
 
-        for L in text.splitlines():
-            self.privmsg("%s!%s@%s" % (sender_name,
-                                       sender_name,
-                                       self.hostname),
-                         recipient_name, L)
+    def wireFormat(self):
+        """
+        Returns the ``(hostname, encoding)`` pair which, along with the
+        message, determines the bytes that :meth:`receive` writes.
+        Clients with the same pair can share the rendered bytes.
+        """
+        return self.hostname, self.encoding or "utf-8"
+
+    def sendRendered(self, data, droppable=False):
+        """
+        Writes lines rendered by :func:`ircdd.wire.render`.
+
+        :param data: the bytes to write.
+
+        :param droppable: if True, the lines are channel chat, which is
+            dropped while the client does not keep up with its output.
+        :type bool:
+        """
+        if isinstance(self.transport, OutputBuffer):
+            self.transport.write(data, droppable)
+        else:
+            self.transport.write(data)
 
     def userJoined(self, group, user_name, user_hostname):
         """
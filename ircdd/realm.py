@@ -7,7 +7,7 @@ from twisted.python import failure
 
 from ircdd.user import ShardedUser
 from ircdd.group import ShardedGroup
-from ircdd.protocol import ProxyIRCDDUser
+from ircdd.handles import RemoteUser
 
 
 class ShardedRealm(object):
@@ -21,6 +21,9 @@ class ShardedRealm(object):
     to the local instance).
     It subscribes to groups on behalf of the locally connected users
     and performs message relaying to the latter.
+    Users are dropped from the realm when they log out, and groups
+    ``group_idle_grace`` seconds after their last local session was
+    removed; both are created again when they are next needed.
 
     :param ctx: an initialized context which will be used to access
         ``RDB`` and ``NSQ``.
@@ -51,6 +54,12 @@ class ShardedRealm(object):
         # The local ShardedGroup serves as a local relay and cache.
         self.groups = {}
 
+        self.group_idle_grace = float(ctx.get("group_idle_grace", 300.0))
+        self._expirations = {}
+
+        ctx["stats"].gauge("realm.users", lambda: len(self.users))
+        ctx["stats"].gauge("realm.groups", lambda: len(self.groups))
+
     def userFactory(self, name):
         """
         Returns a new ShardedUser for the given avatar id.
@@ -85,6 +94,9 @@ class ShardedRealm(object):
         def logout():
             getattr(facet, "logout", lambda: None)()
             avatar.realm = avatar.mind = None
+            self.ctx.remote_users.invalidate(avatar.name)
+            if self.users.get(avatar.name) is avatar:
+                del self.users[avatar.name]
 
         return logout
 
@@ -118,6 +130,7 @@ class ShardedRealm(object):
                     mind.name = avatarId
                     mind.realm = self
                     mind.avatar = avatar
+                    self.ctx.remote_users.invalidate(avatarId)
                     return iface, facet, self.logoutFactory(avatar, facet)
             raise NotImplementedError(self, interfaces)
         return self.getUser(avatarId).addCallback(gotAvatar)
@@ -142,22 +155,29 @@ class ShardedRealm(object):
         """
         assert isinstance(name, unicode)
 
+        def cbUser(user):
+            # The user is connected to another node as well
+            if isinstance(user, RemoteUser):
+                return self.userFactory(user.name)
+            return user
+
         if self.createUserOnRequest:
             def ebUser(err):
                 err.trap(ewords.DuplicateUser)
-                return self.lookupUser(name)
+                return self.lookupUser(name).addCallback(cbUser)
             return self.createUser(name).addErrback(ebUser)
 
-        return self.lookupUser(name)
+        return self.lookupUser(name).addCallback(cbUser)
 
     def lookupUser(self, name):
         """
-        Looks for the given user first in the local store and
-        failing that in the database. If found in the databse,
-        checks the session for validity - if the session is valid
-        the user must be connected to some other node, so a ShardedUser
-        with a ProxyIRCDDUser for mind is returned. If the session is
-        not valid, fail with NoSuchUser.
+        Looks for the given user first in the local store, then
+        among the cached handles of remote users, then in the
+        :class:`ircdd.routes.RoutingTable`, and failing that in the
+        database. If routed to another node, or found in the database
+        with a valid session, the user must be connected to some other
+        node, so a :class:`ircdd.handles.RemoteUser` is cached and
+        returned. If the session is not valid, fail with NoSuchUser.
 
         :param name: the name of the user to look for.
         """
@@ -168,15 +188,23 @@ class ShardedRealm(object):
         if local_user:
             return defer.succeed(local_user)
 
+        handle = self.ctx.remote_users.get(name)
+        if handle is not None:
+            return defer.succeed(handle)
+
+        routes = self.ctx.get('routes')
+        node = routes.route(name) if routes is not None else None
+        if node is not None and node != self.ctx.hostname:
+            return defer.succeed(self.ctx.remote_users.add(name, node))
+
         remote_user = self.ctx.db.lookupUser(name)
         user_session = self.ctx.db.lookupUserSession(name)
 
         # User exists and session is active, so he must be
         # connected to some remote
         if remote_user and user_session and user_session["active"]:
-            return defer.succeed(ShardedUser(self.ctx,
-                                             name,
-                                             ProxyIRCDDUser(self.ctx, name)))
+            return defer.succeed(
+                self.ctx.remote_users.add(name, user_session.get("node")))
 
         return defer.fail(failure.Failure(ewords.NoSuchUser(name)))
 
@@ -208,7 +236,9 @@ class ShardedRealm(object):
 
     def lookupGroup(self, name):
         """
-        Looks for the group in the local shard's store.
+        Looks for the group in the local shard's store. A group which
+        exists in the database but not locally, e.g. because it was
+        torn down while idle, is created again.
 
         :param name: the name of the group.
         """
@@ -219,6 +249,9 @@ class ShardedRealm(object):
         if group:
             return defer.succeed(group)
 
+        if self.ctx.db.lookupGroup(name):
+            return self.addGroup(self.groupFactory(name))
+
         return defer.fail(failure.Failure(ewords.NoSuchGroup(name)))
 
     def getGroup(self, name):
@@ -250,8 +283,39 @@ class ShardedRealm(object):
             return defer.fail(failure.Failure(ewords.DuplicateGroup()))
 
         self.groups[group.name] = group
+        group.idle = self.groupIdle
+        # Collected if nobody joins it
+        self.groupIdle(group)
         return defer.succeed(group)
 
+    def groupIdle(self, group):
+        """
+        Schedules the teardown of a group without local sessions,
+        ``group_idle_grace`` seconds from now.
+
+        :param group: the :class:`ircdd.group.ShardedGroup` which has
+            no local sessions left.
+        """
+        timer = self._expirations.pop(group.name, None)
+        if timer is not None:
+            timer.cancel()
+
+        self._expirations[group.name] = self.ctx.wheel.call_later(
+            self.group_idle_grace, lambda: self._expireGroup(group))
+
+    def _expireGroup(self, group):
+        """
+        Removes the group from the realm and tears it down, unless a
+        local session was added to it in the meantime.
+        """
+        self._expirations.pop(group.name, None)
+        if group.local_sessions or self.groups.get(group.name) is not group:
+            return
+
+        del self.groups[group.name]
+        group.close()
+        self.ctx.stats.incr("realm.groups_expired")
+
     def createGroup(self, name):
         """
         Creates a new group and returns the :class:`ircdd.group.ShardedGroup`
@@ -266,10 +330,8 @@ class ShardedRealm(object):
 
         def ebLookup(err):
             err.trap(ewords.NoSuchGroup)
-            group = self.ctx.db.lookupGroup(name)
-
-            if not group:
-                self.ctx.db.createGroup(name, "public")
+            # The lookup found the group neither here nor in the database
+            self.ctx.db.createGroup(name, "public")
 
             return self.groupFactory(name)
 
@@ -1,9 +1,20 @@
 import nsq
-import json
 import requests
 from requests.exceptions import ConnectionError, Timeout
+from zope.interface import implements
+from twisted.internet import reactor
 from twisted.python import log
 
+from ircdd import envelope
+from ircdd.pool import WriterPool
+from ircdd.spool import PublishQueue
+from ircdd.stats import Stats
+from ircdd.transport import ITransport, filter_messages
+
+
+# Appended to the names of topics and channels which NSQD keeps in memory
+EPHEMERAL = "#ephemeral"
+
 
 def _create_topic(topic, lookupd_http_addresses):
     """
@@ -173,10 +184,25 @@ def _delete_channel(topic, chan, lookupd_http_addresses):
 class RemoteReadWriter(object):
     """
     A high level producer/consumer for publishing/consuming from NSQ.
-    Maintains a single long-lived :class:`nsq.Writer`, a set of
+    Maintains a long-lived :class:`ircdd.pool.WriterPool`, fed by a
+    bounded outbound queue which survives ``NSQD`` outages, a set of
     :class:`nsq.Reader`s, and a set of callbacks. The mapping between
     :class:`nsq.Reader`s and callbacks is 1:1.
 
+    Subscriptions are reference-counted: every owner which subscribes
+    to a topic must release it when done. Once the last owner releases
+    a topic its reader is kept around for a grace period, so that a
+    quick resubscription can reuse it, and then closed. The channels of
+    closed readers which are no longer needed are deleted in batches.
+
+    Messages of the ``ephemeral_types`` are published on the
+    ``#ephemeral`` variant of their topic, which ``NSQD`` keeps in
+    memory only: it never writes them to disk, and drops them rather
+    than spilling them when the queue overflows. Messages of the other
+    types stay on the durable topic. A subscription consumes the topics
+    of both durability classes, unless its message types all belong to
+    one of them.
+
     Expects a list of ``NSQD`` and ``NSQLookupd`` addresses to be passed
     along with a unique server identifier.
 
@@ -194,27 +220,121 @@ class RemoteReadWriter(object):
                         It will be used as channel name for both publishing and
                         reading from `NSQ`.
     :type string:
+
+    :param stats: an optional :class:`ircdd.stats.Stats` registry on which
+                  to maintain the reader counters and gauges.
+
+    :param reader_grace: the number of seconds for which an unreferenced
+                         reader is kept before it is closed.
+    :type float:
+
+    :param cleanup_interval: the number of seconds between batches of
+                             channel deletions.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+                  provider used for scheduling. Defaults to the reactor.
+
+    :param flow: an optional :class:`ircdd.flow.FlowController` which
+                 sets the in-flight limits of the readers.
+
+    :param queue_options: keyword arguments for the outbound
+                          :class:`ircdd.spool.PublishQueue`, such as
+                          its ``memory_limit`` and ``spool_path``.
+    :type dict:
+
+    :param pool_options: keyword arguments for the
+                         :class:`ircdd.pool.WriterPool` which publishes
+                         to the ``NSQD`` instances.
+    :type dict:
+
+    :param client: the ``NSQ`` client module providing the ``Reader``,
+                   ``Writer`` and ``Error`` classes: ``nsq`` (the
+                   default) or :mod:`ircdd.nsqclient`.
+
+    :param compressor: an optional :class:`ircdd.compression.Compressor`
+                       which compresses large message bodies.
+
+    :param dedup: an optional :class:`ircdd.dedup.Deduplicator` which
+                  drops redelivered messages.
+
+    :param reorder: an optional :class:`ircdd.reorder.ReorderBuffer`
+                    which delivers each origin's messages in order.
+
+    :param ephemeral_types: the message types which are published on
+                            ephemeral topics.
+    :type list:
+
+    :param sequencer: an optional :class:`ircdd.envelope.Sequencer`
+                      which numbers the published messages. Defaults to
+                      a sequencer of this transport's own.
     """
 
-    def __init__(self, nsqd_addresses, lookupd_addresses, server_name):
+    implements(ITransport)
+
+    def __init__(self, nsqd_addresses, lookupd_addresses, server_name,
+                 stats=None, reader_grace=30.0, cleanup_interval=60.0,
+                 clock=None, flow=None, queue_options=None,
+                 pool_options=None, client=None, compressor=None,
+                 dedup=None, reorder=None, ephemeral_types=None,
+                 sequencer=None):
         self._readers = {}
+        self._topics = {}
+        self._refs = {}
+        self._evictions = {}
+        self._doomed_channels = set()
+        self._cleanup = None
         self._writer = None
         self._nsqd_addresses = nsqd_addresses
         self._lookupd_addresses = lookupd_addresses
         self._server_name = server_name
+        self._reader_grace = reader_grace
+        self._cleanup_interval = cleanup_interval
+
+        self._clock = clock or reactor
+        self._flow = flow
+        self._pool_options = pool_options or {}
+        self._client = client or nsq
+        self._compressor = compressor
+        self._dedup = dedup
+        self._reorder = reorder
+        self._sequencer = sequencer or envelope.Sequencer()
+        self._ephemeral_types = frozenset(ephemeral_types or ())
+
+        self.stats = stats if stats is not None else Stats()
+        self.stats.gauge("remote.readers", lambda: len(self._readers))
+        self.stats.gauge("remote.connections", self._count_connections)
 
         self._start_writer()
+        self._queue = PublishQueue(self._send,
+                                   lambda: bool(self._writer.conns),
+                                   self.stats,
+                                   clock=self._clock,
+                                   **(queue_options or {}))
+
+    def _count_connections(self):
+        """
+        Returns the number of open nsqd connections held by
+        the readers and the writer.
+        """
+        conns = sum(len(getattr(reader, "conns", ()))
+                    for reader in self._readers.itervalues())
+        return conns + len(getattr(self._writer, "conns", ()))
 
     def _start_writer(self):
-        self._writer = nsq.Writer(self._nsqd_addresses,
-                                  reconnect_interval=10.0)
+        self._writer = WriterPool(self._nsqd_addresses,
+                                  self.stats,
+                                  clock=self._clock,
+                                  client=self._client,
+                                  **self._pool_options)
 
-    def subscribe(self, topic, callback):
+    def subscribe(self, topic, callback, msg_types=None):
         """
         Used to subscribe a callback to a topic.
         It will spin up a new :class:`nsq.Reader` for the given topic if one
         does not exist already and register the given callback with it.
-        Only one callback per topic exists.
+        Only one callback per topic exists. Every call takes a reference
+        on the topic which must be dropped with :meth:`release`.
 
         :param topic: a string which identifies the topic on which to listen.
         :type string:
@@ -228,63 +348,199 @@ class RemoteReadWriter(object):
             parsed body of the message (still available in raw from through
             the `body` attribute).
         :type callable:
+
+        :param msg_types: an optional list of message types that the
+            callback handles. Messages of other types are finished
+            without being decoded.
+        :type list:
         """
-        # Check if topic exists, if not - create it
-        # Check if channel exists, if not - create it
+        self._refs[topic] = self._refs.get(topic, 0) + 1
 
-        if not self._readers.get(topic, None):
-            _create_topic(topic, self._lookupd_addresses)
-            _create_channel(topic, self._server_name, self._lookupd_addresses)
+        eviction = self._evictions.pop(topic, None)
+        if eviction is not None:
+            eviction.cancel()
 
-            reader = nsq.Reader(message_handler=self.filter_callback(callback),
-                                lookupd_http_addresses=self._lookupd_addresses,
-                                topic=topic,
-                                channel=self._server_name,
-                                lookupd_poll_interval=5)
-            self._readers[topic] = reader
+        if topic not in self._topics:
+            self._topics[topic] = []
+            for ephemeral, types in self._classes(msg_types):
+                self._start_reader(topic, ephemeral, callback, types)
             log.msg("Subscribed on %s on %s" % (topic, self._server_name))
 
-    def filter_callback(self, callback):
+    def _classes(self, msg_types):
+        """
+        Returns the durability classes that a subscription to the
+        given message types consumes, as a list of ``(ephemeral,
+        msg_types)`` pairs.
+        """
+        if not self._ephemeral_types:
+            return [(False, msg_types)]
+        if not msg_types:
+            return [(False, None), (True, None)]
+
+        classes = []
+        for ephemeral in (False, True):
+            types = [t for t in msg_types
+                     if (t in self._ephemeral_types) == ephemeral]
+            if types:
+                classes.append((ephemeral, types))
+        return classes
+
+    def _start_reader(self, topic, ephemeral, callback, msg_types):
+        """
+        Starts the reader of one durability class of the topic.
+        """
+        nsq_topic, channel = topic, self._server_name
+        if ephemeral:
+            nsq_topic += EPHEMERAL
+            channel += EPHEMERAL
+
+        # Check if topic exists, if not - create it
+        # Check if channel exists, if not - create it
+        _create_topic(nsq_topic, self._lookupd_addresses)
+        _create_channel(nsq_topic, channel, self._lookupd_addresses)
+
+        handler = self.filter_callback(callback,
+                                       target=topic,
+                                       msg_types=msg_types)
+        max_in_flight = 1
+        if self._flow:
+            handler = self._flow.wrap(nsq_topic, handler)
+            max_in_flight = self._flow.share()
+
+        reader = self._client.Reader(
+            message_handler=handler,
+            lookupd_http_addresses=self._lookupd_addresses,
+            topic=nsq_topic,
+            channel=channel,
+            lookupd_poll_interval=5,
+            max_in_flight=max_in_flight)
+        self._readers[nsq_topic] = reader
+        self._topics[topic].append(nsq_topic)
+
+        if self._flow:
+            self._flow.register(nsq_topic, reader)
+
+    def filter_callback(self, callback, target=None, msg_types=None):
         """
         Decorator function which wraps the given callback in
         a filter that discards messages which originated from this server
-        instance server.
+        instance, messages meant for a different target and messages
+        of types the callback does not handle.
+        See :func:`ircdd.transport.filter_messages`.
 
         :param callback: the callback which will be wrapped
         :type callable:
+
+        :param target: an optional name of the user or group that
+            messages must be addressed to.
+        :type string:
+
+        :param msg_types: an optional list of accepted message types.
+        :type list:
         """
+        return filter_messages(callback, self._server_name,
+                               target=target, msg_types=msg_types,
+                               dedup=self._dedup, reorder=self._reorder)
 
-        def filtered_callback(message):
-            parsed_msg = json.loads(message.body)
+    def release(self, topic, delete_channel=False):
+        """
+        Drops a reference taken on the topic by :meth:`subscribe`.
+        When the last reference is dropped, the topic's reader is
+        closed after the grace period, unless the topic is subscribed
+        to again in the meantime.
 
-            if parsed_msg['origin'] == self._server_name:
-                message.finish()
-                return True
-            else:
-                message.parsed_msg = parsed_msg
-                return callback(message)
+        :param topic: the topic to release.
+        :type string:
+
+        :param delete_channel: if True, this server's channel on the
+            topic is deleted once the reader is closed.
+        :type bool:
+        """
+        refs = self._refs.get(topic, 0) - 1
+        if refs > 0:
+            self._refs[topic] = refs
+            return
 
-        return filtered_callback
+        self._refs.pop(topic, None)
+        if topic in self._topics and topic not in self._evictions:
+            self._evictions[topic] = self._clock.callLater(
+                self._reader_grace, self._evict, topic, delete_channel)
 
-    def unsubscribe(self, topic):
+    def _evict(self, topic, delete_channel):
+        """
+        Closes the reader of a topic which was left unreferenced
+        for the whole grace period.
+        """
+        del self._evictions[topic]
+        self.unsubscribe(topic, delete_channel)
+        self.stats.incr("remote.readers_evicted")
+
+    def unsubscribe(self, topic, delete_channel=False):
         """
         Unsubscribes a callback from the given topic and
-        shut down the reader.
+        shut down the reader immediately, regardless of
+        the references held on the topic.
 
         :param topic: the topic for which to stop listening.
         :type string:
+
+        :param delete_channel: if True, also schedules this server's
+            channel on the topic for deletion so that messages published
+            on it stop being queued for this server.
+        :type bool:
         """
-        self._readers[topic].close()
-        del self._readers[topic]
+        nsq_topics = self._topics.pop(topic)
+        self._refs.pop(topic, None)
+
+        for nsq_topic in nsq_topics:
+            self._readers.pop(nsq_topic).close()
+            if self._flow:
+                self._flow.unregister(nsq_topic)
+
+        eviction = self._evictions.pop(topic, None)
+        if eviction is not None:
+            eviction.cancel()
+
+        if self._reorder is not None:
+            self._reorder.forget(envelope.digest(topic))
+
+        if delete_channel:
+            # Ephemeral channels disappear with their last consumer
+            self._doomed_channels.update(t for t in nsq_topics
+                                         if not t.endswith(EPHEMERAL))
+            if self._cleanup is None:
+                self._cleanup = self._clock.callLater(
+                    self._cleanup_interval, self.delete_channels)
+
         log.msg("Unsubscribed from %s on %s" % (topic, self._server_name))
 
+    def delete_channels(self):
+        """
+        Deletes, in one batch, this server's channels on all the
+        topics scheduled for deletion which have not been subscribed
+        to again since.
+        """
+        if self._cleanup is not None and self._cleanup.active():
+            self._cleanup.cancel()
+        self._cleanup = None
+
+        doomed = self._doomed_channels
+        self._doomed_channels = set()
+
+        for topic in doomed:
+            if topic not in self._readers:
+                _delete_channel(topic, self._server_name,
+                                self._lookupd_addresses)
+                self.stats.incr("remote.channels_deleted")
+
     def publish(self, topic, msg_body, callback=None):
         """
         Publishes a message to the given queue and calls
-        the optional callback once completed. Creates the
-        writer if it does not exist. The message is wrapped in
-        a container dictionary that wears the origin tag,
-        json formatted, and then given to the writer.
+        the optional callback once completed. The message is wrapped in
+        an envelope (see :mod:`ircdd.envelope`) that wears the
+        origin, type and target in its header, and then put on the
+        outbound :class:`ircdd.spool.PublishQueue`, which hands it to
+        the writer and holds on to it until ``NSQD`` acknowledges it.
 
         :param topic: the name of the topic to publish to
         :type string:
@@ -293,18 +549,32 @@ class RemoteReadWriter(object):
         :type string:
 
         :param callback: an optional callback which will be
-            called once :method:`nsq.Writer.pub()` completes.
-            Defaults to a logging callback.
+            called without arguments once ``NSQD`` acknowledges
+            the message.
         :type callable:
         """
 
-        msg = dict(msg_body=msg_body, origin=self._server_name)
+        msg = envelope.pack(self._server_name, topic, msg_body,
+                            compressor=self._compressor,
+                            sequencer=self._sequencer)
+
+        if msg_body.get("type") in self._ephemeral_types:
+            topic += EPHEMERAL
+            self.stats.incr("remote.published_ephemeral")
+
+        self._queue.put(topic, msg, callback)
 
+    def _send(self, topic, msg, done):
+        """
+        Hands a serialized message from the outbound queue
+        to the writer.
+        """
         def finish_pub(conn, data):
-            if isinstance(data, nsq.Error):
+            if isinstance(data, self._client.Error):
                 log.err("NSQ Error: on %s, data is %s" %
                         (conn, data))
-        if not callback:
-            callback = finish_pub
+                done(False)
+            else:
+                done(True)
 
-        self._writer.pub(topic, json.dumps(msg), callback=callback)
+        self._writer.pub(topic, msg, callback=finish_pub)
@@ -0,0 +1,184 @@
+"""
+This module contains the buffer which puts the messages received
+from each origin back in the order in which they were published.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+
+HELD = object()
+DUPLICATE = object()
+
+
+class _Stream(object):
+    """
+    The messages of a single origin on a single topic.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.pending = {}
+        self.timer = None
+
+
+class ReorderBuffer(object):
+    """
+    Delivers the messages of each stream (an origin's messages on a
+    topic) in the order of their sequence numbers.
+
+    A message which arrives ahead of its predecessors is held until
+    they arrive, for at most ``timeout`` seconds; the missing messages
+    are then given up on and counted as a gap, as they are when more
+    than ``max_pending`` messages of a stream are held. A message which
+    arrives after its stream has moved past it is delivered right away
+    and counted as late. At most ``max_streams`` streams are tracked;
+    the least recently active one is flushed and dropped to make room
+    for a new one.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the reorder counters and gauges.
+
+    :param timeout: the number of seconds for which a message is held.
+    :type float:
+
+    :param max_pending: the number of messages that may be held for a
+        single stream.
+    :type int:
+
+    :param max_streams: the number of streams tracked.
+    :type int:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for scheduling. Defaults to the reactor.
+    """
+
+    def __init__(self, stats, timeout=0.5, max_pending=100,
+                 max_streams=10000, clock=None):
+        self.stats = stats
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_streams = max_streams
+        self._clock = clock or reactor
+
+        self._streams = OrderedDict()
+        self._pending = 0
+
+        self.stats.gauge("reorder.pending", lambda: self._pending)
+        self.stats.gauge("reorder.streams", lambda: len(self._streams))
+
+    def receive(self, key, seq, deliver):
+        """
+        Delivers the message now if it is the next of its stream, along
+        with the held messages which follow it, or holds it.
+
+        Returns the result of ``deliver`` if the message was delivered,
+        :data:`HELD` if it is held, or :data:`DUPLICATE` if a message
+        with the same sequence number is already held.
+
+        :param key: the stream of the message.
+
+        :param seq: the sequence number of the message in its stream.
+        :type int:
+
+        :param deliver: a callable which delivers the message.
+        """
+        stream = self._streams.pop(key, None)
+        if stream is None:
+            if len(self._streams) >= self.max_streams:
+                self._evict()
+            stream = _Stream(seq)
+        self._streams[key] = stream
+
+        if seq < stream.expected:
+            self.stats.incr("reorder.late")
+            return deliver()
+
+        if seq == stream.expected:
+            stream.expected += 1
+            result = deliver()
+            self._drain(key, stream)
+            return result
+
+        if seq in stream.pending:
+            return DUPLICATE
+
+        stream.pending[seq] = deliver
+        self._pending += 1
+        self.stats.incr("reorder.held")
+
+        if len(stream.pending) > self.max_pending:
+            self._skip(key, stream)
+        else:
+            self._schedule(key, stream)
+        return HELD
+
+    def _drain(self, key, stream):
+        """
+        Delivers the held messages which are next in the stream.
+        """
+        while stream.expected in stream.pending:
+            deliver = stream.pending.pop(stream.expected)
+            self._pending -= 1
+            stream.expected += 1
+            deliver()
+        self._schedule(key, stream)
+
+    def _schedule(self, key, stream):
+        if not stream.pending:
+            if stream.timer is not None:
+                stream.timer.cancel()
+                stream.timer = None
+        elif stream.timer is None:
+            stream.timer = self._clock.callLater(self.timeout,
+                                                 self._expire, key)
+
+    def _skip(self, key, stream):
+        """
+        Gives up on the messages missing before the first held one.
+        """
+        first = min(stream.pending)
+        self.stats.incr("reorder.gaps", first - stream.expected)
+        stream.expected = first
+        self._drain(key, stream)
+
+    def _expire(self, key):
+        stream = self._streams.get(key)
+        if stream is None:
+            return
+        stream.timer = None
+        if stream.pending:
+            self._skip(key, stream)
+
+    def forget(self, target):
+        """
+        Flushes and drops the streams of every origin to the target,
+        once its topic is released: the origins keep numbering the
+        messages they publish meanwhile, so a stream picked up again
+        later must start from the first message then received rather
+        than wait for the ones missed.
+
+        :param target: the target digest, as carried in the keys
+            ``(stream, target)`` given to :meth:`receive`.
+        """
+        for key in [key for key in self._streams if key[1] == target]:
+            self._flush(self._streams.pop(key))
+
+    def _evict(self):
+        """
+        Flushes and drops the least recently active stream.
+        """
+        key, stream = self._streams.popitem(last=False)
+        self._flush(stream)
+
+    def _flush(self, stream):
+        """
+        Delivers the held messages of a dropped stream.
+        """
+        if stream.timer is not None:
+            stream.timer.cancel()
+            stream.timer = None
+        for seq in sorted(stream.pending):
+            self._pending -= 1
+            stream.pending.pop(seq)()
@@ -0,0 +1,137 @@
+"""
+This module contains the routing table which maps the nicknames of
+the users connected anywhere in the cluster to their server nodes.
+"""
+
+from twisted.internet import reactor, threads
+
+
+class RoutingTable(object):
+    """
+    A map from nicknames to the server nodes the users are connected
+    to. It is loaded from the ``user_sessions`` table and kept up to
+    date by the changefeed of the table, so users can be located
+    without querying the database.
+
+    Every session heartbeat confirms its route. A route which was not
+    confirmed for ``max_age`` seconds belongs to a session which is no
+    longer active, e.g. because its node went down, and is not used.
+    Sessions written by nodes which do not record their ``node`` have
+    no route.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the routing counters and gauges.
+
+    :param max_age: the number of seconds after which an unconfirmed
+        route is not used.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    def __init__(self, stats, max_age=30.0, clock=None):
+        self.stats = stats
+        self.max_age = max_age
+        self._clock = clock or reactor
+
+        # A callable taking the nickname of a user whose session ended.
+        self.removed = None
+
+        self._routes = {}
+
+        self.stats.gauge("routes.size", lambda: len(self._routes))
+        self.stats.gauge("routes.staleness_ms", self.staleness)
+        self.stats.gauge("routes.miss_rate", self.missRate)
+
+    def staleness(self):
+        """
+        Returns the number of milliseconds since the least recently
+        confirmed route was confirmed.
+        """
+        if not self._routes:
+            return 0
+        oldest = min(confirmed for _, confirmed in self._routes.itervalues())
+        return int((self._clock.seconds() - oldest) * 1000)
+
+    def missRate(self):
+        """
+        Returns the share of the lookups which found no usable route.
+        """
+        hits = self.stats.counters["routes.hits"]
+        misses = self.stats.counters["routes.misses"]
+        return float(misses) / ((hits + misses) or 1)
+
+    def apply(self, change):
+        """
+        Updates the routes with a change of the ``user_sessions``
+        changefeed.
+
+        :param change: a dict with the ``old_val`` and ``new_val`` of
+            a session.
+        :type dict:
+        """
+        self.stats.incr("routes.changes")
+        session = change.get("new_val")
+
+        if session is None:
+            name = (change.get("old_val") or {}).get("id")
+            if name is not None:
+                self._routes.pop(name, None)
+                if self.removed is not None:
+                    self.removed(name)
+        elif session.get("node"):
+            self._routes[session["id"]] = (session["node"],
+                                           self._clock.seconds())
+        else:
+            self._routes.pop(session["id"], None)
+
+    def route(self, name):
+        """
+        Returns the server node to which the user is connected, or
+        None if the user has no usable route.
+
+        :param name: the nickname of the user.
+        :type string:
+        """
+        entry = self._routes.get(name)
+        if entry is None or (self._clock.seconds() - entry[1] >=
+                             self.max_age):
+            self.stats.incr("routes.misses")
+            return None
+
+        self.stats.incr("routes.hits")
+        return entry[0]
+
+    def purge(self):
+        """
+        Drops the routes which have not been confirmed for
+        ``max_age`` seconds.
+        """
+        deadline = self._clock.seconds() - self.max_age
+        for name, (_, confirmed) in self._routes.items():
+            if confirmed <= deadline:
+                del self._routes[name]
+
+    def start(self, db):
+        """
+        Starts following the ``user_sessions`` changefeed in a thread.
+
+        :param db: the :class:`ircdd.database.IRCDDatabase` to follow.
+        """
+        return threads.deferToThread(self._observe, db)
+
+    def _observe(self, db):
+        """
+        Continuously processes the stream of session changes.
+        In order to join with the reactor thread on SIGINT
+        a callback forcefully closes the changeset's connection.
+        """
+        changeset = db.observeUserSessions()
+
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      changeset.conn.close,
+                                      False)
+
+        for change in changeset:
+            reactor.callFromThread(self.apply, change)
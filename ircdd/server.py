@@ -1,9 +1,21 @@
-from twisted.application import internet
-from twisted.internet import protocol
+from twisted.application import internet, service
+from twisted.internet import protocol, reactor
 
+from ircdd.mesh import MeshServerFactory
+from ircdd.output import OutputBuffer
 from ircdd.protocol import IRCDDUser
 
 
+def _bufferedBytes(transport):
+    """
+    Returns the number of bytes queued for the client by its output
+    buffer (see :meth:`ircdd.output.OutputBuffer.queued`).
+    """
+    if isinstance(transport, OutputBuffer):
+        return transport.queued()
+    return 0
+
+
 class IRCDDFactory(protocol.ServerFactory):
     """
     Factory which creates instances of the :class:`ircdd.server.IRCDDUser`
@@ -22,6 +34,13 @@ class IRCDDFactory(protocol.ServerFactory):
         self.realm = ctx['realm']
         self.portal = ctx['portal']
         self._serverInfo = ctx['server_info']
+        self.clients = set()
+
+        ctx['stats'].gauge("output.writes_per_line", self.writesPerLine)
+        ctx['stats'].gauge("output.congested", lambda: sum(
+            1 for client in self.clients
+            if getattr(client.transport, "paused", False)))
+        ctx['stats'].gauge("output.sendq_top", self.largestSendQueues)
 
     def buildProtocol(self, addr):
         """
@@ -31,8 +50,44 @@ class IRCDDFactory(protocol.ServerFactory):
         p = self.protocol()
         p.factory = self
         p.ctx = self.ctx
+        self.clients.add(p)
         return p
 
+    def writesPerLine(self):
+        """
+        Returns the number of writes handed to the client transports
+        per line written to the clients.
+        """
+        counters = self.ctx['stats'].counters
+        return (float(counters["output.writes"]) /
+                (counters["output.lines"] or 1))
+
+    def sendQueues(self):
+        """
+        Returns a dict mapping the nicknames of the connected clients
+        to the number of bytes queued for them.
+        """
+        return dict((client.name, _bufferedBytes(client.transport))
+                    for client in self.clients if client.transport)
+
+    def largestSendQueues(self, count=5):
+        """
+        Returns the clients with the largest send queues, as a string
+        of ``nickname:bytes`` pairs.
+        """
+        queues = sorted(self.sendQueues().iteritems(),
+                        key=lambda (name, size): size, reverse=True)
+        return ",".join("%s:%s" % (name, size)
+                        for name, size in queues[:count] if size)
+
+    def bufferedBytes(self):
+        """
+        Returns the number of bytes buffered for all connected
+        clients.
+        """
+        return sum(_bufferedBytes(client.transport)
+                   for client in self.clients if client.transport)
+
 
 def makeServer(ctx):
     """
@@ -47,6 +102,81 @@ def makeServer(ctx):
     """
     f = IRCDDFactory(ctx)
     IRCDDUser.ctx = ctx
+    ctx['flow'].pressure = f.bufferedBytes
 
     irc_server = internet.TCPServer(int(ctx['port']), f)
     return irc_server
+
+
+def makeStatsReporter(ctx):
+    """
+    Creates a service which periodically logs the server's
+    counters and gauges, every `stats_interval` seconds.
+
+    :param ctx: a :class:`ircdd.context.ConfigStore` object that
+        contains both the raw config values and the initialized shared
+        drivers.
+    """
+    return internet.TimerService(float(ctx['stats_interval']),
+                                 ctx['stats'].report)
+
+
+def makeFlowController(ctx):
+    """
+    Creates a service which periodically adjusts the in-flight
+    limits of the ``NSQ`` readers to the load of the server,
+    every `flow_interval` seconds.
+
+    :param ctx: a :class:`ircdd.context.ConfigStore` object that
+        contains both the raw config values and the initialized shared
+        drivers.
+    """
+    return internet.TimerService(ctx['flow'].interval, ctx['flow'].adjust)
+
+
+def makeTimingWheel(ctx):
+    """
+    Creates a service which advances the node's timing wheel,
+    every `wheel_tick` seconds.
+
+    :param ctx: a :class:`ircdd.context.ConfigStore` object that
+        contains both the raw config values and the initialized shared
+        drivers.
+    """
+    return internet.TimerService(ctx['wheel'].tick, ctx['wheel'].advance)
+
+
+def makeRoutingTable(ctx):
+    """
+    Creates a service which drops the routes of inactive sessions
+    from the node's routing table, every `routes_max_age` seconds.
+    The table starts following the session changes once the reactor
+    runs.
+
+    :param ctx: a :class:`ircdd.context.ConfigStore` object that
+        contains both the raw config values and the initialized shared
+        drivers.
+    """
+    routes = ctx['routes']
+    reactor.callWhenRunning(routes.start, ctx['db'])
+    return internet.TimerService(routes.max_age, routes.purge)
+
+
+def makeMeshService(ctx):
+    """
+    Creates a service which accepts connections from the other
+    server nodes on `mesh_port` and looks them up every
+    `mesh_discovery_interval` seconds, for the mesh transport.
+
+    :param ctx: a :class:`ircdd.context.ConfigStore` object that
+        contains both the raw config values and the initialized shared
+        drivers.
+    """
+    mesh = ctx['node_transport']
+
+    mesh_service = service.MultiService()
+    internet.TCPServer(mesh.port,
+                       MeshServerFactory(mesh)).setServiceParent(mesh_service)
+    internet.TimerService(mesh.discovery_interval,
+                          mesh.discover).setServiceParent(mesh_service)
+    return mesh_service
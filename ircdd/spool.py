@@ -0,0 +1,319 @@
+"""
+This module contains the outbound queue which holds published
+messages until ``NSQD`` has acknowledged them.
+"""
+
+import os
+import struct
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+# topic length, data length
+RECORD = struct.Struct("!HI")
+
+
+class PublishQueue(object):
+    """
+    A bounded, ordered queue of outbound messages.
+
+    Messages are kept in memory until they are acknowledged. Once the
+    memory budget is used up, further messages are appended to an
+    on-disk log and read back, in order, as the memory queue drains.
+    A message that fails to be sent (e.g. because ``NSQD`` is down) is
+    put back at the head of the queue and retried, along with everything
+    queued after it, once the publisher is connected again.
+    The on-disk log survives restarts: a log left over by a previous
+    run is replayed first.
+
+    :param send: a callable taking a topic, the serialized message and
+        a completion callback, which it must call with ``True`` once the
+        message is acknowledged or ``False`` if sending failed.
+    :type callable:
+
+    :param connected: a callable which returns True while messages can
+        be sent.
+    :type callable:
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the queue counters and gauges.
+
+    :param memory_limit: the number of bytes that may be held in memory,
+        including the messages awaiting acknowledgement.
+    :type int:
+
+    :param spool_path: the path of the on-disk log. If None, messages
+        which do not fit in memory are dropped.
+    :type string:
+
+    :param spool_limit: the maximum size of the on-disk log in bytes.
+    :type int:
+
+    :param window: the maximum number of unacknowledged messages.
+    :type int:
+
+    :param retry_interval: seconds to wait before retrying after a
+        failure.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for scheduling. Defaults to the reactor.
+    """
+
+    def __init__(self, send, connected, stats, memory_limit=8 * 1024 * 1024,
+                 spool_path=None, spool_limit=1024 * 1024 * 1024,
+                 window=1000, retry_interval=1.0, clock=None):
+        self._send = send
+        self._connected = connected
+        self.stats = stats
+        self.memory_limit = memory_limit
+        self.spool_path = spool_path
+        self.spool_limit = spool_limit
+        self.window = window
+        self.retry_interval = retry_interval
+        self._clock = clock or reactor
+
+        self._memory = deque()
+        self._memory_bytes = 0
+        self._unacked = {}
+        self._failed = {}
+        self._seq = 0
+        self._retry = None
+        self._flushing = False
+
+        self._spool_in = None
+        self._spool_out = None
+        self._spool_records = 0
+        self._spool_written = 0
+        self._spool_read = 0
+        self._spool_read_records = 0
+        self._spool_callbacks = {}
+
+        if spool_path and os.path.exists(spool_path):
+            self._recoverSpool()
+
+        self.stats.gauge("publish.queue_depth", self.depth)
+        self.stats.gauge("publish.queue_bytes", lambda: self._memory_bytes)
+        self.stats.gauge("publish.spool_records",
+                         lambda: self._spool_records)
+        self.stats.gauge("publish.spool_bytes", self.spoolBytes)
+
+    def depth(self):
+        """
+        Returns the number of messages which have not been
+        acknowledged yet, both in memory and on disk.
+        """
+        return (len(self._memory) + len(self._unacked) + len(self._failed) +
+                self._spool_records)
+
+    def spoolBytes(self):
+        """
+        Returns the number of bytes in the on-disk log which have not
+        been read back yet.
+        """
+        return self._spool_written - self._spool_read
+
+    def put(self, topic, data, callback=None):
+        """
+        Queues a message for publishing and tries to send it.
+
+        :param topic: the topic to publish the message on.
+        :type string:
+
+        :param data: the serialized message.
+        :type string:
+
+        :param callback: an optional callable to call without arguments
+            once the message is acknowledged.
+        :type callable:
+        """
+        size = len(data)
+
+        if (not self._spool_records and
+                self._memory_bytes + size <= self.memory_limit):
+            self._memory.append((topic, data, callback))
+            self._memory_bytes += size
+        elif self.spool_path and self.spoolBytes() < self.spool_limit:
+            self._spill(topic, data, callback)
+        else:
+            log.err("Outbound queue full, dropping message for %s" % topic)
+            self.stats.incr("publish.dropped")
+            return
+
+        self.flush()
+
+    def flush(self):
+        """
+        Sends queued messages until the window of unacknowledged
+        messages is full. If the publisher is not connected, or a
+        previous send failed, a retry is scheduled instead.
+        """
+        if self._failed or self._retry is not None or self._flushing:
+            return
+
+        if not self._connected():
+            if self.depth():
+                self._scheduleRetry()
+            return
+
+        # Sends may complete synchronously; the guard keeps their
+        # completion callbacks from flushing recursively.
+        self._flushing = True
+        try:
+            while not self._failed and len(self._unacked) < self.window:
+                if not self._memory and not self._unspill():
+                    break
+
+                topic, data, callback = self._memory.popleft()
+                self._seq += 1
+                seq = self._seq
+                self._unacked[seq] = (topic, data, callback)
+
+                self._send(topic, data,
+                           lambda ok, seq=seq: self._done(seq, ok))
+        finally:
+            self._flushing = False
+
+    def _done(self, seq, ok):
+        """
+        Completion callback for a single message.
+        """
+        entry = self._unacked.pop(seq)
+
+        if ok:
+            self._memory_bytes -= len(entry[1])
+            if entry[2] is not None:
+                entry[2]()
+        else:
+            self._failed[seq] = entry
+
+        if self._failed:
+            if not self._unacked:
+                # Every outstanding send has completed; put the failed
+                # messages back at the head of the queue, in order.
+                for seq in sorted(self._failed, reverse=True):
+                    self._memory.appendleft(self._failed[seq])
+                self.stats.incr("publish.retries", len(self._failed))
+                self._failed = {}
+                self._scheduleRetry()
+        else:
+            self.flush()
+
+    def _scheduleRetry(self):
+        if self._retry is None:
+            self._retry = self._clock.callLater(self.retry_interval,
+                                                self._retryFlush)
+
+    def _retryFlush(self):
+        self._retry = None
+        self.flush()
+
+    def _spill(self, topic, data, callback):
+        """
+        Appends a message to the on-disk log.
+        """
+        if self._spool_out is None:
+            self._spool_out = open(self.spool_path, "ab")
+
+        if isinstance(topic, unicode):
+            topic = topic.encode("utf8")
+
+        self._spool_out.write(RECORD.pack(len(topic), len(data)))
+        self._spool_out.write(topic)
+        self._spool_out.write(data)
+
+        if callback is not None:
+            index = self._spool_read_records + self._spool_records
+            self._spool_callbacks[index] = callback
+
+        self._spool_records += 1
+        self._spool_written += RECORD.size + len(topic) + len(data)
+        self.stats.incr("publish.spilled")
+
+    def _unspill(self):
+        """
+        Moves messages from the on-disk log back to memory while they
+        fit in the memory budget. Returns True if any were moved.
+        """
+        if not self._spool_records:
+            return False
+
+        moved = False
+
+        if self._spool_out is not None:
+            self._spool_out.flush()
+
+        while self._spool_records:
+            if self._spool_in is None:
+                self._spool_in = open(self.spool_path, "rb")
+                self._spool_in.seek(self._spool_read)
+
+            header = self._spool_in.read(RECORD.size)
+            topic_len, data_len = RECORD.unpack(header)
+            if (moved and
+                    self._memory_bytes + data_len > self.memory_limit):
+                self._spool_in.seek(self._spool_read)
+                break
+
+            topic = self._spool_in.read(topic_len).decode("utf8")
+            data = self._spool_in.read(data_len)
+            callback = self._spool_callbacks.pop(self._spool_read_records,
+                                                 None)
+
+            self._memory.append((topic, data, callback))
+            self._memory_bytes += data_len
+            self._spool_records -= 1
+            self._spool_read_records += 1
+            self._spool_read += RECORD.size + topic_len + data_len
+            self.stats.incr("publish.replayed")
+            moved = True
+
+        if not self._spool_records:
+            self._truncateSpool()
+
+        return moved
+
+    def _truncateSpool(self):
+        """
+        Empties the on-disk log once every record has been read back.
+        """
+        for spool in (self._spool_in, self._spool_out):
+            if spool is not None:
+                spool.close()
+        self._spool_in = self._spool_out = None
+
+        if self.spool_path and os.path.exists(self.spool_path):
+            open(self.spool_path, "wb").close()
+
+        self._spool_written = self._spool_read = 0
+        self._spool_read_records = 0
+
+    def _recoverSpool(self):
+        """
+        Counts the complete records of an on-disk log left over by a
+        previous run so that they are replayed. A record truncated by a
+        crash is discarded.
+        """
+        size = os.path.getsize(self.spool_path)
+        offset = 0
+
+        with open(self.spool_path, "rb") as spool:
+            while offset + RECORD.size <= size:
+                topic_len, data_len = RECORD.unpack(spool.read(RECORD.size))
+                end = offset + RECORD.size + topic_len + data_len
+                if end > size:
+                    break
+                spool.seek(end)
+                offset = end
+                self._spool_records += 1
+
+        if offset < size:
+            with open(self.spool_path, "r+b") as spool:
+                spool.truncate(offset)
+
+        self._spool_written = offset
+        if self._spool_records:
+            log.msg("Replaying %s spooled messages from %s" %
+                    (self._spool_records, self.spool_path))
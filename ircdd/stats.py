@@ -0,0 +1,66 @@
+"""
+This module contains the counters and gauges which the server
+maintains about its own operation.
+"""
+
+from collections import defaultdict
+
+from twisted.python import log
+
+
+class Stats(object):
+    """
+    A registry of named counters and gauges shared by the
+    components of a server instance.
+    Counters are incremented by the components as events happen;
+    gauges are callables which are sampled whenever a snapshot
+    is taken.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+
+    def incr(self, name, amount=1):
+        """
+        Increments the given counter.
+
+        :param name: the name of the counter.
+        :type string:
+
+        :param amount: the amount by which to increment.
+        :type int:
+        """
+        self.counters[name] += amount
+
+    def gauge(self, name, sample):
+        """
+        Registers a gauge under the given name, replacing any
+        gauge previously registered under it.
+
+        :param name: the name of the gauge.
+        :type string:
+
+        :param sample: a callable which takes no arguments and
+            returns the current value of the gauge.
+        :type callable:
+        """
+        self.gauges[name] = sample
+
+    def snapshot(self):
+        """
+        Returns a dict mapping the names of all counters and
+        gauges to their current values.
+        """
+        values = dict(self.counters)
+        for name, sample in self.gauges.iteritems():
+            values[name] = sample()
+        return values
+
+    def report(self):
+        """
+        Logs the current values of all counters and gauges.
+        """
+        values = self.snapshot()
+        log.msg("Stats: %s" % ", ".join("%s=%s" % (name, values[name])
+                                        for name in sorted(values)))
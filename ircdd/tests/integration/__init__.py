@@ -15,6 +15,7 @@ def setUp():
     r.db(DB).table_create("groups").run(conn)
     r.db(DB).table_create("user_sessions").run(conn)
     r.db(DB).table_create("group_states").run(conn)
+    r.db(DB).table_create("nodes").run(conn)
     conn.close()
 
 
@@ -32,4 +33,5 @@ def cleanTables():
     r.db(DB).table("groups").delete().run(conn)
     r.db(DB).table("user_sessions").delete().run(conn)
     r.db(DB).table("group_states").delete().run(conn)
+    r.db(DB).table("nodes").delete().run(conn)
     conn.close()
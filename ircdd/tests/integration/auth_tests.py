@@ -74,6 +74,7 @@ class TestIRCDDAuth:
         self.conn.close()
 
     def getResponse(self, protocol):
+        protocol.transport.flush()
         response = protocol.transport.value().splitlines()
         protocol.transport.clear()
         return map(irc.parsemsg, response)
@@ -348,6 +348,33 @@ class TestIRCDDatabase():
         result = self.db.heartbeatUserSession("test_user")
         assert result["replaced"] == 1
 
+    def test_observesUserSessions(self):
+        self.db.heartbeatUserSession("test_user", "node1")
+
+        changes = self.db.observeUserSessions()
+        initial = changes.next()
+        assert initial["new_val"]["id"] == "test_user"
+        assert initial["new_val"]["node"] == "node1"
+
+        self.db.removeUserSession("test_user")
+        change = changes.next()
+        assert change["old_val"]["id"] == "test_user"
+        assert change["new_val"] is None
+        changes.close()
+
+    def test_heartbeatsNode(self):
+        result = self.db.heartbeatNode("node1", "10.0.0.1", 5800)
+        assert result["inserted"] == 1
+
+        result = self.db.heartbeatNode("node1", "10.0.0.2", 5800)
+        assert result["replaced"] == 1
+
+        nodes = self.db.listNodes()
+        assert nodes == [{"id": "node1", "host": "10.0.0.2", "port": 5800}]
+
+        self.db.removeNode("node1")
+        assert self.db.listNodes() == []
+
     def test_heartbeatUserInGroup(self):
         # Creates initial heartbeat
         result = self.db.heartbeatUserInGroup("test_user", "test_group")
@@ -67,6 +67,7 @@ class TestMessaging():
         self.conn.close()
 
     def getResponse(self, protocol):
+        protocol.transport.flush()
         response = protocol.transport.value().splitlines()
         protocol.transport.clear()
         return map(irc.parsemsg, response)
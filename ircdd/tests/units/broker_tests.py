@@ -0,0 +1,192 @@
+from twisted.internet import task
+
+from ircdd.broker import LocalBroker, LocalReader, LocalReadWriter
+from ircdd.dedup import Deduplicator
+from ircdd.reorder import ReorderBuffer
+from ircdd.stats import Stats
+from ircdd.transport import ITransport
+
+
+class TestLocalBroker:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.broker = LocalBroker(msg_timeout=10.0, clock=self.clock)
+        self.received = []
+
+    def handler(self, result=None):
+        def handle(message):
+            self.received.append(message)
+            return result
+        return handle
+
+    def testDeliversAsynchronously(self):
+        channel = self.broker.channel("topic", "node1")
+        LocalReader(channel, self.handler(True))
+
+        self.broker.publish("topic", "msg")
+        assert self.received == []
+
+        self.clock.advance(0)
+        assert [m.body for m in self.received] == ["msg"]
+        assert self.broker.depth() == 0
+        assert self.broker.inFlight() == 0
+
+    def testCopiesToEveryChannel(self):
+        LocalReader(self.broker.channel("topic", "node1"), self.handler(True))
+        LocalReader(self.broker.channel("topic", "node2"), self.handler(True))
+
+        self.broker.publish("topic", "msg")
+        self.clock.advance(0)
+
+        assert len(self.received) == 2
+
+    def testKeepsMessagesUntilFirstChannel(self):
+        self.broker.publish("topic", "msg")
+        assert self.broker.depth() == 1
+
+        LocalReader(self.broker.channel("topic", "node1"), self.handler(True))
+        self.clock.advance(0)
+
+        assert [m.body for m in self.received] == ["msg"]
+
+    def testHonoursMaxInFlight(self):
+        reader = LocalReader(self.broker.channel("topic", "node1"),
+                             self.handler(), max_in_flight=2)
+        for i in range(5):
+            self.broker.publish("topic", "msg%s" % i)
+        self.clock.advance(0)
+
+        assert len(self.received) == 2
+        assert self.broker.inFlight() == 2
+
+        self.received[0].finish()
+        self.clock.advance(0)
+        assert len(self.received) == 3
+
+        reader.max_in_flight = 10
+        self.received[1].finish()
+        self.clock.advance(0)
+        assert [m.body for m in self.received] == ["msg%s" % i
+                                                   for i in range(5)]
+
+    def testRedeliversRequeuedAndExpiredMessages(self):
+        LocalReader(self.broker.channel("topic", "node1"), self.handler())
+        self.broker.publish("topic", "msg")
+        self.clock.advance(0)
+
+        self.received[0].requeue()
+        self.clock.advance(0)
+        assert len(self.received) == 2
+        assert self.received[1].attempts == 2
+
+        self.clock.advance(10.0)
+        self.clock.advance(0)
+        assert len(self.received) == 3
+        assert self.broker.stats.counters["broker.timeouts"] == 1
+
+    def testHoldsMessagesWhileDisabled(self):
+        reader = LocalReader(self.broker.channel("topic", "node1"),
+                             self.handler(True))
+        reader.disabled = lambda: True
+        self.broker.publish("topic", "msg")
+        self.clock.advance(0)
+        assert self.received == []
+
+        reader.disabled = lambda: False
+        self.clock.advance(self.broker.poll_interval)
+        assert len(self.received) == 1
+
+    def testDeletedChannelStopsQueueing(self):
+        LocalReader(self.broker.channel("topic", "node1"), self.handler(True))
+        LocalReader(self.broker.channel("topic", "node2"), self.handler(True))
+        self.broker.deleteChannel("topic", "node2")
+
+        self.broker.publish("topic", "msg")
+        self.clock.advance(0)
+
+        assert len(self.received) == 1
+
+
+class TestLocalReadWriter:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.broker = LocalBroker(clock=self.clock)
+        self.node1 = LocalReadWriter(self.broker, "node1", clock=self.clock)
+        self.node2 = LocalReadWriter(self.broker, "node2", clock=self.clock)
+        self.received = []
+
+    def callback(self, message):
+        self.received.append(message.parsed_msg)
+        message.finish()
+        return True
+
+    def testProvidesTransport(self):
+        assert ITransport.providedBy(self.node1)
+
+    def testExchangesMessagesBetweenNodes(self):
+        self.node1.subscribe("user", self.callback)
+        self.node2.subscribe("user", self.callback)
+
+        self.node1.publish("user", {"text": "hi"})
+        self.clock.advance(0)
+
+        assert [(m["msg_body"], m["origin"]) for m in self.received] == \
+            [({"text": "hi"}, "node1")]
+
+    def testFiltersMessageTypes(self):
+        self.node2.subscribe("user", self.callback, msg_types=["privmsg"])
+
+        self.node1.publish("user", {"type": "join"})
+        self.node1.publish("user", {"type": "privmsg"})
+        self.clock.advance(0)
+
+        assert [m["msg_body"]["type"] for m in self.received] == ["privmsg"]
+
+    def testReleaseClosesReaderAfterGrace(self):
+        self.node2.subscribe("user", self.callback)
+        self.node2.release("user", delete_channel=True)
+        assert "user" in self.node2._readers
+
+        self.clock.advance(30.0)
+        assert "user" not in self.node2._readers
+
+        self.node1.publish("user", {"text": "hi"})
+        self.clock.advance(0)
+        assert self.received == []
+
+    def testDropsRedeliveredMessages(self):
+        stats = Stats()
+        node = LocalReadWriter(self.broker, "node3", clock=self.clock,
+                               dedup=Deduplicator(stats, clock=self.clock))
+
+        def slow(message):
+            # Handled, but finished too late
+            self.received.append(message.parsed_msg)
+
+        node.subscribe("user", slow)
+        self.node1.publish("user", {"text": "hi"})
+        self.clock.advance(0)
+        self.clock.advance(self.broker.msg_timeout)
+        self.clock.advance(0)
+
+        assert len(self.received) == 1
+        assert stats.counters["dedup.duplicates"] == 1
+
+    def testSequencesEachNodeSeparately(self):
+        stats = Stats()
+        node = LocalReadWriter(self.broker, "node3", clock=self.clock,
+                               reorder=ReorderBuffer(stats, clock=self.clock))
+        node.subscribe("chan", self.callback)
+
+        for n in range(3):
+            self.node1.publish("chan", {"n": n})
+            self.node2.publish("chan", {"n": n})
+            node.publish("chan", {"n": n})
+        self.clock.advance(0)
+
+        assert [(m["origin"], m["msg_body"]["n"]) for m in self.received] == \
+            [("node1", 0), ("node2", 0), ("node1", 1), ("node2", 1),
+             ("node1", 2), ("node2", 2)]
+        assert stats.counters["reorder.held"] == 0
@@ -0,0 +1,38 @@
+from ircdd.compression import Compressor
+from ircdd.stats import Stats
+
+
+class TestCompressor:
+
+    def setUp(self):
+        self.stats = Stats()
+        self.compressor = Compressor(self.stats,
+                                     thresholds={"privmsg": 100,
+                                                 "join": None},
+                                     default_threshold=1000)
+
+    def testCompressesFromThreshold(self):
+        body, compressed = self.compressor.compress("privmsg", "a" * 99)
+        assert not compressed
+
+        body, compressed = self.compressor.compress("privmsg", "a" * 100)
+        assert compressed
+        assert len(body) < 100
+
+    def testThresholdPerMessageType(self):
+        assert not self.compressor.compress("join", "a" * 5000)[1]
+        assert not self.compressor.compress("part", "a" * 500)[1]
+        assert self.compressor.compress("part", "a" * 1000)[1]
+
+    def testKeepsIncompressibleBodies(self):
+        body = "".join(chr(i) for i in range(256))
+        assert self.compressor.compress("privmsg", body) == (body, False)
+        assert self.stats.counters["compress.incompressible"] == 1
+
+    def testReportsRatio(self):
+        assert self.compressor.ratio() == 1.0
+
+        self.compressor.compress("privmsg", "a" * 1000)
+
+        assert self.stats.counters["compress.bytes_in"] == 1000
+        assert self.stats.snapshot()["compress.ratio"] < 0.1
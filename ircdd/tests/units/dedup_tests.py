@@ -0,0 +1,39 @@
+from twisted.internet import task
+
+from ircdd.dedup import Deduplicator
+from ircdd.stats import Stats
+
+
+class TestDeduplicator:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.dedup = Deduplicator(self.stats, window=10.0, max_entries=4,
+                                  clock=self.clock)
+
+    def testDetectsDuplicates(self):
+        assert not self.dedup.seen("a")
+        self.dedup.add("a")
+
+        assert self.dedup.seen("a")
+        assert not self.dedup.seen("b")
+        assert self.stats.counters["dedup.duplicates"] == 1
+        assert self.stats.counters["dedup.checked"] == 3
+
+    def testForgetsAfterWindow(self):
+        self.dedup.add("a")
+
+        self.clock.advance(5.0)
+        assert self.dedup.seen("a")
+
+        self.clock.advance(5.0)
+        assert not self.dedup.seen("a")
+
+    def testStaysWithinBudget(self):
+        for i in range(20):
+            self.dedup.add(i)
+
+        assert self.stats.snapshot()["dedup.entries"] <= 4
+        assert self.dedup.seen(19)
+        assert self.stats.counters["dedup.early_rotations"] > 0
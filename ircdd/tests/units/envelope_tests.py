@@ -0,0 +1,91 @@
+from ircdd import envelope
+from ircdd.compression import Compressor
+from ircdd.stats import Stats
+
+
+class TestEnvelope:
+
+    def testRoundTrip(self):
+        body = {"type": "privmsg", "text": "hello"}
+        data = envelope.pack("testserver", "testchan", body)
+
+        header = envelope.unpack_header(data)
+
+        assert header.version == envelope.VERSION
+        assert header.msg_type == envelope.TYPES["privmsg"]
+        assert header.origin == envelope.digest("testserver")
+        assert header.target == envelope.digest("testchan")
+
+        parsed = envelope.unpack_body(data)
+
+        assert parsed["origin"] == "testserver"
+        assert parsed["msg_body"] == body
+
+    def testHeaderIsFixedSize(self):
+        for name in ("a", "a" * 64):
+            data = envelope.pack(name, name, {"type": "join"})
+
+            assert data[envelope.HEADER.size] == "{"
+
+    def testUnknownType(self):
+        data = envelope.pack("testserver", "testchan", {"type": "bogus"})
+
+        assert envelope.unpack_header(data).msg_type == envelope.UNKNOWN_TYPE
+
+    def testPlainJsonHasNoHeader(self):
+        assert envelope.unpack_header('{"origin": "testserver"}') is None
+        assert envelope.unpack_header("") is None
+
+    def testDigestAcceptsUnicode(self):
+        assert envelope.digest(u"testchan") == envelope.digest("testchan")
+
+    def testCompressedRoundTrip(self):
+        compressor = Compressor(Stats(), default_threshold=0)
+        body = {"type": "privmsg", "text": "hello " * 100}
+        data = envelope.pack("testserver", "testchan", body,
+                             compressor=compressor)
+
+        header = envelope.unpack_header(data)
+
+        assert header.compressed
+        assert header.msg_type == envelope.TYPES["privmsg"]
+        assert len(data) < len(envelope.pack("testserver", "testchan", body))
+        assert envelope.unpack_body(data)["msg_body"] == body
+
+    def testSequencesPerTarget(self):
+        sequencer = envelope.Sequencer()
+
+        def pack(target):
+            return envelope.unpack_body(
+                envelope.pack("s", target, {}, sequencer=sequencer))
+        first = pack("seqchan")
+        second = pack("seqchan")
+        other = pack("seqother")
+
+        assert (first["seq"], second["seq"], other["seq"]) == (1, 2, 1)
+        assert envelope.stream(first) == envelope.stream(second)
+        assert envelope.stream(first) != envelope.stream(other)
+        assert envelope.stream(first)[0] == "s"
+
+        sequencer.rewind("seqchan")
+        assert pack("seqchan")["seq"] == 2
+
+    def testSequencesPerSequencer(self):
+        first, second = envelope.Sequencer(), envelope.Sequencer()
+
+        assert first.advance("chan")[1] == second.advance("chan")[1] == 1
+        assert first.advance("chan")[0] != second.advance("chan")[0]
+        assert "seq" not in envelope.unpack_body(
+            envelope.pack("s", "chan", {}))
+
+    def testDropsLeastRecentlyUsedCounters(self):
+        sequencer = envelope.Sequencer(max_targets=2)
+        stream, _ = sequencer.advance("a")
+        sequencer.advance("b")
+        sequencer.advance("a")
+        sequencer.advance("c")
+
+        assert sequencer.advance("a") == (stream, 3)
+        again, seq = sequencer.advance("b")
+        assert seq == 1
+        assert again != stream
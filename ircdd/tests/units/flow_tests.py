@@ -0,0 +1,77 @@
+import mock
+
+from twisted.internet import task
+
+from ircdd.flow import FlowController
+from ircdd.stats import Stats
+
+
+def makeReader(conns=1):
+    reader = mock.Mock()
+    reader.total_rdy = 0
+    reader.conns = {}
+    for i in xrange(conns):
+        conn = mock.Mock()
+        conn.rdy = 0
+        conn.max_rdy_count = 2500
+
+        def send_rdy(value, conn=conn):
+            conn.rdy = value
+            return True
+        conn.send_rdy.side_effect = send_rdy
+        reader.conns[i] = conn
+    return reader
+
+
+class TestFlowController:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.flow = FlowController(100, Stats(), interval=1.0,
+                                   clock=self.clock)
+
+    def tick(self, seconds=1.0):
+        self.clock.advance(seconds)
+        self.flow.adjust()
+
+    def testBudgetSharedByRate(self):
+        busy, idle = makeReader(), makeReader()
+        self.flow.register("busy", busy)
+        self.flow.register("idle", idle)
+
+        handler = self.flow.wrap("busy", lambda message: True)
+        self.flow.adjust()
+        for i in xrange(50):
+            handler(None)
+        self.tick()
+
+        assert busy.max_in_flight > idle.max_in_flight
+        assert busy.max_in_flight + idle.max_in_flight <= 100
+        assert busy.conns[0].rdy == busy.max_in_flight
+
+    def testLagShrinksBudget(self):
+        self.flow.register("topic", makeReader())
+        self.flow.adjust()
+
+        self.tick(1.5)
+        assert self.flow.effectiveBudget() == 50
+        assert self.flow.stats.counters["flow.throttles"] == 1
+
+        self.tick()
+        assert self.flow.effectiveBudget() == 60
+
+    def testPressurePausesReaders(self):
+        reader = makeReader(conns=2)
+        self.flow.register("topic", reader)
+        self.flow.pressure = lambda: 32 * 1024 * 1024
+        self.flow.adjust()
+
+        self.tick()
+        assert self.flow.paused
+        assert reader.disabled()
+        assert [c.rdy for c in reader.conns.values()] == [0, 0]
+
+        self.flow.pressure = lambda: 0
+        self.tick()
+        assert not self.flow.paused
+        assert all(c.rdy > 0 for c in reader.conns.values())
@@ -0,0 +1,106 @@
+import mock
+from twisted.test import proto_helpers
+
+from ircdd.context import ConfigStore
+from ircdd.group import ShardedGroup
+from ircdd.interest import InterestMap
+from ircdd.output import OutputBuffer
+from ircdd.protocol import IRCDDUser
+from ircdd.stats import Stats
+
+
+def makeClient(name):
+    client = IRCDDUser()
+    client.name = name
+    client.hostname = "testserver"
+    client.transport = proto_helpers.StringTransport()
+    return client
+
+
+class TestShardedGroup:
+
+    def setUp(self):
+        self.ctx = ConfigStore(hostname="testserver",
+                               remote_rw=mock.Mock(),
+                               db=mock.Mock(),
+                               interest=InterestMap("testserver"),
+                               stats=Stats())
+        self.ctx.db.lookupGroup.return_value = None
+        self.ctx.db.getGroupState.return_value = None
+
+        with mock.patch("ircdd.group.threads"):
+            self.group = ShardedGroup(self.ctx, "chan")
+
+    def testRendersOncePerMessage(self):
+        clients = [makeClient(name) for name in ("john", "jane", "bob")]
+        for client in clients:
+            self.group.local_sessions[client.name] = client
+
+        self.group.receive("john", self.group, {"text": u"hi\nthere"})
+
+        assert clients[0].transport.value() == ""
+        for client in clients[1:]:
+            assert client.transport.value() == (
+                ":john!john@testserver PRIVMSG #chan :hi\r\n"
+                ":john!john@testserver PRIVMSG #chan :there\r\n")
+        assert self.ctx.stats.counters["fanout.renders"] == 1
+
+    def testIsolatesClientErrors(self):
+        broken, ok = makeClient("broken"), makeClient("ok")
+        broken.transport = mock.Mock()
+        broken.transport.write.side_effect = IOError("gone")
+        self.group.local_sessions.update(broken=broken, ok=ok)
+
+        self.group.receive("john", self.group, {"text": "hi"})
+
+        assert ok.transport.value()
+        assert "broken" not in self.group.local_sessions
+        assert self.ctx.stats.counters["fanout.errors"] == 1
+
+    def testWritesPrerenderedLines(self):
+        client = makeClient("jane")
+        self.group.local_sessions["jane"] = client
+
+        self.group.receive("john", self.group,
+                           {"text": "ignored",
+                            "wire": [u"PRIVMSG #chan :hi"]})
+        self.group.receive("john", self.group,
+                           {"text": "hi", "wire": [u"PRIVMSG #chan :\r\nX"]})
+
+        assert client.transport.value() == (
+            ":john!john@testserver PRIVMSG #chan :hi\r\n" * 2)
+
+    def testDropsOnlyChatForPausedClients(self):
+        client = makeClient("jane")
+        transport = client.transport
+        client.transport = OutputBuffer(transport, self.ctx.stats)
+        self.group.local_sessions["jane"] = client
+
+        client.transport.pauseProducing()
+        self.group.receive("john", self.group, {"text": "chat"})
+        client.receive("john", client, {"text": "direct"})
+        client.transport.flush()
+
+        assert transport.value() == \
+            ":john!john@testserver PRIVMSG jane :direct\r\n"
+        assert self.ctx.stats.counters["output.dropped"] == 1
+
+    def testReportsIdleAndCloses(self):
+        idle = []
+        self.group.idle = idle.append
+        client = makeClient("jane")
+        client.ctx = self.ctx
+        self.group.add(client)
+        self.group.remove(client)
+        assert idle == [self.group]
+
+        changeset = mock.Mock()
+        with mock.patch("ircdd.group.reactor") as reactor:
+            self.group._watch(changeset)
+            self.group.close()
+
+            reactor.removeSystemEventTrigger.assert_called_once_with(
+                reactor.addSystemEventTrigger.return_value)
+        changeset.conn.close.assert_called_once_with(False)
+        assert self.group.closed
+        assert not self.ctx.interest.nodes("chan")
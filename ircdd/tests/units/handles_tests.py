@@ -0,0 +1,85 @@
+import mock
+from twisted.internet import task
+
+from ircdd.context import ConfigStore
+from ircdd.handles import RemoteUser, RemoteUserCache
+from ircdd.interest import InterestMap
+from ircdd.realm import ShardedRealm
+from ircdd.stats import Stats
+
+
+class TestRemoteUserCache:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.cache = RemoteUserCache(self.stats, max_size=2, ttl=5.0,
+                                     clock=self.clock)
+
+    def testCachesHandles(self):
+        assert self.cache.get(u"john") is None
+        handle = self.cache.add(u"john")
+
+        assert self.cache.get(u"john") is handle
+        assert handle.mind is handle
+        assert self.stats.counters["remote_users.hits"] == 1
+        assert self.stats.counters["remote_users.misses"] == 1
+
+    def testExpiresHandles(self):
+        self.cache.add(u"john")
+        self.clock.advance(5)
+
+        assert self.cache.get(u"john") is None
+        assert self.stats.snapshot()["remote_users.cached"] == 0
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.cache.add(u"john")
+        self.cache.add(u"jane")
+        self.cache.get(u"john")
+        self.cache.add(u"bob")
+
+        assert self.cache.get(u"jane") is None
+        assert self.cache.get(u"john") is not None
+        assert self.stats.counters["remote_users.evicted"] == 1
+
+    def testInvalidates(self):
+        self.cache.add(u"john")
+        self.cache.invalidate(u"john")
+        self.cache.invalidate(u"jane")
+
+        assert self.cache.get(u"john") is None
+        assert self.stats.counters["remote_users.invalidated"] == 1
+
+
+class TestRealmLookup:
+
+    def setUp(self):
+        self.ctx = ConfigStore(hostname="testserver",
+                               user_on_request=True,
+                               group_on_request=False,
+                               remote_rw=mock.Mock(),
+                               db=mock.Mock(),
+                               interest=InterestMap("testserver"),
+                               stats=Stats())
+        self.ctx.remote_users = RemoteUserCache(self.ctx.stats)
+        self.ctx.db.lookupUser.return_value = {"nickname": u"jane"}
+        self.ctx.db.lookupUserSession.return_value = {"active": True}
+        self.realm = ShardedRealm(self.ctx, "testserver")
+
+    def testReturnsCachedHandleForRemoteUsers(self):
+        results = []
+        for _ in range(3):
+            self.realm.lookupUser(u"jane").addCallback(results.append)
+
+        assert isinstance(results[0], RemoteUser)
+        assert results[1] is results[0] is results[2]
+        assert self.ctx.db.lookupUserSession.call_count == 1
+        assert not self.ctx.remote_rw.subscribe.called
+
+    def testLogsInUserConnectedElsewhere(self):
+        results = []
+        self.realm.lookupUser(u"jane")
+        self.realm.getUser(u"jane").addCallback(results.append)
+
+        assert not isinstance(results[0], RemoteUser)
+        assert results[0].name == u"jane"
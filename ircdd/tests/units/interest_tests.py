@@ -0,0 +1,39 @@
+from ircdd.interest import InterestMap
+
+
+class TestInterestMap:
+
+    def testLocalOnly(self):
+        interest = InterestMap("testserver")
+
+        assert not interest.isLocalOnly("testchan")
+
+        interest.add("testchan", "testserver", "john")
+        assert interest.isLocalOnly("testchan")
+
+        interest.add("testchan", "otherserver", "jane")
+        assert not interest.isLocalOnly("testchan")
+        assert interest.remoteNodes("testchan") == set(["otherserver"])
+
+        interest.remove("testchan", "otherserver", "jane")
+        assert interest.isLocalOnly("testchan")
+
+    def testInterestDroppedWithLastMember(self):
+        interest = InterestMap("testserver")
+
+        interest.add("testchan", "otherserver", "john")
+        interest.add("testchan", "otherserver", "jane")
+
+        interest.remove("testchan", "otherserver", "john")
+        assert interest.nodes("testchan") == set(["otherserver"])
+
+        interest.remove("testchan", "otherserver", "jane")
+        assert interest.nodes("testchan") == set()
+        assert len(interest) == 0
+
+    def testRemoveUnknown(self):
+        interest = InterestMap("testserver")
+
+        interest.remove("testchan", "otherserver", "john")
+
+        assert len(interest) == 0
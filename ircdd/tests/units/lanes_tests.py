@@ -0,0 +1,56 @@
+from twisted.internet import task
+
+from ircdd import lanes
+from ircdd.broker import LocalBroker, LocalReadWriter
+from ircdd.lanes import LaneTransport
+from ircdd.stats import Stats
+
+
+class TestLaneTransport:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.broker = LocalBroker(clock=self.clock)
+        self.stats = Stats()
+        self.node1 = LaneTransport(
+            LocalReadWriter(self.broker, "node1", clock=self.clock),
+            self.stats)
+        self.node2 = LaneTransport(
+            LocalReadWriter(self.broker, "node2", clock=self.clock),
+            self.stats)
+        self.received = []
+
+    def callback(self, message):
+        self.received.append(message.parsed_msg["msg_body"]["type"])
+        message.finish()
+        return True
+
+    def testLaneTopics(self):
+        assert lanes.lane("privmsg") == lanes.CHAT
+        assert lanes.lane("join") == lanes.CONTROL
+        assert lanes.lane_topic("chan", lanes.CHAT) == "chan"
+        assert lanes.lane_topic("chan", lanes.CONTROL) == "chan.control"
+
+    def testControlIsNotQueuedBehindChat(self):
+        self.node2.subscribe("chan", self.callback)
+        reader = self.node2.transport._readers["chan"]
+        reader.max_in_flight = 0
+
+        self.node1.publish("chan", {"type": "privmsg"})
+        self.node1.publish("chan", {"type": "join"})
+        self.clock.advance(0)
+
+        assert self.received == ["join"]
+        assert self.broker.depth() == 1
+        assert self.stats.counters["lanes.chat.published"] == 1
+        assert self.stats.counters["lanes.control.received"] == 1
+        assert "lanes.control.latency_ms" in self.stats.snapshot()
+
+    def testSubscribesOnlyToHandledLanes(self):
+        self.node2.subscribe("user", self.callback, msg_types=["privmsg"])
+
+        assert self.node2.transport._readers.keys() == ["user"]
+
+        self.node2.release("user")
+        self.clock.advance(30.0)
+        assert self.node2.transport._readers == {}
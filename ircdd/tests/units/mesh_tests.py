@@ -0,0 +1,165 @@
+import mock
+from twisted.test import proto_helpers
+
+from ircdd import mesh
+from ircdd.mesh import MeshProtocol, MeshTransport
+
+
+def connect(mesh1, mesh2):
+    """
+    Connects two meshes through in-memory transports and returns
+    a function which moves the pending bytes between them.
+    """
+    proto1, proto2 = MeshProtocol(mesh1), MeshProtocol(mesh2)
+    transport1 = proto_helpers.StringTransport()
+    transport2 = proto_helpers.StringTransport()
+    proto1.makeConnection(transport1)
+    proto2.makeConnection(transport2)
+
+    def pump():
+        while transport1.value() or transport2.value():
+            data1, data2 = transport1.value(), transport2.value()
+            transport1.clear()
+            transport2.clear()
+            proto2.dataReceived(data1)
+            proto1.dataReceived(data2)
+
+    pump()
+    return proto1, proto2, pump
+
+
+class TestMeshTransport:
+
+    def setUp(self):
+        self.clock = proto_helpers.MemoryReactorClock()
+        self.node1 = MeshTransport("node1", None, "host1", 5800,
+                                   clock=self.clock)
+        self.node2 = MeshTransport("node2", None, "host2", 5800,
+                                   clock=self.clock)
+        self.received = []
+
+    def callback(self, message):
+        self.received.append(message.parsed_msg)
+        message.finish()
+        return True
+
+    def testFrames(self):
+        frame = mesh.pack_frame(mesh.MSG, u"topic", "data")
+        assert mesh.unpack_frame(frame) == (mesh.MSG, u"topic", "data")
+
+    def testDeliversToSubscribedPeers(self):
+        self.node2.subscribe("user", self.callback)
+        proto1, proto2, pump = connect(self.node1, self.node2)
+
+        assert self.node1._peers == {"node2": proto1}
+        assert proto1.topics == set(["user"])
+
+        self.node1.publish("user", {"text": "hi"})
+        self.node1.publish("other", {"text": "hi"})
+        pump()
+
+        assert [(m["msg_body"], m["origin"]) for m in self.received] == \
+            [({"text": "hi"}, "node1")]
+        assert self.node1.stats.counters["mesh.sent"] == 1
+
+    def testAnnouncesSubscriptionChanges(self):
+        proto1, proto2, pump = connect(self.node1, self.node2)
+
+        self.node2.subscribe("user", self.callback)
+        pump()
+        assert proto1.topics == set(["user"])
+
+        self.node2.release("user")
+        self.clock.advance(30.0)
+        pump()
+        assert proto1.topics == set()
+
+    def testQueuesWhilePeerIsSlow(self):
+        self.node1.queue_limit = 200
+        self.node2.subscribe("user", self.callback)
+        proto1, proto2, pump = connect(self.node1, self.node2)
+
+        proto1.pauseProducing()
+        self.node1.publish("user", {"text": "hi"})
+        assert proto1.queued > 0
+        self.node1.publish("user", {"text": "x" * 200})
+        assert self.node1.stats.counters["mesh.dropped"] == 1
+
+        proto1.resumeProducing()
+        pump()
+        assert len(self.received) == 1
+        assert proto1.queued == 0
+
+    def testFallsBackUntilConnectedToEveryNode(self):
+        fallback = mock.Mock()
+        self.node1.fallback = fallback
+        self.node1.updateNodes([{"id": "node0", "host": "h", "port": 1},
+                                {"id": "node2", "host": "h", "port": 1}])
+
+        self.node1.publish("user", {"text": "hi"})
+        assert fallback.publish.called
+        assert self.node1.stats.counters["mesh.fallback"] == 1
+
+    def testConnectsToLesserNames(self):
+        self.node2.updateNodes([{"id": "node1", "host": "host1", "port": 1},
+                                {"id": "node3", "host": "host3", "port": 1}])
+
+        assert [c[0] for c in self.clock.tcpClients] == ["host1"]
+
+        self.node2.updateNodes([])
+        assert self.node2._connectors == {}
+
+    def testSendsControlLaneFramesFirst(self):
+        self.node2.subscribe("user", self.callback)
+        self.node2.subscribe("user.control", self.callback)
+        proto1, proto2, pump = connect(self.node1, self.node2)
+
+        proto1.pauseProducing()
+        self.node1.publish("user", {"type": "privmsg"})
+        self.node1.publish("user", {"type": "join"})
+        self.node1.publish("user.control", {"type": "part"})
+        proto1.resumeProducing()
+        pump()
+
+        assert [m["msg_body"]["type"] for m in self.received] == \
+            ["part", "privmsg", "join"]
+
+    def testFallsBackUntilFirstDiscovery(self):
+        fallback = mock.Mock()
+        self.node1.fallback = fallback
+
+        self.node1.publish("user", {"text": "hi"})
+        assert fallback.publish.called
+        assert not self.node1.isComplete()
+
+        self.node1.updateNodes([])
+        assert self.node1.isComplete()
+
+    def testFallsBackUntilPeerAnnouncedSubscriptions(self):
+        fallback = mock.Mock()
+        self.node1.fallback = fallback
+        self.node1.updateNodes([{"id": "node2", "host": "h", "port": 1}])
+        self.node2.subscribe("user", self.callback)
+
+        proto1, proto2 = MeshProtocol(self.node1), MeshProtocol(self.node2)
+        transport2 = proto_helpers.StringTransport()
+        proto1.makeConnection(proto_helpers.StringTransport())
+        proto2.makeConnection(transport2)
+        # The length prefix and the HELLO frame
+        hello = 4 + len(mesh.pack_frame(mesh.HELLO, u"node2"))
+        data = transport2.value()
+
+        proto1.dataReceived(data[:hello])
+        self.node1.publish("user", {"text": "hi"})
+        assert fallback.publish.call_count == 1
+
+        proto1.dataReceived(data[hello:])
+        assert proto1.ready
+        self.node1.publish("user", {"text": "hi"})
+        assert fallback.publish.call_count == 1
+        assert self.node1.stats.counters["mesh.sent"] == 1
+
+    def testCountsMessagesWhileIncomplete(self):
+        self.node1.publish("user", {"text": "hi"})
+
+        assert self.node1.stats.counters["mesh.incomplete"] == 1
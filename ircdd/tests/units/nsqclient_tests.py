@@ -0,0 +1,174 @@
+import json
+import struct
+
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+from ircdd import nsqclient
+from ircdd.nsqclient import NSQProtocol, Reader, Writer
+
+
+def frame(frame_type, data):
+    return struct.pack("!ll", len(data) + 4, frame_type) + data
+
+
+def message(id, body, attempts=1):
+    return frame(nsqclient.FRAME_MESSAGE,
+                 struct.pack("!qH16s", 0, attempts, id) + body)
+
+
+class FakeOwner(object):
+
+    def __init__(self):
+        self.ready = []
+        self.lost = []
+        self.messages = []
+
+    def identify_options(self):
+        return {"client_id": "test"}
+
+    def connectionReady(self, conn):
+        self.ready.append(conn)
+
+    def connectionLost(self, conn):
+        self.lost.append(conn)
+
+    def messageReceived(self, conn, message):
+        self.messages.append(message)
+
+
+class TestNSQProtocol:
+
+    def setUp(self):
+        self.owner = FakeOwner()
+        self.transport = proto_helpers.StringTransport()
+        self.conn = NSQProtocol(self.owner, "nsqd:4150")
+        self.conn.makeConnection(self.transport)
+
+    def respond(self, data, frame_type=nsqclient.FRAME_RESPONSE):
+        self.conn.dataReceived(frame(frame_type, data))
+
+    def testIdentifiesOnConnect(self):
+        sent = self.transport.value()
+        assert sent.startswith(nsqclient.MAGIC + "IDENTIFY\n")
+        assert json.loads(sent[len(nsqclient.MAGIC) + 13:]) == \
+            {"client_id": "test"}
+
+        self.respond(json.dumps({"max_rdy_count": 100}))
+        assert self.owner.ready == [self.conn]
+        assert self.conn.max_rdy_count == 100
+
+    def testAnswersHeartbeats(self):
+        self.respond("OK")
+        self.transport.clear()
+
+        self.respond(nsqclient.HEARTBEAT)
+        assert self.transport.value() == "NOP\n"
+
+    def testParsesFramesSplitAcrossReads(self):
+        self.respond("OK")
+        data = message("0" * 16, "first") + message("1" * 16, "second", 3)
+
+        self.conn.dataReceived(data[:5])
+        self.conn.dataReceived(data[5:40])
+        self.conn.dataReceived(data[40:])
+
+        assert [(m.id, m.body) for m in self.owner.messages] == \
+            [("0" * 16, "first"), ("1" * 16, "second")]
+        assert self.owner.messages[1].attempts == 3
+
+    def testPipelinesPublishes(self):
+        self.respond("OK")
+        results = []
+        self.conn.pub("topic", "a", results.append)
+        self.conn.mpub("topic", ["b", "c"], results.append)
+        self.conn.pub("topic", "d", results.append)
+
+        self.respond("OK")
+        self.respond("E_BAD_MESSAGE", nsqclient.FRAME_ERROR)
+        self.respond("E_FIN_FAILED", nsqclient.FRAME_ERROR)
+        assert results[0] == "OK"
+        assert isinstance(results[1], nsqclient.Error)
+        assert len(results) == 2
+
+        self.conn.connectionLost(failure.Failure(Exception()))
+        assert isinstance(results[2], nsqclient.Error)
+        assert self.owner.lost == [self.conn]
+
+    def testRespondsToMessages(self):
+        self.respond("OK")
+        self.conn.dataReceived(message("0" * 16, "body"))
+        self.transport.clear()
+
+        msg = self.owner.messages[0]
+        msg.finish()
+        assert self.transport.value() == "FIN %s\n" % ("0" * 16)
+        assert msg.has_responded()
+
+
+class TestClients:
+
+    def setUp(self):
+        self.clock = proto_helpers.MemoryReactorClock()
+
+    def connect(self, client):
+        transport = proto_helpers.StringTransport()
+        conn = client._factories.values()[0].buildProtocol(None)
+        conn.makeConnection(transport)
+        transport.clear()
+        conn.dataReceived(frame(nsqclient.FRAME_RESPONSE, "OK"))
+        return conn, transport
+
+    def testWriterFailsWithoutConnections(self):
+        writer = Writer(["nsqd:4150"], clock=self.clock)
+        results = []
+        writer.pub("topic", "msg", lambda conn, data: results.append(data))
+
+        assert isinstance(results[0], nsqclient.Error)
+
+    def testWriterPublishes(self):
+        writer = Writer(["nsqd:4150"], clock=self.clock)
+        conn, transport = self.connect(writer)
+        results = []
+
+        writer.pub(u"topic", "msg", lambda c, data: results.append((c, data)))
+        assert transport.value() == "PUB topic\n" + struct.pack("!l", 3) + \
+            "msg"
+
+        conn.dataReceived(frame(nsqclient.FRAME_RESPONSE, "OK"))
+        assert results == [(conn, "OK")]
+
+    def testReaderSubscribesAndHandlesMessages(self):
+        handled = []
+
+        def handler(message):
+            handled.append(message.body)
+            return message.body == "good"
+
+        reader = Reader(message_handler=handler, topic="topic",
+                        channel="node", nsqd_tcp_addresses=["nsqd:4150"],
+                        max_in_flight=10, clock=self.clock)
+        conn, transport = self.connect(reader)
+        assert transport.value() == "SUB topic node\n"
+
+        transport.clear()
+        conn.dataReceived(frame(nsqclient.FRAME_RESPONSE, "OK"))
+        assert transport.value() == "RDY 10\n"
+        assert reader.total_rdy == 10
+
+        transport.clear()
+        conn.dataReceived(message("0" * 16, "good") +
+                          message("1" * 16, "bad"))
+        assert handled == ["good", "bad"]
+        assert transport.value() == "FIN %s\nREQ %s 0\n" % ("0" * 16,
+                                                            "1" * 16)
+
+    def testDisabledReaderStartsPaused(self):
+        reader = Reader(message_handler=None, topic="topic",
+                        channel="node", nsqd_tcp_addresses=["nsqd:4150"],
+                        clock=self.clock)
+        reader.disabled = lambda: True
+        conn, transport = self.connect(reader)
+        conn.dataReceived(frame(nsqclient.FRAME_RESPONSE, "OK"))
+
+        assert conn.rdy == 0
@@ -0,0 +1,141 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from ircdd.output import OutputBuffer, OutputScheduler
+from ircdd.stats import Stats
+
+
+SENDQ_EXCEEDED = "ERROR :Closing Link: SendQ exceeded\r\n"
+
+
+class TestOutputBuffer:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.transport = proto_helpers.StringTransport()
+        self.buffer = OutputBuffer(self.transport, self.stats,
+                                   max_delay=0.0, max_bytes=20,
+                                   clock=self.clock)
+
+    def testCoalescesUntilNextIteration(self):
+        self.buffer.write("one\r\n")
+        self.buffer.write("two\r\n")
+        assert self.transport.value() == ""
+        assert self.buffer.pending == 10
+
+        self.clock.advance(0)
+        assert self.transport.value() == "one\r\ntwo\r\n"
+        assert self.stats.counters["output.lines"] == 2
+        assert self.stats.counters["output.writes"] == 1
+
+    def testFlushesPastThreshold(self):
+        self.buffer.write("x" * 25)
+
+        assert self.transport.value() == "x" * 25
+        assert not self.clock.getDelayedCalls()
+
+    def testFlushesBeforeLosingConnection(self):
+        self.buffer.write("bye\r\n")
+        self.buffer.loseConnection()
+
+        assert self.transport.value() == "bye\r\n"
+        assert self.transport.disconnecting
+
+    def testDelegatesToTransport(self):
+        assert self.buffer.getPeer() == self.transport.getPeer()
+
+    def testRegistersAsProducer(self):
+        assert self.transport.producer is self.buffer
+        assert self.transport.streaming
+
+    def testDropsChatWhilePaused(self):
+        self.buffer.pauseProducing()
+        assert self.transport.producerState == "paused"
+
+        self.buffer.write("chat\r\n", droppable=True)
+        self.buffer.write("notice\r\n")
+        self.clock.advance(0)
+        assert self.transport.value() == "notice\r\n"
+        assert self.stats.counters["output.dropped"] == 1
+        assert self.stats.counters["output.pauses"] == 1
+
+        self.buffer.resumeProducing()
+        assert self.transport.producerState == "producing"
+        self.buffer.write("chat\r\n", droppable=True)
+        self.clock.advance(0)
+        assert self.transport.value() == "notice\r\nchat\r\n"
+
+    def testCountsDataSentWhilePaused(self):
+        self.buffer.write("x" * 25)
+        assert self.buffer.queued() == 0
+
+        self.buffer.pauseProducing()
+        self.buffer.write("y" * 25)
+        self.buffer.write("z" * 5)
+        assert self.buffer.queued() == 30
+
+        self.buffer.resumeProducing()
+        assert self.buffer.queued() == 5
+
+    def testDisconnectsPastSendQ(self):
+        aborted = []
+        self.transport.abortConnection = lambda: aborted.append(True)
+        self.buffer.sendq = 30
+        self.buffer.pauseProducing()
+        self.buffer.write("x" * 25)
+        self.buffer.write("five\r\n")
+
+        assert self.transport.value() == "x" * 25 + SENDQ_EXCEEDED
+        assert self.transport.disconnecting
+        assert self.buffer.pending == 0
+        assert self.stats.counters["output.sendq_exceeded"] == 1
+
+        self.buffer.write("late\r\n")
+        self.clock.advance(0)
+        assert self.transport.value() == "x" * 25 + SENDQ_EXCEEDED
+
+        self.clock.advance(self.buffer.close_timeout)
+        assert aborted
+
+    def testDoesNotAbortClosedConnections(self):
+        self.buffer.sendq = 10
+        self.buffer.write("x" * 20)
+        assert self.clock.getDelayedCalls()
+
+        self.buffer.discard()
+        assert self.clock.getDelayedCalls() == []
+
+
+class TestOutputScheduler:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.scheduler = OutputScheduler(clock=self.clock)
+
+    def testFlushesAllBuffersWithOneCall(self):
+        transports = [proto_helpers.StringTransport() for _ in range(100)]
+        buffers = [OutputBuffer(transport, self.stats, clock=self.clock,
+                                scheduler=self.scheduler)
+                   for transport in transports]
+
+        for buffer in buffers:
+            buffer.write("one\r\n")
+            buffer.write("two\r\n")
+        assert len(self.clock.getDelayedCalls()) == 1
+
+        self.clock.advance(0)
+        assert all(t.value() == "one\r\ntwo\r\n" for t in transports)
+        assert self.stats.counters["output.writes"] == 100
+        assert self.clock.getDelayedCalls() == []
+
+    def testSkipsDiscardedBuffers(self):
+        transport = proto_helpers.StringTransport()
+        buffer = OutputBuffer(transport, self.stats, clock=self.clock,
+                              scheduler=self.scheduler)
+        buffer.write("one\r\n")
+        buffer.discard()
+
+        self.clock.advance(0)
+        assert transport.value() == ""
@@ -0,0 +1,144 @@
+import mock
+from twisted.internet import defer
+from twisted.test import proto_helpers
+
+from ircdd.context import ConfigStore
+from ircdd.parser import (LineParser, MAX_LINE, dispatch_table, parse_line,
+                          parse_tags)
+from ircdd.protocol import IRCDDUser
+from ircdd.stats import Stats
+
+
+class TestParseLine:
+
+    def testParsesLikeParsemsg(self):
+        assert parse_line("privmsg #chan :hello there") == \
+            (None, "", "PRIVMSG", ["#chan", "hello there"])
+        assert parse_line(":john!john@host JOIN #chan") == \
+            (None, "john!john@host", "JOIN", ["#chan"])
+        assert parse_line("PING") == (None, "", "PING", [])
+        assert parse_line("TOPIC #chan :") == \
+            (None, "", "TOPIC", ["#chan", ""])
+        assert parse_line("MODE  #chan   +o  john") == \
+            (None, "", "MODE", ["#chan", "+o", "john"])
+
+    def testParsesTags(self):
+        tags, prefix, command, params = parse_line(
+            "@time=2015-03-01T12:00:00Z;+draft/msgid=a\\sb\\:c\\\\;flag "
+            ":john PRIVMSG #chan :hi")
+
+        assert tags == {"time": "2015-03-01T12:00:00Z",
+                        "+draft/msgid": "a b;c\\",
+                        "flag": ""}
+        assert (prefix, command, params) == ("john", "PRIVMSG",
+                                             ["#chan", "hi"])
+
+    def testUnescapesTagValues(self):
+        assert parse_tags("a=x\\ny\\r;b=tr\\;c=\\q") == \
+            {"a": "x\ny\r", "b": "tr", "c": "q"}
+
+    def testRejectsMalformedLines(self):
+        for line in (":", ":prefix", ":prefix  ", "@tags", "@a=b :p",
+                     " :trailing", "PRIV.MSG x", ":p :PRIVMSG"):
+            assert parse_line(line) is None, line
+
+
+class TestLineParser:
+
+    def setUp(self):
+        self.stats = Stats()
+        self.parser = LineParser(self.stats)
+
+    def testSplitsLines(self):
+        assert self.parser.feed("NICK john\r\nUSER j 0 * :J") == \
+            [(None, "", "NICK", ["john"])]
+        assert self.parser.feed("\nPING x\n\r\n   \r\n") == \
+            [(None, "", "USER", ["j", "0", "*", "J"]),
+             (None, "", "PING", ["x"])]
+
+    def testKeepsBytes(self):
+        [(_, _, command, params)] = self.parser.feed(
+            "PART #caf\xc3\xa9 :bye \xff\r\n")
+
+        assert command == "PART"
+        assert params == ["#caf\xc3\xa9", "bye \xff"]
+        assert all(isinstance(param, str) for param in params)
+
+    def testDropsMalformedAndOversizedLines(self):
+        assert self.parser.feed(":prefix\r\n") == []
+        assert self.stats.counters["parser.malformed"] == 1
+
+        assert self.parser.feed("PRIVMSG #chan :" + "x" * MAX_LINE) == []
+        assert self.parser.feed("x" * 10) == []
+        assert self.parser.feed("xx\r\nPING x\r\n") == \
+            [(None, "", "PING", ["x"])]
+        assert self.stats.counters["parser.oversized"] == 1
+
+
+class Handlers(IRCDDUser):
+
+    def irc_PING(self, prefix, params):
+        self.handled.append(("class", params, self.tags))
+
+
+class TestDispatch:
+
+    def setUp(self):
+        self.client = Handlers()
+        self.client.ctx = ConfigStore(stats=Stats())
+        self.client.factory = ConfigStore(
+            clients=set(), realm=ConfigStore(name="testserver"))
+        self.client.makeConnection(proto_helpers.StringTransport())
+        self.client.handled = []
+
+    def testBuildsTablePerClass(self):
+        table = dispatch_table(Handlers)
+
+        assert table["PING"][1] == Handlers.irc_PING
+        assert table["JOIN"][1] == IRCDDUser.irc_JOIN
+        assert dispatch_table(Handlers) is table
+
+    def testDispatchesWithTags(self):
+        self.client.dataReceived("@a=1 PING :x\r\nPING y\r\n")
+
+        assert self.client.handled == [("class", ["x"], {"a": "1"}),
+                                       ("class", ["y"], None)]
+        assert self.client.tags is None
+
+    def testPrefersInstanceHandlers(self):
+        self.client.irc_PING = lambda prefix, params: \
+            self.client.handled.append(("instance", params, None))
+        self.client.dataReceived("PING :x\r\n")
+
+        assert self.client.handled == [("instance", ["x"], None)]
+
+
+class TestNonAsciiParams:
+
+    def setUp(self):
+        self.client = IRCDDUser()
+        self.client.ctx = ConfigStore(stats=Stats())
+        self.client.factory = ConfigStore(
+            clients=set(), realm=ConfigStore(name="testserver"))
+        self.client.makeConnection(proto_helpers.StringTransport())
+        self.client.realm = mock.Mock()
+        self.client.avatar = mock.Mock()
+        self.client.avatar.join.return_value = defer.Deferred()
+        self.client.avatar.leave.return_value = defer.Deferred()
+        self.client.name = u"john"
+
+    def testJoinsNonAsciiChannel(self):
+        group = mock.Mock()
+        self.client.realm.getGroup.return_value = defer.succeed(group)
+        self.client.dataReceived("JOIN #caf\xc3\xa9\r\n")
+
+        self.client.realm.getGroup.assert_called_once_with(u"caf\xe9")
+        self.client.avatar.join.assert_called_once_with(group)
+
+    def testPartsWithNonAsciiReason(self):
+        group = mock.Mock()
+        self.client.realm.lookupGroup.return_value = defer.succeed(group)
+        self.client.dataReceived("PART #caf\xc3\xa9 :bye \xc3\xa9\r\n")
+
+        self.client.realm.lookupGroup.assert_called_once_with(u"caf\xe9")
+        self.client.avatar.leave.assert_called_once_with(group, u"bye \xe9")
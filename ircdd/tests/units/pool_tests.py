@@ -0,0 +1,126 @@
+import mock
+import nsq
+from nose.tools import assert_raises
+from twisted.internet import task
+
+from ircdd.pool import WriterPool
+from ircdd.stats import Stats
+
+
+class FakeWriter(object):
+
+    def __init__(self, addresses, **kwargs):
+        self.address = addresses[0]
+        self.conns = {self.address: object()}
+        self.pending = []
+
+    def pub(self, topic, msg, callback=None):
+        self.pending.append(callback)
+
+    def ack(self, ok=True):
+        pending, self.pending = self.pending, []
+        for callback in pending:
+            callback(None, "OK" if ok else nsq.Error("failed"))
+
+
+class TestWriterPool:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.addresses = ["nsqd1:4150", "nsqd2:4150", "nsqd3:4150"]
+        with mock.patch("nsq.Writer", FakeWriter):
+            self.pool = WriterPool(self.addresses, self.stats,
+                                   max_failures=2, probe_interval=5.0,
+                                   clock=self.clock)
+
+    def writer(self, topic):
+        return self.pool.choose(topic).writer
+
+    def fail(self, topic, times):
+        for _ in range(times):
+            writer = self.writer(topic)
+            self.pool.pub(topic, "msg")
+            writer.ack(ok=False)
+
+    def testTopicsStickToOneWriter(self):
+        first = self.writer("topic")
+        for _ in range(5):
+            assert self.writer("topic") is first
+
+        chosen = set(self.writer("topic%s" % i).address for i in range(50))
+        assert len(chosen) == len(self.addresses)
+
+    def testCallbackReceivesResult(self):
+        results = []
+        writer = self.writer("topic")
+        self.pool.pub("topic", "msg",
+                      callback=lambda conn, data: results.append(data))
+        writer.ack()
+
+        assert results == ["OK"]
+
+    def testEjectsFailingWriter(self):
+        first = self.writer("topic")
+        self.fail("topic", 2)
+
+        assert self.writer("topic") is not first
+        assert self.stats.counters["pool.ejections"] == 1
+        assert self.stats.snapshot()["pool.%s.healthy" % first.address] == 0
+
+    def testSkipsDisconnectedWriter(self):
+        first = self.writer("topic")
+        first.conns = {}
+
+        assert self.writer("topic") is not first
+        assert self.pool.conns
+
+    def testReadmitsAfterProbeInterval(self):
+        first = self.writer("topic")
+        self.fail("topic", 2)
+
+        self.clock.advance(5.0)
+        assert self.writer("topic") is first
+
+        self.pool.pub("topic", "msg")
+        first.ack()
+        assert self.writer("topic") is first
+
+    def testBacksOffWhileProbesFail(self):
+        first = self.writer("topic")
+        self.fail("topic", 2)
+
+        self.clock.advance(5.0)
+        self.fail("topic", 1)
+        assert self.writer("topic") is not first
+
+        self.clock.advance(5.0)
+        assert self.writer("topic") is not first
+        self.clock.advance(5.0)
+        assert self.writer("topic") is first
+
+    def testEjectsSlowWriter(self):
+        first = self.pool.choose("topic")
+        for member in self.pool._members:
+            if member is not first:
+                self.pool._record(member, 0.1, False)
+
+        self.pool._record(first, 1.0, False)
+
+        assert self.pool.choose("topic") is not first
+
+    def testNeverEjectsLastWriter(self):
+        for member in self.pool._members:
+            member.writer.conns = {}
+        remaining = self.pool._members[0]
+        remaining.writer.conns = {remaining.address: object()}
+
+        for member in self.pool._members[1:]:
+            self.pool._eject(member)
+        self.fail("topic", 5)
+
+        assert self.pool.choose("topic") is remaining
+        assert remaining.ejected_until is None
+
+    def testRequiresAnAddress(self):
+        assert_raises(ValueError, WriterPool, [], self.stats)
@@ -0,0 +1,123 @@
+import mock
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.words import ewords
+
+from ircdd.context import ConfigStore
+from ircdd.handles import RemoteUserCache
+from ircdd.interest import InterestMap
+from ircdd.protocol import IRCDDUser
+from ircdd.realm import ShardedRealm
+from ircdd.stats import Stats
+from ircdd.wheel import TimingWheel
+
+
+class TestRealmLifecycle:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.ctx = ConfigStore(hostname="testserver",
+                               user_on_request=True,
+                               group_on_request=True,
+                               group_idle_grace=60.0,
+                               remote_rw=mock.Mock(),
+                               db=mock.Mock(),
+                               interest=InterestMap("testserver"),
+                               stats=Stats())
+        self.ctx.remote_users = RemoteUserCache(self.ctx.stats)
+        self.ctx.wheel = TimingWheel(self.ctx.stats, clock=self.clock)
+        self.ctx.db.lookupGroup.return_value = None
+        self.ctx.db.getGroupState.return_value = None
+        self.realm = ShardedRealm(self.ctx, "testserver")
+
+    def advance(self, seconds):
+        for _ in range(int(seconds * 10)):
+            self.clock.advance(0.1)
+            self.ctx.wheel.advance()
+
+    def makeMember(self, name):
+        member = IRCDDUser()
+        member.ctx = self.ctx
+        member.name = name
+        member.hostname = "testserver"
+        member.transport = proto_helpers.StringTransport()
+        return member
+
+    def getGroup(self, name):
+        groups = []
+        with mock.patch("ircdd.group.threads"):
+            self.realm.getGroup(name).addCallback(groups.append)
+        return groups[0]
+
+    def testRemovesUserOnLogout(self):
+        avatar = mock.Mock()
+        avatar.name = u"john"
+        self.realm.users[u"john"] = avatar
+
+        self.realm.logoutFactory(avatar, mock.Mock())()
+
+        assert u"john" not in self.realm.users
+        assert self.ctx.stats.snapshot()["realm.users"] == 0
+
+    def testTearsDownIdleGroups(self):
+        group = self.getGroup(u"chan")
+        member = self.makeMember(u"john")
+        group.add(member)
+
+        self.advance(61)
+        assert self.realm.groups[u"chan"] is group
+
+        group.remove(member)
+        self.advance(30)
+        assert self.realm.groups[u"chan"] is group
+
+        self.advance(31)
+        assert u"chan" not in self.realm.groups
+        assert group.closed
+        assert self.ctx.stats.counters["realm.groups_expired"] == 1
+
+    def testKeepsGroupsRejoinedDuringGrace(self):
+        group = self.getGroup(u"chan")
+        member = self.makeMember(u"john")
+        group.add(member)
+        group.remove(member)
+
+        self.advance(30)
+        group.add(member)
+        self.advance(31)
+
+        assert self.realm.groups[u"chan"] is group
+        assert not group.closed
+
+    def testRehydratesGroupsOnNextUse(self):
+        group = self.getGroup(u"chan")
+        self.advance(61)
+        assert u"chan" not in self.realm.groups
+
+        again = self.getGroup(u"chan")
+        assert again is not group
+        assert self.realm.groups[u"chan"] is again
+
+    def testLooksUpExpiredGroupsInDatabase(self):
+        self.getGroup(u"chan")
+        self.advance(61)
+        assert u"chan" not in self.realm.groups
+
+        self.ctx.db.lookupGroup.return_value = {"name": u"chan",
+                                                "meta": {}}
+        member = self.makeMember(u"john")
+        member.realm = self.realm
+        with mock.patch("ircdd.group.threads"):
+            member.irc_NAMES("", ["#chan"])
+
+        assert member.transport.value().startswith(
+            ":john!john@testserver JOIN #chan\r\n")
+        assert " 366 john #chan :" in member.transport.value()
+        assert u"chan" in self.realm.groups
+
+    def testLooksUpUnknownGroups(self):
+        failures = []
+        self.realm.lookupGroup(u"nowhere").addErrback(failures.append)
+
+        assert failures[0].check(ewords.NoSuchGroup)
+        assert u"nowhere" not in self.realm.groups
@@ -1,6 +1,10 @@
 import mock
 import responses
+from twisted.internet import task
+from ircdd import envelope
 from ircdd.remote import RemoteReadWriter
+from ircdd.reorder import ReorderBuffer
+from ircdd.stats import Stats
 from nose.tools import assert_raises
 
 
@@ -111,3 +115,199 @@ class TestRemoteReadWriter:
                       }"""
 
         assert filteredCb(mock_m) == mock_m.parsed_body["message"]
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("nsq.Message")
+    @mock.patch("tornado.ioloop.IOLoop")
+    def testHeaderFilters(self, mock_w, mock_r, mock_m, mock_io):
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver")
+
+        callback = mock.Mock()
+        filteredCb = rw.filter_callback(callback, target="testchan",
+                                        msg_types=["privmsg"])
+
+        with mock.patch("ircdd.envelope.unpack_body") as mock_unpack:
+            mock_m.body = envelope.pack("testserver", "testchan",
+                                        {"type": "privmsg"})
+            assert filteredCb(mock_m) is True
+
+            mock_m.body = envelope.pack("otherserver", "otherchan",
+                                        {"type": "privmsg"})
+            assert filteredCb(mock_m) is True
+
+            mock_m.body = envelope.pack("otherserver", "testchan",
+                                        {"type": "join"})
+            assert filteredCb(mock_m) is True
+
+            assert not mock_unpack.called
+            assert not callback.called
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("nsq.Message")
+    @mock.patch("tornado.ioloop.IOLoop")
+    def testHeaderPassThrough(self, mock_w, mock_r, mock_m, mock_io):
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver")
+
+        callback = mock.Mock()
+        filteredCb = rw.filter_callback(callback, target="testchan",
+                                        msg_types=["privmsg"])
+
+        mock_m.body = envelope.pack("otherserver", "testchan",
+                                    {"type": "privmsg", "text": "hi"})
+        filteredCb(mock_m)
+
+        callback.assert_called_once_with(mock_m)
+        assert mock_m.parsed_msg["origin"] == "otherserver"
+        assert mock_m.parsed_msg["msg_body"]["text"] == "hi"
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("tornado.ioloop.IOLoop")
+    @responses.activate
+    def testUnsubscribeDeletesChannel(self, mock_w, mock_r, mock_io):
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver")
+
+        responses.add(responses.GET, "http://testserver:5566/create_topic",
+                      status=200)
+        responses.add(responses.GET, "http://testserver:5566/create_channel",
+                      status=200)
+        responses.add(responses.GET, "http://testserver:5566/delete_channel",
+                      status=200)
+
+        rw.subscribe("testopic", "callback")
+        rw.unsubscribe("testopic", delete_channel=True)
+        rw.delete_channels()
+
+        assert responses.calls[-1].request.url.startswith(
+            "http://testserver:5566/delete_channel")
+        assert "channel=testserver" in responses.calls[-1].request.url
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("tornado.ioloop.IOLoop")
+    @mock.patch("ircdd.remote._create_topic")
+    @mock.patch("ircdd.remote._create_channel")
+    @mock.patch("ircdd.remote._delete_channel")
+    def testReleaseEvictsAfterGrace(self, mock_delete, *mocks):
+        clock = task.Clock()
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", reader_grace=30.0,
+                              cleanup_interval=60.0, clock=clock)
+
+        rw.subscribe("testopic", "callback")
+        rw.subscribe("testopic", "callback")
+
+        rw.release("testopic", delete_channel=True)
+        clock.advance(60)
+        assert "testopic" in rw._readers
+
+        rw.release("testopic", delete_channel=True)
+        clock.advance(29)
+        assert "testopic" in rw._readers
+        assert rw.stats.snapshot()["remote.readers"] == 1
+
+        clock.advance(1)
+        assert "testopic" not in rw._readers
+        assert rw.stats.counters["remote.readers_evicted"] == 1
+        assert not mock_delete.called
+
+        clock.advance(60)
+        mock_delete.assert_called_once_with("testopic", "testserver",
+                                            ["testserver:5566"])
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("tornado.ioloop.IOLoop")
+    @mock.patch("ircdd.remote._create_topic")
+    @mock.patch("ircdd.remote._create_channel")
+    @mock.patch("ircdd.remote._delete_channel")
+    def testResubscribeWithinGrace(self, mock_delete, *mocks):
+        clock = task.Clock()
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", reader_grace=30.0, clock=clock)
+
+        rw.subscribe("testopic", "callback")
+        reader = rw._readers["testopic"]
+
+        rw.release("testopic", delete_channel=True)
+        clock.advance(10)
+        rw.subscribe("testopic", "callback")
+        clock.advance(60)
+
+        assert rw._readers["testopic"] is reader
+        assert not reader.close.called
+        assert not mock_delete.called
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("tornado.ioloop.IOLoop")
+    @mock.patch("ircdd.remote._create_topic")
+    @mock.patch("ircdd.remote._create_channel")
+    def testEphemeralTypes(self, mock_channel, mock_topic, mock_io, mock_r,
+                           mock_w):
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", ephemeral_types=["privmsg"])
+        rw._queue = mock.Mock()
+
+        rw.subscribe("user", "callback", msg_types=["privmsg"])
+        rw.subscribe("group", "callback")
+
+        assert sorted(rw._readers) == ["group", "group#ephemeral",
+                                       "user#ephemeral"]
+        mock_channel.assert_any_call("user#ephemeral",
+                                     "testserver#ephemeral",
+                                     ["testserver:5566"])
+
+        rw.publish("group", {"type": "privmsg"})
+        rw.publish("group", {"type": "join"})
+        assert [c[0][0] for c in rw._queue.put.call_args_list] == \
+            ["group#ephemeral", "group"]
+
+        rw.unsubscribe("group", delete_channel=True)
+        rw.unsubscribe("user", delete_channel=True)
+        assert rw._readers == {}
+        assert rw._doomed_channels == set(["group"])
+
+    @mock.patch("nsq.Writer")
+    @mock.patch("nsq.Reader")
+    @mock.patch("tornado.ioloop.IOLoop")
+    @mock.patch("ircdd.remote._create_topic")
+    @mock.patch("ircdd.remote._create_channel")
+    def testResubscribeStartsStreamsAfresh(self, mock_channel, mock_topic,
+                                           mock_io, mock_r, mock_w):
+        clock = task.Clock()
+        stats = Stats()
+        rw = RemoteReadWriter(["testserver:4533"], ["testserver:5566"],
+                              "testserver", clock=clock,
+                              reorder=ReorderBuffer(stats, clock=clock))
+        sequencer = envelope.Sequencer()
+        received = []
+
+        def callback(message):
+            received.append(message.parsed_msg["msg_body"]["n"])
+            return True
+
+        def publish(n):
+            body = envelope.pack("node1", "testopic", {"n": n},
+                                 sequencer=sequencer)
+            mock_r.call_args[1]["message_handler"](mock.Mock(body=body))
+
+        rw.subscribe("testopic", callback)
+        publish(0)
+        rw.unsubscribe("testopic")
+
+        # Published while this server was not listening
+        envelope.pack("node1", "testopic", {"n": 1}, sequencer=sequencer)
+
+        rw.subscribe("testopic", callback)
+        publish(2)
+        publish(3)
+
+        assert received == [0, 2, 3]
+        assert stats.counters["reorder.held"] == 0
+        assert not clock.getDelayedCalls()
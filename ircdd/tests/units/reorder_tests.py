@@ -0,0 +1,116 @@
+import mock
+from twisted.internet import task
+
+from ircdd import envelope, reorder
+from ircdd.reorder import ReorderBuffer
+from ircdd.stats import Stats
+from ircdd.transport import filter_messages
+
+
+class TestReorderBuffer:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.buffer = ReorderBuffer(self.stats, timeout=1.0, max_pending=3,
+                                    max_streams=2, clock=self.clock)
+        self.delivered = []
+
+    def receive(self, seq, key="a"):
+        return self.buffer.receive(key, seq,
+                                   lambda: self.delivered.append((key, seq)))
+
+    def testDeliversInOrder(self):
+        self.receive(5)
+        assert self.receive(7) is reorder.HELD
+        assert self.receive(7) is reorder.DUPLICATE
+        self.receive(6)
+
+        assert self.delivered == [("a", 5), ("a", 6), ("a", 7)]
+        assert self.stats.counters["reorder.held"] == 1
+        assert self.stats.snapshot()["reorder.pending"] == 0
+        assert not self.clock.getDelayedCalls()
+
+    def testSkipsGapAfterTimeout(self):
+        self.receive(1)
+        self.receive(4)
+        self.clock.advance(1.0)
+
+        assert self.delivered == [("a", 1), ("a", 4)]
+        assert self.stats.counters["reorder.gaps"] == 2
+
+        self.receive(2)
+        assert self.delivered[-1] == ("a", 2)
+        assert self.stats.counters["reorder.late"] == 1
+
+    def testSkipsGapWhenTooManyHeld(self):
+        self.receive(1)
+        for seq in (3, 4, 5, 6):
+            self.receive(seq)
+
+        assert [seq for _, seq in self.delivered] == [1, 3, 4, 5, 6]
+        assert self.stats.counters["reorder.gaps"] == 1
+
+    def testEvictsLeastRecentStream(self):
+        self.receive(1, "a")
+        self.receive(3, "a")
+        self.receive(1, "b")
+        self.receive(1, "c")
+
+        assert self.delivered[-2:] == [("a", 3), ("c", 1)]
+        assert self.stats.snapshot()["reorder.streams"] == 2
+        assert self.stats.snapshot()["reorder.pending"] == 0
+
+    def testForgetsStreamsToTarget(self):
+        self.receive(1, ("a", "chan"))
+        self.receive(3, ("a", "chan"))
+        self.receive(1, ("b", "user"))
+
+        self.buffer.forget("chan")
+        assert self.delivered[-1] == (("a", "chan"), 3)
+        assert self.stats.snapshot()["reorder.streams"] == 1
+        assert self.stats.snapshot()["reorder.pending"] == 0
+
+        assert self.receive(9, ("a", "chan")) is None
+        assert not self.clock.getDelayedCalls()
+
+
+class TestFilterReordering:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.buffer = ReorderBuffer(Stats(), clock=self.clock)
+        self.received = []
+        self.sequencer = envelope.Sequencer()
+
+    def callback(self, message):
+        self.received.append(message.parsed_msg["msg_body"]["n"])
+        message.finish()
+
+    def message(self, n):
+        body = {"type": "privmsg", "n": n}
+        return mock.Mock(body=envelope.pack("node1", "chan", body,
+                                            sequencer=self.sequencer))
+
+    def testHoldsMessagesUntilPredecessorsArrive(self):
+        handler = filter_messages(self.callback, "node2", target="chan",
+                                  reorder=self.buffer)
+        first, second, third = [self.message(n) for n in range(3)]
+
+        handler(first)
+        handler(third)
+        assert third.enable_async.called
+        assert not third.finish.called
+
+        handler(second)
+        assert self.received == [0, 1, 2]
+        assert third.finish.called
+
+    def testDoesNotReorderFilteredTypes(self):
+        handler = filter_messages(self.callback, "node2", target="chan",
+                                  msg_types=["privmsg"], reorder=self.buffer)
+        first, second = [self.message(n) for n in range(2)]
+
+        handler(second)
+        handler(first)
+        assert self.received == [1, 0]
@@ -0,0 +1,106 @@
+import mock
+from twisted.internet import task
+
+from ircdd.context import ConfigStore
+from ircdd.handles import RemoteUserCache
+from ircdd.interest import InterestMap
+from ircdd.realm import ShardedRealm
+from ircdd.routes import RoutingTable
+from ircdd.stats import Stats
+
+
+def session(name, node):
+    return {"id": name, "node": node, "last_heartbeat": None}
+
+
+class TestRoutingTable:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.routes = RoutingTable(self.stats, max_age=30.0,
+                                   clock=self.clock)
+
+    def testFollowsSessionChanges(self):
+        self.routes.apply({"new_val": session(u"john", "node1")})
+        self.routes.apply({"new_val": session(u"jane", "node2")})
+        assert self.routes.route(u"john") == "node1"
+
+        self.routes.apply({"old_val": session(u"john", "node1"),
+                           "new_val": session(u"john", "node3")})
+        assert self.routes.route(u"john") == "node3"
+
+        removed = []
+        self.routes.removed = removed.append
+        self.routes.apply({"old_val": session(u"john", "node3"),
+                           "new_val": None})
+        assert self.routes.route(u"john") is None
+        assert removed == [u"john"]
+        assert self.stats.snapshot()["routes.size"] == 1
+
+    def testIgnoresSessionsWithoutNode(self):
+        self.routes.apply({"new_val": session(u"john", "node1")})
+        self.routes.apply({"new_val": {"id": u"john"}})
+
+        assert self.routes.route(u"john") is None
+
+    def testExpiresUnconfirmedRoutes(self):
+        self.routes.apply({"new_val": session(u"john", "node1")})
+        self.clock.advance(20)
+        self.routes.apply({"new_val": session(u"jane", "node1")})
+        assert self.stats.snapshot()["routes.staleness_ms"] == 20000
+
+        self.clock.advance(10)
+        assert self.routes.route(u"john") is None
+        assert self.routes.route(u"jane") == "node1"
+
+        self.routes.purge()
+        assert self.stats.snapshot()["routes.size"] == 1
+
+    def testMissRate(self):
+        self.routes.apply({"new_val": session(u"john", "node1")})
+        self.routes.route(u"john")
+        self.routes.route(u"jane")
+        self.routes.route(u"bob")
+        self.routes.route(u"john")
+
+        assert self.stats.snapshot()["routes.miss_rate"] == 0.5
+
+
+class TestRealmRouting:
+
+    def setUp(self):
+        self.ctx = ConfigStore(hostname="node1",
+                               user_on_request=True,
+                               group_on_request=False,
+                               remote_rw=mock.Mock(),
+                               db=mock.Mock(),
+                               interest=InterestMap("node1"),
+                               stats=Stats())
+        self.ctx.remote_users = RemoteUserCache(self.ctx.stats)
+        self.ctx.routes = RoutingTable(self.ctx.stats)
+        self.ctx.routes.removed = self.ctx.remote_users.invalidate
+        self.realm = ShardedRealm(self.ctx, "node1")
+
+    def testRoutesWithoutQueryingDatabase(self):
+        self.ctx.routes.apply({"new_val": session(u"jane", "node2")})
+
+        results = []
+        self.realm.lookupUser(u"jane").addCallback(results.append)
+
+        assert results[0].node == "node2"
+        assert not self.ctx.db.lookupUser.called
+        assert not self.ctx.db.lookupUserSession.called
+
+    def testLogoutInvalidatesHandle(self):
+        self.ctx.routes.apply({"new_val": session(u"jane", "node2")})
+        self.realm.lookupUser(u"jane")
+        self.ctx.routes.apply({"old_val": session(u"jane", "node2"),
+                               "new_val": None})
+        self.ctx.db.lookupUser.return_value = None
+
+        failures = []
+        self.realm.lookupUser(u"jane").addErrback(failures.append)
+
+        assert failures
+        assert self.ctx.db.lookupUser.called
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+
+from twisted.internet import task
+
+from ircdd.spool import PublishQueue
+from ircdd.stats import Stats
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.connected = True
+        self.pending = []
+        self.published = []
+
+    def send(self, topic, data, done):
+        if not self.connected:
+            done(False)
+        else:
+            self.pending.append((topic, data, done))
+
+    def ack(self, ok=True):
+        pending, self.pending = self.pending, []
+        for topic, data, done in pending:
+            if ok:
+                self.published.append(data)
+            done(ok)
+
+
+class TestPublishQueue:
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.spool")
+        self.clock = task.Clock()
+        self.writer = FakeWriter()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def makeQueue(self, **kwargs):
+        return PublishQueue(self.writer.send,
+                            lambda: self.writer.connected,
+                            Stats(), clock=self.clock, **kwargs)
+
+    def testSendsAndAcknowledges(self):
+        queue = self.makeQueue()
+        acked = []
+
+        queue.put("topic", "one", lambda: acked.append("one"))
+        assert queue.depth() == 1
+
+        self.writer.ack()
+        assert self.writer.published == ["one"]
+        assert acked == ["one"]
+        assert queue.depth() == 0
+
+    def testRetriesInOrderAfterFailure(self):
+        queue = self.makeQueue()
+
+        queue.put("topic", "one")
+        queue.put("topic", "two")
+        self.writer.connected = False
+        self.writer.ack(ok=False)
+        queue.put("topic", "three")
+
+        assert queue.depth() == 3
+        self.clock.advance(5)
+        assert self.writer.published == []
+
+        self.writer.connected = True
+        self.clock.advance(1)
+        self.writer.ack()
+
+        assert self.writer.published == ["one", "two", "three"]
+        assert queue.stats.counters["publish.retries"] == 2
+
+    def testSpillsToDiskInOrder(self):
+        self.writer.connected = False
+        queue = self.makeQueue(memory_limit=6, spool_path=self.path)
+
+        for data in ("aaa", "bbb", "ccc", "ddd"):
+            queue.put("topic", data)
+
+        assert queue.stats.counters["publish.spilled"] == 2
+        assert queue.spoolBytes() > 0
+        assert queue.depth() == 4
+
+        self.writer.connected = True
+        self.clock.advance(1)
+        while self.writer.pending:
+            self.writer.ack()
+
+        assert self.writer.published == ["aaa", "bbb", "ccc", "ddd"]
+        assert queue.spoolBytes() == 0
+        assert os.path.getsize(self.path) == 0
+
+    def testReplaysSpoolLeftByPreviousRun(self):
+        self.writer.connected = False
+        queue = self.makeQueue(memory_limit=0, spool_path=self.path)
+        queue.put("topic", "one")
+        queue.put(u"topic", "two")
+        queue._spool_out.flush()
+
+        with open(self.path, "ab") as spool:
+            spool.write("\x00\x05to")
+
+        self.writer.connected = True
+        queue = self.makeQueue(memory_limit=0, spool_path=self.path)
+        queue.flush()
+        while self.writer.pending:
+            self.writer.ack()
+
+        assert self.writer.published == ["one", "two"]
+
+    def testDropsWithoutSpool(self):
+        self.writer.connected = False
+        queue = self.makeQueue(memory_limit=3)
+
+        queue.put("topic", "one")
+        queue.put("topic", "two")
+
+        assert queue.depth() == 1
+        assert queue.stats.counters["publish.dropped"] == 1
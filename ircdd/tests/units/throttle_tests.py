@@ -0,0 +1,141 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from ircdd.context import ConfigStore
+from ircdd.protocol import IRCDDUser
+from ircdd.stats import Stats
+from ircdd.throttle import FloodControl, TokenBucket
+
+
+class TestTokenBucket:
+
+    def testRefillsUpToBurst(self):
+        clock = task.Clock()
+        bucket = TokenBucket(2.0, 4.0, clock=clock)
+
+        assert bucket.take(4)
+        assert not bucket.take(1)
+        assert bucket.wait(3) == 1.5
+
+        clock.advance(10)
+        assert bucket.take(4)
+        assert not bucket.take(1)
+
+    def testOwesCostsPastBurst(self):
+        clock = task.Clock()
+        bucket = TokenBucket(1.0, 2.0, clock=clock)
+
+        assert bucket.take(5)
+        assert bucket.tokens == -3.0
+        assert bucket.wait(5) == 5.0
+
+
+class TestFloodControl:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.control = FloodControl(self.stats, rate=1.0, burst=3.0,
+                                    max_queued=3,
+                                    global_caps={"LIST": 1},
+                                    clock=self.clock)
+        self.handled = []
+        self.flooded = []
+        self.busy = []
+        self.throttle = self.control.throttle(
+            lambda command, arg: self.handled.append(arg),
+            lambda: self.flooded.append(True),
+            self.busy.append)
+
+    def testLagsCommandsPastBurst(self):
+        for n in range(5):
+            self.throttle.submit("PRIVMSG", n)
+
+        assert self.handled == [0, 1, 2]
+        assert self.stats.snapshot()["flood.queued"] == 2
+        assert self.stats.counters["flood.message.delayed"] == 2
+
+        self.clock.advance(1)
+        assert self.handled == [0, 1, 2, 3]
+        self.clock.advance(1)
+        assert self.handled == [0, 1, 2, 3, 4]
+        assert self.control.queued == 0
+
+    def testChargesPerCommandClass(self):
+        self.throttle.submit("JOIN", "a")
+        self.throttle.submit("JOIN", "b")
+
+        assert self.handled == ["a"]
+        self.clock.advance(1)
+        assert self.handled == ["a", "b"]
+
+    def testFreeCommandsSkipAnEmptyQueue(self):
+        # Leaves the bucket owing tokens
+        self.throttle.submit("LIST", "list")
+        self.throttle.submit("PONG", "pong")
+
+        assert self.handled == ["list", "pong"]
+
+    def testFreeCommandsKeepTheirOrder(self):
+        for n in range(6):
+            self.throttle.submit("PRIVMSG", n)
+        self.throttle.submit("PONG", "pong")
+        self.throttle.submit("QUIT", "quit")
+
+        assert self.handled == [0, 1, 2]
+        assert not self.flooded
+        assert self.stats.snapshot()["flood.queued"] == 5
+
+        self.clock.advance(3)
+        assert self.handled == [0, 1, 2, 3, 4, 5, "pong", "quit"]
+        assert self.control.queued == 0
+
+    def testDisconnectsExcessFlood(self):
+        for n in range(7):
+            self.throttle.submit("PRIVMSG", n)
+
+        assert self.flooded == [True]
+        assert self.stats.counters["flood.excess"] == 1
+        assert self.control.queued == 0
+        assert not self.clock.getDelayedCalls()
+
+    def testRefusesCommandsOverGlobalCap(self):
+        other = self.control.throttle(
+            lambda command, arg: self.handled.append(arg),
+            lambda: None, self.busy.append)
+
+        self.throttle.submit("LIST", "first")
+        other.submit("LIST", "second")
+
+        assert self.handled == ["first"]
+        assert self.busy == ["LIST"]
+        assert self.stats.counters["flood.busy"] == 1
+
+        self.clock.advance(5)
+        other.submit("LIST", "third")
+        assert self.handled == ["first", "third"]
+
+
+class TestIRCDDUserFlood:
+
+    def testThrottlesReceivedLines(self):
+        clock = task.Clock()
+        stats = Stats()
+        client = IRCDDUser()
+        client.ctx = ConfigStore(stats=stats, flood=FloodControl(
+            stats, rate=1.0, burst=1.0, max_queued=1, clock=clock))
+        client.factory = ConfigStore(clients=set(),
+                                     realm=ConfigStore(name="testserver"))
+        client.hostname = "testserver"
+        client.makeConnection(proto_helpers.StringTransport())
+        client.transport.flush()
+        client.transport.clear()
+
+        handled = []
+        client.irc_PING = lambda prefix, params: handled.append(params)
+        client.dataReceived("PING :one\r\nPING :two\r\nPING :three\r\n")
+        client.transport.flush()
+
+        assert handled == [["one"]]
+        assert "Excess Flood" in client.transport.value()
+        assert client.transport.disconnecting
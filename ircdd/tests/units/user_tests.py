@@ -0,0 +1,86 @@
+import mock
+from twisted.internet import task
+
+from ircdd.context import ConfigStore
+from ircdd.interest import InterestMap
+from ircdd.routes import RoutingTable
+from ircdd.stats import Stats
+from ircdd.user import ShardedUser
+from ircdd.wheel import TimingWheel
+
+
+class TestShardedUser:
+
+    def setUp(self):
+        self.ctx = ConfigStore(hostname="testserver",
+                               remote_rw=mock.Mock(),
+                               db=mock.Mock(),
+                               interest=InterestMap("testserver"),
+                               stats=Stats(),
+                               heartbeat_interval=10.0)
+        self.clock = task.Clock()
+        self.ctx.wheel = TimingWheel(self.ctx.stats, clock=self.clock)
+
+    def sendToLocalUser(self, node):
+        self.ctx.routes = RoutingTable(self.ctx.stats, clock=self.clock)
+        self.ctx.routes.apply({"new_val": {"id": "jane", "node": node}})
+        self.ctx.interest.add("jane", "testserver", "jane")
+        recipient = mock.Mock()
+        recipient.name = "jane"
+
+        ShardedUser(self.ctx, "john").send(recipient, {"text": "hi"})
+        assert recipient.receive.called
+
+    def testSendToLocalUserSkipsPublish(self):
+        self.sendToLocalUser("testserver")
+
+        assert not self.ctx.remote_rw.publish.called
+        assert self.ctx.stats.counters["publish.skipped.user"] == 1
+
+    def testSendToUserAlsoConnectedElsewherePublishes(self):
+        self.sendToLocalUser("otherserver")
+
+        assert self.ctx.remote_rw.publish.called
+        assert self.ctx.stats.counters["publish.skipped.user"] == 0
+
+    def testSendToLocalUserPublishesWithoutRoutes(self):
+        john = ShardedUser(self.ctx, "john")
+        recipient = mock.Mock()
+        recipient.name = "jane"
+        self.ctx.interest.add("jane", "testserver", "jane")
+
+        john.send(recipient, {"text": "hi"})
+
+        assert self.ctx.remote_rw.publish.called
+
+    def testSendToRemoteUserPublishes(self):
+        john = ShardedUser(self.ctx, "john")
+        recipient = mock.Mock()
+        recipient.name = "jane"
+
+        john.send(recipient, {"text": "hi"})
+
+        assert self.ctx.remote_rw.publish.called
+        assert self.ctx.stats.counters["publish.skipped.user"] == 0
+
+    def testHeartbeatsOnWheelUntilLogout(self):
+        john = ShardedUser(self.ctx, "john")
+        john.loggedIn(None, mock.Mock())
+
+        for _ in range(100):
+            self.clock.advance(0.1)
+            self.ctx.wheel.advance()
+        assert self.ctx.db.heartbeatUserSession.call_count == 2
+
+        john.logout()
+        assert self.ctx.stats.snapshot()["wheel.timers"] == 0
+
+    def testSendCarriesRenderedLines(self):
+        john = ShardedUser(self.ctx, "john")
+        recipient = mock.Mock()
+        recipient.name = "jane"
+
+        john.send(recipient, {"text": "hi\nthere"})
+
+        message = self.ctx.remote_rw.publish.call_args[0][1]
+        assert message["wire"] == ["PRIVMSG jane :hi", "PRIVMSG jane :there"]
@@ -0,0 +1,69 @@
+from twisted.internet import task
+
+from ircdd.stats import Stats
+from ircdd.wheel import TimingWheel
+
+
+class TestTimingWheel:
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stats = Stats()
+        self.wheel = TimingWheel(self.stats, tick=1.0, slots=4, levels=2,
+                                 clock=self.clock)
+        self.fired = []
+
+    def advance(self, seconds):
+        for _ in range(int(seconds)):
+            self.clock.advance(1.0)
+            self.wheel.advance()
+
+    def testFiresOnceAfterDelay(self):
+        for delay in (1, 3, 6, 13, 40):
+            self.wheel.call_later(delay, lambda d=delay: self.fired.append(
+                (d, self.clock.seconds())))
+
+        self.advance(50)
+
+        assert self.fired == [(1, 1), (3, 3), (6, 6), (13, 13), (40, 40)]
+        assert self.stats.snapshot()["wheel.timers"] == 0
+
+    def testCatchesUpWithMissedTicks(self):
+        self.wheel.call_later(2, lambda: self.fired.append(True))
+
+        self.clock.advance(10.0)
+        self.wheel.advance()
+
+        assert self.fired == [True]
+
+    def testCancels(self):
+        timer = self.wheel.call_later(6, lambda: self.fired.append(True))
+        assert timer.active()
+
+        timer.cancel()
+        self.advance(10)
+
+        assert not timer.active()
+        assert self.fired == []
+        assert self.stats.snapshot()["wheel.timers"] == 0
+
+    def testRepeatsWithinJitter(self):
+        times = []
+        timer = self.wheel.call_every(
+            10, lambda: times.append(self.clock.seconds()), jitter=0.2)
+
+        self.advance(60)
+        timer.cancel()
+
+        assert times[0] <= 10
+        assert all(8 <= b - a <= 12 for a, b in zip(times, times[1:]))
+        assert len(times) >= 5
+
+    def testSpreadsTimersAcrossInterval(self):
+        wheel = TimingWheel(self.stats, tick=1.0, slots=16, levels=2,
+                            clock=self.clock)
+        for _ in range(160):
+            wheel.call_every(10, lambda: None)
+
+        assert self.stats.snapshot()["wheel.slot_max"] < 40
+        assert self.stats.snapshot()["wheel.slot_mean"] == 10.0
@@ -0,0 +1,299 @@
+"""
+This module contains the flood control which paces the commands
+that each client sends, and caps the rate of the commands which
+query the database across all clients of a node.
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+
+
+# The class of each command whose cost differs from the default one
+COMMAND_CLASSES = {
+    "PRIVMSG": "message",
+    "NOTICE": "message",
+    "JOIN": "membership",
+    "PART": "membership",
+    "NAMES": "membership",
+    "TOPIC": "membership",
+    "LIST": "query",
+    "WHO": "query",
+    "WHOIS": "query",
+    "PONG": "free",
+    "QUIT": "free",
+}
+
+# The number of tokens taken by a command of each class
+DEFAULT_COSTS = {
+    "default": 1.0,
+    "message": 1.0,
+    "membership": 2.0,
+    "query": 5.0,
+    "free": 0.0,
+}
+
+# The number of commands per second that all clients may send together
+DEFAULT_GLOBAL_CAPS = {
+    "LIST": 2.0,
+    "WHO": 20.0,
+    "WHOIS": 20.0,
+}
+
+
+def command_class(command):
+    """
+    Returns the class of the given command.
+
+    :param command: the upper-case name of the command.
+    :type string:
+    """
+    return COMMAND_CLASSES.get(command, "default")
+
+
+class TokenBucket(object):
+    """
+    A bucket which fills with ``rate`` tokens per second up to
+    ``burst`` tokens. A cost larger than ``burst`` is taken from a
+    full bucket, which then owes the difference.
+
+    :param rate: the number of tokens added per second.
+    :type float:
+
+    :param burst: the number of tokens the bucket holds.
+    :type float:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    def __init__(self, rate, burst, clock=None):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock or reactor
+
+        self.tokens = burst
+        self._last = self._clock.seconds()
+
+    def _refill(self):
+        now = self._clock.seconds()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self, cost):
+        """
+        Takes the tokens if the bucket holds enough of them, and
+        returns whether it did.
+
+        :param cost: the number of tokens to take.
+        :type float:
+        """
+        self._refill()
+        if self.tokens < min(cost, self.burst):
+            return False
+        self.tokens -= cost
+        return True
+
+    def wait(self, cost):
+        """
+        Returns the number of seconds until the bucket holds the
+        given number of tokens.
+
+        :param cost: the number of tokens needed.
+        :type float:
+        """
+        self._refill()
+        return max(0.0, (min(cost, self.burst) - self.tokens) / self.rate)
+
+
+class ClientThrottle(object):
+    """
+    Paces the commands of a single client connection.
+
+    A command is handled right away while the client's bucket holds
+    enough tokens for it. Otherwise it is queued, along with every
+    command the client sends after it, and handled once the bucket
+    refills: the client is lagged by its own flooding, as classic IRC
+    servers do. A client which queues more than ``max_queued``
+    commands is disconnected. Free commands (``PONG`` and ``QUIT``)
+    take no tokens: they are handled right away when nothing is
+    queued, and otherwise queued in order behind the commands sent
+    before them, without counting against ``max_queued``.
+
+    Created by :meth:`FloodControl.throttle`.
+
+    :param control: the :class:`FloodControl` of the node.
+
+    :param handle: a callable taking the command and its arguments,
+        which handles the command.
+
+    :param flooded: a callable which disconnects the client.
+
+    :param busy: a callable taking the command, which tells the client
+        that the node-wide cap of the command was reached.
+    """
+
+    def __init__(self, control, handle, flooded, busy):
+        self.control = control
+        self.handle = handle
+        self.flooded = flooded
+        self.busy = busy
+
+        self.bucket = TokenBucket(control.rate, control.burst,
+                                  clock=control._clock)
+        self._queue = deque()
+        self._free = 0
+        self._timer = None
+
+    def submit(self, command, *args):
+        """
+        Handles the command now, or queues it.
+
+        :param command: the upper-case name of the command.
+        :type string:
+
+        :param args: the arguments with which the command is handled.
+        """
+        cost = self.control.cost(command)
+
+        if self._queue or (cost and not self.bucket.take(cost)):
+            if cost and (len(self._queue) - self._free >=
+                         self.control.max_queued):
+                self.control.stats.incr("flood.excess")
+                self.stop()
+                self.flooded()
+                return
+
+            self._queue.append((command, args))
+            self.control.queued += 1
+            if not cost:
+                self._free += 1
+            self.control.stats.incr("flood.%s.delayed" %
+                                    command_class(command))
+            self._schedule()
+            return
+
+        self._dispatch(command, args)
+
+    def _dispatch(self, command, args):
+        if self.control.admit(command):
+            self.handle(command, *args)
+        else:
+            self.control.stats.incr("flood.busy")
+            self.busy(command)
+
+    def _schedule(self):
+        if self._timer is None and self._queue:
+            command, _ = self._queue[0]
+            delay = self.bucket.wait(self.control.cost(command))
+            self._timer = self.control._clock.callLater(delay, self._drain)
+
+    def _drain(self):
+        """
+        Handles the queued commands for which the bucket refilled.
+        """
+        self._timer = None
+        while self._queue:
+            command, args = self._queue[0]
+            cost = self.control.cost(command)
+            if cost and not self.bucket.take(cost):
+                break
+            self._queue.popleft()
+            self.control.queued -= 1
+            if not cost:
+                self._free -= 1
+            self._dispatch(command, args)
+        self._schedule()
+
+    def stop(self):
+        """
+        Drops the queued commands, once the connection is gone.
+        """
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self.control.queued -= len(self._queue)
+        self._queue.clear()
+        self._free = 0
+
+
+class FloodControl(object):
+    """
+    The flood control of a node: the token bucket settings shared by
+    the :class:`ClientThrottle` of every client connection, and one
+    node-wide bucket per capped command. Commands over their node-wide
+    cap are refused rather than queued.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the flood counters and gauges.
+
+    :param rate: the number of tokens each client gains per second.
+    :type float:
+
+    :param burst: the number of tokens each client may hold.
+    :type float:
+
+    :param costs: a dict mapping command classes to the number of
+        tokens their commands take, overriding :data:`DEFAULT_COSTS`.
+    :type dict:
+
+    :param max_queued: the number of commands that may be queued for a
+        client before it is disconnected.
+    :type int:
+
+    :param global_caps: a dict mapping commands to the number of them
+        the node handles per second, overriding
+        :data:`DEFAULT_GLOBAL_CAPS`.
+    :type dict:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    def __init__(self, stats, rate=1.0, burst=10.0, costs=None,
+                 max_queued=100, global_caps=None, clock=None):
+        self.stats = stats
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self._clock = clock or reactor
+
+        self.costs = dict(DEFAULT_COSTS)
+        self.costs.update(costs or {})
+
+        caps = dict(DEFAULT_GLOBAL_CAPS)
+        caps.update(global_caps or {})
+        self._caps = dict(
+            (command.upper(), TokenBucket(float(cap), max(1.0, float(cap)),
+                                          clock=self._clock))
+            for command, cap in caps.iteritems() if cap)
+
+        self.queued = 0
+        self.stats.gauge("flood.queued", lambda: self.queued)
+
+    def cost(self, command):
+        """
+        Returns the number of tokens the command takes.
+
+        :param command: the upper-case name of the command.
+        :type string:
+        """
+        return float(self.costs.get(command_class(command),
+                                    self.costs["default"]))
+
+    def admit(self, command):
+        """
+        Returns whether the command is within its node-wide cap.
+
+        :param command: the upper-case name of the command.
+        :type string:
+        """
+        bucket = self._caps.get(command)
+        return bucket is None or bucket.take(1.0)
+
+    def throttle(self, handle, flooded, busy):
+        """
+        Returns a :class:`ClientThrottle` for a new client connection.
+        """
+        return ClientThrottle(self, handle, flooded, busy)
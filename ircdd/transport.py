@@ -0,0 +1,158 @@
+"""
+This module defines the interface of the transports which carry
+messages between the server nodes of the cluster.
+"""
+
+import json
+
+from zope.interface import Interface
+
+from ircdd import envelope, reorder as _reorder
+
+
+class ITransport(Interface):
+    """
+    A publish/subscribe transport between server nodes. Every node
+    consumes each topic it subscribes to on its own channel, so a
+    message published on a topic reaches every subscribed node once.
+    """
+
+    def subscribe(topic, callback, msg_types=None):
+        """
+        Subscribes the callback to the topic and takes a reference
+        on it, which must be dropped with :meth:`release`.
+
+        The callback is called with a message which has the raw
+        ``body``, the decoded ``parsed_msg`` and ``finish`` and
+        ``requeue`` methods, and must finish or requeue it.
+
+        :param topic: the name of the user or group.
+
+        :param callback: the callable to call with each message.
+
+        :param msg_types: an optional list of message types that the
+            callback handles.
+        """
+
+    def release(topic, delete_channel=False):
+        """
+        Drops a reference taken on the topic by :meth:`subscribe`.
+
+        :param topic: the name of the user or group.
+
+        :param delete_channel: if True, this node's channel on the
+            topic is deleted once the topic is no longer consumed.
+        """
+
+    def unsubscribe(topic, delete_channel=False):
+        """
+        Stops consuming the topic immediately.
+
+        :param topic: the name of the user or group.
+
+        :param delete_channel: if True, this node's channel on the
+            topic is deleted.
+        """
+
+    def publish(topic, msg_body, callback=None):
+        """
+        Publishes a message to every node subscribed to the topic.
+
+        :param topic: the name of the user or group.
+
+        :param msg_body: the JSON-serializable message.
+
+        :param callback: an optional callable to call without
+            arguments once the transport has accepted the message.
+        """
+
+
+def filter_messages(callback, server_name, target=None, msg_types=None,
+                    dedup=None, reorder=None):
+    """
+    Wraps the given callback in a filter that discards messages which
+    originated from the given server, messages meant for a different
+    target and messages of types the callback does not handle. The
+    filter only looks at the envelope header; the body is decoded just
+    for the messages that reach the callback, and stored in their
+    ``parsed_msg`` attribute. With a ``dedup`` structure, messages whose
+    ID was already handled are discarded too. With a ``reorder`` buffer,
+    each origin's messages reach the callback in the order in which they
+    were published; a message held by the buffer is marked as handled
+    asynchronously, and the callback finishes it once it is delivered.
+    Only callbacks which take every message type are reordered, since
+    the others see just part of each origin's sequence.
+
+    :param callback: the callback which will be wrapped
+    :type callable:
+
+    :param server_name: the name of the local server.
+    :type string:
+
+    :param target: an optional name of the user or group that
+        messages must be addressed to.
+    :type string:
+
+    :param msg_types: an optional list of accepted message types.
+    :type list:
+
+    :param dedup: an optional :class:`ircdd.dedup.Deduplicator`.
+
+    :param reorder: an optional :class:`ircdd.reorder.ReorderBuffer`.
+    """
+    origin = envelope.digest(server_name)
+    target_digest = envelope.digest(target) if target else None
+    type_codes = None
+    if msg_types:
+        type_codes = frozenset(envelope.type_code(t) for t in msg_types)
+        reorder = None
+
+    def filtered_callback(message):
+        header = envelope.unpack_header(message.body)
+
+        if header is None:
+            # Published by a server that predates the envelope header
+            parsed_msg = json.loads(message.body)
+
+            if parsed_msg['origin'] == server_name:
+                message.finish()
+                return True
+        elif (header.origin == origin or
+              (target_digest and header.target != target_digest) or
+              (type_codes and header.msg_type not in type_codes)):
+            message.finish()
+            return True
+        else:
+            parsed_msg = envelope.unpack_body(message.body)
+
+        id = parsed_msg.get("id")
+        if dedup is not None and id is not None and dedup.seen(id):
+            message.finish()
+            return True
+
+        message.parsed_msg = parsed_msg
+
+        def deliver():
+            result = callback(message)
+
+            # A message that failed will be delivered again and must
+            # not be mistaken for a duplicate then.
+            if dedup is not None and id is not None and result is not False:
+                dedup.add(id)
+            return result
+
+        seq = parsed_msg.get("seq")
+        if reorder is None or seq is None:
+            return deliver()
+
+        key = (envelope.stream(parsed_msg), header.target)
+        result = reorder.receive(key, seq, deliver)
+        if result is _reorder.DUPLICATE:
+            message.finish()
+            return True
+        if result is _reorder.HELD:
+            message.enable_async()
+            return None
+        return result
+
+    return filtered_callback
@@ -8,7 +8,8 @@ from time import time
 from zope.interface import implements
 
 from twisted.words import iwords
-from twisted.internet import task
+
+from ircdd import wire
 
 
 class ShardedUser(object):
@@ -38,16 +39,24 @@ class ShardedUser(object):
         self.mind = mind
 
         self.ctx = ctx
-        self.ctx["remote_rw"].subscribe(self.name, self.receiveRemote)
+        self.ctx["remote_rw"].subscribe(self.name, self.receiveRemote,
+                                        msg_types=["privmsg"])
 
-        self.heartbeat = task.LoopingCall(self._hbSession)
-        self.heartbeat_groups = task.LoopingCall(self._hbGroupSession)
+        self.heartbeat = None
+
+    def _heartbeat(self):
+        """
+        Sends the periodic heartbeats of the user's session and
+        group subscriptions.
+        """
+        self._hbSession()
+        self._hbGroupSession()
 
     def _hbSession(self):
         """
         Sends a hearbeat to the user's session document.
         """
-        self.ctx.db.heartbeatUserSession(self.name)
+        self.ctx.db.heartbeatUserSession(self.name, self.ctx.hostname)
 
     def _hbGroupSession(self):
         """
@@ -55,18 +64,24 @@ class ShardedUser(object):
         in order to maintain presence in them.
         """
         for group in self.groups:
-            self.ctx.db.heartbeatUserInGroup(self.name, group.name)
+            self.ctx.db.heartbeatUserInGroup(self.name, group.name,
+                                             self.ctx.hostname)
 
     def send(self, recipient, message):
         """
         Sends message to the given recipient, even if the
         recipient is not local.
+        The message's IRC lines are rendered once, here, and carried
+        along under ``wire`` unless ``prerender_messages`` is off.
         Sending is done in four steps:
 
         1. Determine that recipient exists via the
         database.
         2. Dispatch message to the recipient's
-        message topic.
+        message topic, unless no other node has sessions
+        for the recipient: for a group, no other node showed
+        interest in it; for a user, the routing table also
+        places their session on this node.
         3. Add message to the database chat log.
         4. Dispatch message to the local shard of the
         recipient, if any.
@@ -79,7 +94,31 @@ class ShardedUser(object):
         message["recipient"] = recipient.name
         message["type"] = "privmsg"
 
-        self.ctx.remote_rw.publish(recipient.name, message)
+        if iwords.IGroup.providedBy(recipient):
+            local_only = not recipient.hasRemoteMembers()
+            kind = "group"
+            recipient_name = "#" + recipient.name
+        else:
+            # Nothing registers remote interest in user topics, so the
+            # user may also be connected to another node unless the
+            # routing table places their session on this one
+            routes = self.ctx.get("routes")
+            local_only = (routes is not None and
+                          self.ctx.interest.isLocalOnly(recipient.name) and
+                          routes.route(recipient.name) == self.ctx.hostname)
+            kind = "user"
+            recipient_name = recipient.name
+
+        if self.ctx.get("prerender_messages", True):
+            message["wire"] = wire.privmsg_lines(
+                recipient_name,
+                message.get("text", "<an unrepresentable message>"))
+
+        if local_only:
+            self.ctx.stats.incr("publish.skipped.%s" % kind)
+        else:
+            self.ctx.remote_rw.publish(recipient.name, message)
+
         self.lastMessage = time()
         return recipient.receive(self.name, recipient, message)
 
@@ -104,28 +143,32 @@ class ShardedUser(object):
         """
         Associates this ShardedUser with a client connection
         and starts to heartbeat the user's session and group
-        subscription,
+        subscription on the node's :class:`ircdd.wheel.TimingWheel`,
         completing the login process.
         """
         self.realm = realm
         self.mind = mind
 
+        self.ctx.interest.add(self.name, self.ctx.hostname, self.name)
+
         self._hbSession()
 
-        self.heartbeat.start(10.0)
-        self.heartbeat_groups.start(10.0)
+        self.heartbeat = self.ctx.wheel.call_every(
+            self.ctx.heartbeat_interval, self._heartbeat)
 
     def logout(self):
         """
         Stops maintaining the sessions and cleans them,
-        completing the logout process
+        completing the logout process. The user's topic is
+        released so that its reader can be shut down.
         """
-        self.heartbeat.stop()
-        self.heartbeat_groups.stop()
+        self.heartbeat.cancel()
 
-        for g in self.groups:
+        for g in self.groups[:]:
             self.leave(g)
 
+        self.ctx.interest.remove(self.name, self.ctx.hostname, self.name)
+        self.ctx.remote_rw.release(self.name, delete_channel=True)
         self.ctx.db.removeUserSession(self.name)
 
     def join(self, group):
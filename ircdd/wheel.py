@@ -0,0 +1,222 @@
+"""
+This module contains the timing wheel which runs the periodic
+per-user work of a server node, such as session heartbeats.
+"""
+
+import random
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class Timer(object):
+    """
+    A callable scheduled on a :class:`TimingWheel`.
+    """
+
+    __slots__ = ("wheel", "func", "expires", "interval", "jitter", "slot")
+
+    def __init__(self, wheel, func, expires, interval=None, jitter=0.0):
+        self.wheel = wheel
+        self.func = func
+        self.expires = expires
+        self.interval = interval
+        self.jitter = jitter
+        self.slot = None
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        """
+        Stops the timer.
+        """
+        self.wheel.cancel(self)
+
+
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel: ``levels`` wheels of ``slots`` slots
+    each, where a slot of the first wheel spans one ``tick`` and a slot
+    of every following wheel spans a whole turn of the previous one.
+    A timer is put in the slot of the coarsest wheel that its deadline
+    requires, and moved down a wheel whenever that slot comes up, so
+    scheduling and cancelling a timer take constant time whatever the
+    number of timers. Every tick, the timers of the current slot of the
+    first wheel are fired together.
+
+    Periodic timers start at a random point of their interval and are
+    rescheduled with up to ``jitter`` of their interval added or taken
+    away, so that timers created at the same time, e.g. by clients
+    reconnecting after an outage, spread evenly across the interval.
+
+    The wheel does not schedule anything on the reactor: :meth:`advance`
+    must be called about every ``tick`` seconds, and catches up with
+    the ticks elapsed since the previous call.
+
+    :param stats: the :class:`ircdd.stats.Stats` registry on which to
+        maintain the wheel counters and gauges.
+
+    :param tick: the number of seconds spanned by a slot of the first
+        wheel, i.e. the resolution of the timers.
+    :type float:
+
+    :param slots: the number of slots of each wheel.
+    :type int:
+
+    :param levels: the number of wheels. Deadlines past
+        ``tick * slots ** levels`` seconds are moved down the wheels
+        later than due.
+    :type int:
+
+    :param clock: the :class:`twisted.internet.interfaces.IReactorTime`
+        provider used for timing. Defaults to the reactor.
+    """
+
+    def __init__(self, stats, tick=0.1, slots=64, levels=3, clock=None):
+        self.stats = stats
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._clock = clock or reactor
+        self._random = random.Random()
+
+        self._wheels = [[set() for _ in range(slots)]
+                        for _ in range(levels)]
+        self._spans = [slots ** level for level in range(levels)]
+        self._started = self._clock.seconds()
+        self._now = 0
+        self._count = 0
+
+        self.stats.gauge("wheel.timers", lambda: self._count)
+        self.stats.gauge("wheel.slot_max",
+                         lambda: max(len(slot) for slot in self._wheels[0]))
+        self.stats.gauge("wheel.slot_mean",
+                         lambda: (float(sum(len(slot)
+                                            for slot in self._wheels[0])) /
+                                  self.slots))
+
+    def _ticks(self, delay):
+        return max(1, int(round(delay / self.tick)))
+
+    def _insert(self, timer):
+        """
+        Puts the timer in the slot of the coarsest wheel needed to
+        hold its deadline.
+        """
+        remaining = max(timer.expires - self._now, 0)
+
+        for level, span in enumerate(self._spans):
+            if remaining < span * self.slots:
+                index = (timer.expires // span) % self.slots
+                break
+        else:
+            # Too far out: parked in the slot which comes up last
+            index = (self._now // span - 1) % self.slots
+
+        slot = self._wheels[level][index]
+        slot.add(timer)
+        timer.slot = slot
+
+    def call_later(self, delay, func):
+        """
+        Schedules the callable to be called, without arguments, in
+        about ``delay`` seconds. Returns the :class:`Timer`.
+
+        :param delay: the number of seconds before the call.
+        :type float:
+
+        :param func: the callable to call.
+        """
+        timer = Timer(self, func, self._now + self._ticks(delay))
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def call_every(self, interval, func, jitter=0.1):
+        """
+        Schedules the callable to be called, without arguments, about
+        every ``interval`` seconds, starting at a random point of the
+        first interval. Returns the :class:`Timer`.
+
+        :param interval: the number of seconds between calls.
+        :type float:
+
+        :param func: the callable to call.
+
+        :param jitter: the fraction of the interval by which each
+            call may be moved.
+        :type float:
+        """
+        delay = self._random.uniform(0, interval)
+        timer = Timer(self, func, self._now + self._ticks(delay),
+                      interval, jitter)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        Stops the timer, if it is still scheduled.
+
+        :param timer: a :class:`Timer` of this wheel.
+        """
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+
+    def advance(self):
+        """
+        Fires the timers which came due since the previous call.
+        Meant to be called every ``tick`` seconds.
+        """
+        target = int((self._clock.seconds() - self._started) / self.tick)
+        while self._now < target:
+            self._now += 1
+            self._cascade()
+            self._fire(self._wheels[0][self._now % self.slots])
+
+    def _cascade(self):
+        """
+        Moves the timers of the slots which come up on the coarser
+        wheels down to the finer ones.
+        """
+        for level in range(1, self.levels):
+            span = self._spans[level]
+            if self._now % span:
+                break
+
+            index = (self._now // span) % self.slots
+            slot = self._wheels[level][index]
+            self._wheels[level][index] = set()
+            for timer in slot:
+                self._insert(timer)
+
+    def _fire(self, slot):
+        if not slot:
+            return
+
+        due = [timer for timer in slot if timer.expires <= self._now]
+        self.stats.incr("wheel.batches")
+        self.stats.incr("wheel.fired", len(due))
+
+        for timer in due:
+            if timer.slot is not slot:
+                # Cancelled by one of the timers fired before it
+                continue
+            slot.discard(timer)
+            if timer.interval is None:
+                timer.slot = None
+                self._count -= 1
+            else:
+                spread = timer.interval * timer.jitter
+                delay = timer.interval + self._random.uniform(-spread,
+                                                              spread)
+                timer.expires = self._now + self._ticks(delay)
+                self._insert(timer)
+
+            try:
+                timer.func()
+            except Exception:
+                log.err()
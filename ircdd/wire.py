@@ -0,0 +1,71 @@
+"""
+This module renders the IRC lines that are written to clients, so
+that a message sent to many clients is rendered once.
+"""
+
+from twisted.words.protocols import irc
+
+
+def privmsg_lines(recipient_name, text):
+    """
+    Returns the ``PRIVMSG`` lines, without prefix or line ending,
+    which carry the text to the recipient: one per line of text.
+
+    :param recipient_name: the name of the recipient, with the ``#``
+        prefix for groups.
+    :type string:
+
+    :param text: the text of the message.
+    :type string:
+    """
+    return ["PRIVMSG %s :%s" % (recipient_name, irc.lowQuote(line))
+            for line in text.splitlines()]
+
+
+def message_lines(message, recipient_name):
+    """
+    Returns the ``PRIVMSG`` lines of a message: the lines rendered by
+    the server it was sent on, carried under ``wire``, or else lines
+    rendered from its text.
+
+    :param message: a message dictionary.
+    :type dict:
+
+    :param recipient_name: the name of the recipient, with the ``#``
+        prefix for groups.
+    :type string:
+    """
+    lines = message.get("wire")
+    if isinstance(lines, list) and all(
+            isinstance(line, basestring) and
+            "\r" not in line and "\n" not in line
+            for line in lines):
+        return lines
+
+    return privmsg_lines(recipient_name,
+                         message.get("text", "<an unrepresentable message>"))
+
+
+def render(sender_name, hostname, lines, encoding="utf-8"):
+    """
+    Returns the bytes which send the lines from the sender, prefixed
+    with the sender's ``nick!user@host`` as seen by a client of the
+    given server.
+
+    :param sender_name: the name of the sender.
+    :type string:
+
+    :param hostname: the name of the server the client is connected to.
+    :type string:
+
+    :param lines: lines returned by :func:`privmsg_lines`.
+    :type list:
+
+    :param encoding: the encoding of the client.
+    :type string:
+    """
+    prefix = ":%s!%s@%s " % (sender_name, sender_name, hostname)
+    data = "".join(prefix + line + "\r\n" for line in lines)
+    if isinstance(data, unicode):
+        data = data.encode(encoding)
+    return data
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+"""
+Measures the number of client lines per second that are split, parsed
+and dispatched to their handler by Twisted's IRC protocol (parsemsg
+and a getattr lookup per line) and by ircdd.parser (LineParser and the
+dispatch table of the class).
+
+    python scripts/benchmarks/irc_parser.py --count 200000
+"""
+
+import argparse
+import time
+
+from twisted.words.protocols import irc
+
+from ircdd import parser
+from ircdd.stats import Stats
+
+
+LINES = [
+    "PRIVMSG #python :does anyone know how to profile a twisted app?\r\n",
+    ":john!john@example.org PRIVMSG jane :hi there\r\n",
+    "PING :irc.example.org\r\n",
+    "JOIN #python\r\n",
+    "@time=2015-03-01T12:00:00.000Z;msgid=abc PRIVMSG #chan :tagged\r\n",
+    "WHO #python\r\n",
+]
+
+
+class Handlers(irc.IRC):
+    """
+    A protocol whose handlers do nothing, so only the parsing and
+    dispatch are measured.
+    """
+
+    def irc_PRIVMSG(self, prefix, params):
+        pass
+
+    def irc_PING(self, prefix, params):
+        pass
+
+    def irc_JOIN(self, prefix, params):
+        pass
+
+    def irc_WHO(self, prefix, params):
+        pass
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+
+class Twisted(Handlers):
+
+    def dispatch(self, data):
+        self.dataReceived(data)
+
+
+class Table(Handlers):
+
+    def __init__(self):
+        self.lineParser = parser.LineParser(Stats())
+
+    def dispatch(self, data):
+        table = parser.dispatch_table(self.__class__)
+        for tags, prefix, command, params in self.lineParser.feed(data):
+            entry = table.get(command)
+            if entry is None:
+                self.irc_unknown(prefix, command, params)
+            else:
+                entry[1](self, prefix, params)
+
+
+def run(protocol, chunks):
+    start = time.time()
+    for chunk in chunks:
+        protocol.dispatch(chunk)
+    return time.time() - start
+
+
+def main(args):
+    data = "".join(LINES) * (args.count // len(LINES))
+    lines = data.count("\n")
+    # Split the data as it is received from the network
+    chunks = [data[i:i + args.chunk]
+              for i in range(0, len(data), args.chunk)]
+
+    for name, protocol in [("twisted", Twisted()), ("ircdd", Table())]:
+        protocol.buffer = ""
+        best = min(run(protocol, chunks) for _ in range(args.repeat))
+        print("%-8s %10.0f lines/s" % (name, lines / best))
+
+
+if __name__ == "__main__":
+    parser_ = argparse.ArgumentParser(description=__doc__)
+    parser_.add_argument("--count", type=int, default=200000)
+    parser_.add_argument("--chunk", type=int, default=4096,
+                         help="bytes received per read")
+    parser_.add_argument("--repeat", type=int, default=3)
+    main(parser_.parse_args())
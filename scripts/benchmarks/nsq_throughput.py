@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+"""
+Measures the publish and consume throughput of the pynsq client
+(running on tornado's IOLoop bridged into the reactor) and of the
+native Twisted client in ircdd.nsqclient, against a running nsqd.
+
+    python scripts/benchmarks/nsq_throughput.py --nsqd 127.0.0.1:4150
+"""
+
+import argparse
+import time
+import uuid
+
+from tornado.platform.twisted import TwistedIOLoop
+TwistedIOLoop().install()
+
+import nsq  # noqa
+from twisted.internet import defer, reactor, task  # noqa
+
+from ircdd import nsqclient  # noqa
+
+
+def wait_for(condition, interval=0.01):
+    d = defer.Deferred()
+
+    def check():
+        if condition():
+            poll.stop()
+            d.callback(None)
+
+    poll = task.LoopingCall(check)
+    poll.start(interval)
+    return d
+
+
+@defer.inlineCallbacks
+def run(client, nsqd, count, size, window, max_in_flight):
+    topic = "bench_%s" % uuid.uuid4().hex[:8]
+    body = "x" * size
+
+    writer = client.Writer([nsqd])
+    yield wait_for(lambda: writer.conns)
+
+    acked = [0]
+    outstanding = [0]
+
+    def published(conn, data):
+        outstanding[0] -= 1
+        if not isinstance(data, client.Error):
+            acked[0] += 1
+
+    start = time.time()
+    sent = 0
+    while sent < count:
+        while sent < count and outstanding[0] < window:
+            outstanding[0] += 1
+            sent += 1
+            writer.pub(topic, body, callback=published)
+        yield wait_for(lambda: outstanding[0] < window, 0)
+    yield wait_for(lambda: outstanding[0] == 0, 0)
+    pub_elapsed = time.time() - start
+
+    received = [0]
+
+    def handler(message):
+        received[0] += 1
+        return True
+
+    start = time.time()
+    reader = client.Reader(message_handler=handler,
+                           nsqd_tcp_addresses=[nsqd],
+                           topic=topic, channel="bench",
+                           max_in_flight=max_in_flight)
+    yield wait_for(lambda: received[0] >= acked[0])
+    sub_elapsed = time.time() - start
+    reader.close()
+
+    defer.returnValue((acked[0] / pub_elapsed, received[0] / sub_elapsed))
+
+
+@defer.inlineCallbacks
+def main(args):
+    clients = [("pynsq", nsq), ("native", nsqclient)]
+    try:
+        for name, client in clients:
+            pub_rate, sub_rate = yield run(client, args.nsqd, args.count,
+                                           args.size, args.window,
+                                           args.max_in_flight)
+            print("%-8s publish %10.0f msg/s   consume %10.0f msg/s" %
+                  (name, pub_rate, sub_rate))
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nsqd", default="127.0.0.1:4150")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--window", type=int, default=1000,
+                        help="unacknowledged publishes in flight")
+    parser.add_argument("--max-in-flight", type=int, default=2500)
+    args = parser.parse_args()
+
+    reactor.callWhenRunning(main, args)
+    reactor.run()
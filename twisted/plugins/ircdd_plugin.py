@@ -4,14 +4,11 @@ from zope.interface import implements
 from twisted.cred import credentials, strcred
 from twisted.python import usage, log
 from twisted.plugin import IPlugin
-from twisted.application.service import IServiceMaker
+from twisted.application.service import IServiceMaker, MultiService
 
 import ircdd.server as ircdd_server
 from ircdd import context
 
-from tornado.platform.twisted import TwistedIOLoop
-TwistedIOLoop().install()
-
 logging.basicConfig()
 observer = log.PythonLoggingObserver()
 observer.start()
@@ -26,7 +23,17 @@ class Options(usage.Options, strcred.AuthOptionMixin):
         ["db", "D", "ircdd", "Name of the database holding cluster data."],
         ["rdb_port", "", 28015, "Database port for client connections."],
         ["rdb_host", "", "localhost", "Database host."],
-        ["config", "C", None, "Configuration file."]
+        ["config", "C", None, "Configuration file."],
+        ["stats_interval", "", 60, "Seconds between stats reports."],
+        ["spool_path", "", "ircdd.spool",
+         "File to which outbound messages are spilled when NSQ is down."],
+        ["transport", "", "nsq",
+         "Transport between instances: nsq, mesh for direct connections, "
+         "or local for an in-process broker."],
+        ["nsq_client", "", "pynsq",
+         "NSQ client: pynsq, or native for the Twisted client."],
+        ["mesh_port", "", 5800,
+         "Port on which to listen for other instances (mesh transport)."]
         ]
 
     optFlags = [["ssl", "S", "Use ssl."],
@@ -54,6 +61,16 @@ class IRCDDServiceMaker():
 
     def makeService(self, config):
         ctx = context.makeContext(config)
-        return ircdd_server.makeServer(ctx)
+
+        service = MultiService()
+        ircdd_server.makeServer(ctx).setServiceParent(service)
+        ircdd_server.makeStatsReporter(ctx).setServiceParent(service)
+        ircdd_server.makeFlowController(ctx).setServiceParent(service)
+        ircdd_server.makeTimingWheel(ctx).setServiceParent(service)
+        if ctx.get('routes') is not None:
+            ircdd_server.makeRoutingTable(ctx).setServiceParent(service)
+        if ctx.get('transport') == 'mesh':
+            ircdd_server.makeMeshService(ctx).setServiceParent(service)
+        return service
 
 serviceMaker = IRCDDServiceMaker()